@@ -1 +1,48 @@
+# rascode - WCPS queries against rasdaman data cubes
+# The public classes are imported on first access, so `import rascode` loads no
+# submodule and none of NumPy, PIL or the HTTP clients
 
+import importlib
+
+# Public name -> submodule defining it
+_EXPORTS = {
+    'DataCube': 'main',
+    'WebDataConnector': 'wdc',
+    'DataBlockConnector': 'dbc',
+    'AsyncDataBlockConnector': 'adbc',
+    'DatabaseOperation': 'dbo',
+    'QueryCache': 'cache',
+    'QueryResult': 'results',
+    'decode_result': 'results',
+    'ImageResult': 'images',
+    'Query': 'query',
+    'QueryError': 'exceptions',
+    'DependencyError': 'exceptions',
+    'ServerError': 'exceptions',
+    'OverloadError': 'exceptions',
+    'AdaptiveLimiter': 'limiter',
+    'RetryPolicy': 'limiter',
+    'HedgePolicy': 'hedging',
+    'OperationGraph': 'dag',
+    'LocalEvaluator': 'local',
+    'ChunkStore': 'store',
+    'FanOutResult': 'fanout',
+    'CoverageMetadata': 'metadata',
+    'TiledQuery': 'tiling',
+    'TimeSeriesFetcher': 'timeseries',
+    'Instrumentation': 'instrumentation',
+    'MetricsSink': 'instrumentation',
+    'LogSink': 'instrumentation',
+}
+
+__all__ = list(_EXPORTS)
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{_EXPORTS[name]}", __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
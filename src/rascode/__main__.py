@@ -0,0 +1,7 @@
+# python -m rascode runs a batch of query specs, see cli.py
+
+import sys
+
+from .cli import main
+
+sys.exit(main())
@@ -0,0 +1,149 @@
+# Asynchronous DataBase Connection object
+# asyncio counterpart of the DBC, built on aiohttp
+# One ADBC instance is created when a WDC is created and is shared by its DBOs
+
+import time
+
+from .exceptions import ServerError
+from .limiter import AsyncAdaptiveLimiter, RetryPolicy, is_overload, retry_after
+
+class AsyncDataBlockConnector:
+    # Set URL to that specified by user
+    # max_in_flight - maximum number of WCPS requests sent to the server at the same time
+    # timeout - (connect, read) timeout in seconds used for every query, or one number for both
+    # compress - ask the server for gzip/deflate compressed responses
+    # coalesce - identical queries awaited while one is in flight share its request
+    # adaptive - start at max_in_flight requests in flight and lower the limit when the
+    # server answers 5xx/429, times out or slows down (see limiter.py); False uses a
+    # fixed semaphore
+    # retry - RetryPolicy as for DataBlockConnector (True for the default, None to disable)
+    def __init__(self, url, max_in_flight=100, timeout=(5, 60), compress=True, coalesce=True,
+                 adaptive=True, retry=True):
+        self.url = url
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.coalesce = coalesce
+        self.adaptive = adaptive
+        self.retry = RetryPolicy() if retry is True else retry
+        self.limiter = None
+        self.headers = {'Accept-Encoding': 'gzip, deflate' if compress else 'identity'}
+        self._session = None
+        self._semaphore = None
+        self._in_flight = {}
+
+    # The aiohttp session and the semaphore or limiter are created on first use,
+    # inside the event loop that runs the queries
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            import asyncio
+            import aiohttp
+
+            connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+            connect, read = self.timeout if isinstance(self.timeout, (tuple, list)) else (self.timeout,) * 2
+            timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            if self.adaptive:
+                self.limiter = AsyncAdaptiveLimiter(initial=self.max_in_flight, max_limit=self.max_in_flight)
+            else:
+                self._semaphore = asyncio.Semaphore(self.max_in_flight)
+            self._in_flight = {}
+        return self._session
+
+    # Close the session and its pooled connections
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # trace is an optional QueryTrace, filled in as by DataBlockConnector.query
+    async def query(self, query, trace=None):
+        if not self.coalesce:
+            return await self._send(query, trace)
+
+        # The request runs as a task shared by every caller of the same query; shield keeps
+        # it running for the others when one caller is cancelled
+        import asyncio
+        self._get_session()
+        task = self._in_flight.get(query)
+        if task is None:
+            task = asyncio.ensure_future(self._send(query, trace))
+            self._in_flight[query] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(query, None))
+        elif trace is not None:
+            trace.shared = True
+            with trace.phase('wait'):
+                return await asyncio.shield(task)
+        return await asyncio.shield(task)
+
+    # Errors of requests worth retrying besides the statuses of the RetryPolicy
+    @staticmethod
+    def _transient_errors():
+        import asyncio
+        import aiohttp
+        return (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+    # Retryable failures are sent again after a jittered backoff
+    async def _send(self, query, trace):
+        import asyncio
+        session = self._get_session()
+        attempt = 0
+        while True:
+            try:
+                return await self._limited(session, query, trace)
+            except Exception as e:
+                attempt += 1
+                if self.retry is None or attempt >= self.retry.attempts \
+                        or not self.retry.retryable(e, self._transient_errors()):
+                    raise
+                delay = self.retry.delay(attempt - 1, getattr(e, 'retry_after', None))
+                if trace is None:
+                    await asyncio.sleep(delay)
+                else:
+                    trace.retries += 1
+                    with trace.phase('backoff'):
+                        await asyncio.sleep(delay)
+
+    # Only max_in_flight requests are sent at once, the rest wait on the semaphore,
+    # or for the current limit of the adaptive limiter
+    async def _limited(self, session, query, trace):
+        import asyncio
+        if self.limiter is None:
+            async with self._semaphore:
+                return await self._post(session, query, trace)
+
+        if trace is None:
+            started = await self.limiter.acquire()
+        else:
+            with trace.phase('queue'):
+                started = await self.limiter.acquire()
+        try:
+            content = await self._post(session, query, trace)
+        except BaseException as e:
+            self.limiter.release(started, ok=False, overloaded=is_overload(e, (asyncio.TimeoutError,)))
+            raise
+        self.limiter.release(started, ok=True)
+        return content
+
+    async def _post(self, session, query, trace):
+        start = time.perf_counter()
+        async with session.post(self.url, params={'query': query}, headers=self.headers) as response:
+            if trace is None:
+                content = await response.read()
+            else:
+                trace.timings['wait'] = trace.timings.get('wait', 0.0) + time.perf_counter() - start
+                with trace.phase('download'):
+                    content = await response.read()
+                # Content-Length is the transferred (compressed) size when the server sends it
+                trace.bytes += response.content_length or len(content)
+
+            # If  successful, return response; if unsuccessful, display error message
+            if response.status == 200:
+                return content
+            raise ServerError(f"Error: {response.status}, {content.decode('utf-8', 'replace')}",
+                              response.status, retry_after(response.headers))
@@ -17,11 +17,13 @@ class dbc:
     # inside of __init__ we initialize the connection to the WCPS server
     def __init__(self):
         self.server_url = 'https://ows.rasdaman.org/rasdaman/ows?REQUEST=GetCoverage' # Link used for connection to WCPS server - Gets Coverages for the user
+        self.session = requests.Session() # Keep-alive session, reuses the connection between queries
+        self.timeout = (5, 60) # (connect, read) timeout in seconds
     
     # Send the query to WCPS server - result is either the response or just an error
     def query_run(self, query):
         try:
-            response = requests.post(self.server_url, {'query':query})
+            response = self.session.post(self.server_url, {'query':query}, timeout=self.timeout)
             response.raise_for_status()
         except HTTPError as e:
             # Checks for server side errors
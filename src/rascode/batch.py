@@ -0,0 +1,90 @@
+# Point query batching
+# Folds point queries (single values and aggregates at one location) on the same
+# coverage into one WCPS request returning a struct, then splits the result again
+
+import re
+
+# for $c in (coverage) return [min|max|avg|count|add(] $c[...] [> 15] [)]
+_POINT_QUERY = re.compile(r"""
+    ^\s*for\s+\$c\s+in\s*\(\s*(?P<coverage>[\w.-]+)\s*\)\s*return\s+
+    (?P<expr>
+        (?P<func>min|max|avg|count|add)\s*\(\s*\$c\s*\[(?P<agg_subset>[^\[\]]*)\]
+            (?:\s*(?:[<>]=?|!?=)\s*-?[\d.]+)?\s*\)
+        |
+        \$c\s*\[(?P<subset>[^\[\]]*)\]
+    )\s*$""", re.VERBOSE)
+_QUOTED = re.compile(r'"[^"]*"|\'[^\']*\'')
+
+def match_point_query(query):
+    """
+    Returns (coverage, expression) if the query evaluates to a single value at one
+    location and can be folded into a batch, otherwise None.
+    """
+    match = _POINT_QUERY.match(query)
+    if match is None:
+        return None
+    # A subset without an aggregate is only a single value if every axis is sliced
+    subset = match.group('subset')
+    if subset is not None and ':' in _QUOTED.sub('', subset):
+        return None
+    return match.group('coverage'), ' '.join(match.group('expr').split())
+
+def split_struct_result(text, count):
+    """
+    Splits the '{v0,v1,...}' text returned for a struct into its count values.
+    """
+    values = [value.strip() for value in text.strip().strip('{}').split(',')]
+    if len(values) != count:
+        raise ValueError(f"Expected {count} values in batch result, got {len(values)}")
+    return values
+
+class PointBatch:
+    """
+    One request to send to the server.
+    - 'query' is the (possibly folded) WCPS query.
+    - 'indices' are the positions of the original queries it answers.
+    """
+    def __init__(self, query, indices, batched):
+        self.query = query
+        self.indices = indices
+        self.batched = batched
+
+    # Returns one result per original query; an error is handed to every query of the batch
+    def split(self, result):
+        if not self.batched or isinstance(result, Exception):
+            return [result] * len(self.indices)
+        if hasattr(result, 'raw'):
+            # Typed results (QueryResult) are split on their raw text and decoded per point
+            values = split_struct_result(result.raw.decode('utf-8'), len(self.indices))
+            return [type(result)(value.encode('utf-8')) for value in values]
+        return split_struct_result(result, len(self.indices))
+
+def fold_point_queries(queries, max_points=100):
+    """
+    Groups the point queries of the list by coverage into batches of at most
+    max_points, each sent as one query. Other queries are kept as single batches.
+    """
+    batches = []
+    groups = {}
+    for i, query in enumerate(queries):
+        point = match_point_query(query)
+        if point is None:
+            batches.append(PointBatch(query, [i], False))
+            continue
+        coverage, expr = point
+        group = groups.setdefault(coverage, [])
+        group.append((i, expr))
+        if len(group) == max_points:
+            batches.append(_fold(coverage, group))
+            groups[coverage] = []
+    for coverage, group in groups.items():
+        if group:
+            batches.append(_fold(coverage, group))
+    return batches
+
+def _fold(coverage, group):
+    if len(group) == 1:
+        i, expr = group[0]
+        return PointBatch(f"for $c in ({coverage}) return {expr}", [i], False)
+    fields = "; ".join(f"p{n}: {expr}" for n, (_, expr) in enumerate(group))
+    return PointBatch(f"for $c in ({coverage}) return {{{fields}}}", [i for i, _ in group], True)
@@ -0,0 +1,354 @@
+# Benchmarks
+# Measures the overhead of the library against the local mock WCPS server and prints
+# the results as JSON, so runs of different versions can be compared
+#
+# PYTHONPATH=src python -m rascode.benchmark [--latency 0.02] [--requests 200] [--output bench.json]
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from .instrumentation import Instrumentation, MetricsSink
+from .mockserver import MockWCPSServer, make_netcdf
+from .results import decode_result
+
+ANSI = '"2014-01":"2014-12"'
+
+# Dependencies that importing the package must not load
+HEAVY_MODULES = ('numpy', 'PIL', 'requests', 'urllib3', 'aiohttp', 'asyncio')
+
+# Arguments for every query-building method of DataCube
+QUERY_METHODS = {
+    'most_basic_query': (),
+    'get_single_value': (53.08, 8.80, '"2014-07"'),
+    'get_3d_to_1d_subset': (53.08, 8.80, ANSI),
+    'get_3d_to_2d_subset': ('"2014-07"',),
+    'get_celsius_to_kelvin': (53.08, 8.80, ANSI),
+    'get_min': (53.08, 8.80, ANSI),
+    'get_max': (53.08, 8.80, ANSI),
+    'get_avg': (53.08, 8.80, ANSI),
+    'get_when_temp_more_than_15': (53.08, 8.80, ANSI),
+    'get_summary': (53.08, 8.80, ANSI),
+    'get_on_the_fly_coloring': ('35:75', '-20:40', '2014-07'),
+    'get_coverage_consturctor': (),
+    'retrieve_temperature_data': (53.08, 8.80, '2014-01:2014-12'),
+    'calculate_aggregate_temperature': (53.08, 8.80, '2014-01:2014-12'),
+    'visualize_temperature': ('35:75', '-20:40', '2014-07', {'high': 30, 'low': 10}),
+    'advanced_query_capabilities': (53.08, 8.80, '$c > 0', ['[ansi("2014-07")]']),
+    'get_data_series': (53.08, 8.80, '2014-01', '2014-12', 'P1M'),
+    'apply_threshold_filter': (15,),
+    'extract_seasonal_data': (53.08, 8.80, 'summer', '2014'),
+    'spatial_aggregation': ('35:75', '-20:40', '2014-07'),
+    'difference_between_dates': (53.08, 8.80, '2014-01', '2014-07'),
+    'classify_data': ([10, 20, 30],),
+    'correlation_between_variables': ('AvgLandTemp', 'AvgTemperatureColor', '35:75', '-20:40', ANSI),
+}
+
+def latency_stats(samples):
+    """
+    Summarizes latency samples (seconds) in milliseconds.
+    """
+    samples = np.asarray(samples) * 1000
+    if samples.size == 0:
+        return {}
+    p50, p90, p99 = np.percentile(samples, [50, 90, 99])
+    return {'count': int(samples.size), 'mean_ms': float(samples.mean()), 'p50_ms': float(p50),
+            'p90_ms': float(p90), 'p99_ms': float(p99), 'max_ms': float(samples.max())}
+
+def _per_call(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+def bench_import(module='rascode.main', repeat=5):
+    """
+    Time for a fresh interpreter to import module (best of repeat runs, in milliseconds)
+    and the heavy dependencies that the import loaded.
+    """
+    code = (f"import sys, time; start = time.perf_counter(); import {module}; "
+            f"print(time.perf_counter() - start); "
+            f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    env = dict(os.environ)
+    src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [src, env.get('PYTHONPATH')]))
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                env=env, check=True).stdout.split('\n')
+        times.append(float(output[0]) * 1000)
+    return {'module': module, 'ms': min(times), 'heavy_modules': [m for m in output[1].split(',') if m]}
+
+def bench_query_build(repeat=2000):
+    """
+    Time to build one query with each DataCube method, in microseconds.
+    """
+    from .main import DataCube
+    cube = DataCube("AvgLandTemp")
+    results = {}
+    for name, args in QUERY_METHODS.items():
+        method = getattr(cube, name)
+        results[name] = _per_call(lambda: method(*args), repeat) * 1e6
+    return {'us_per_query': results}
+
+def bench_connector(url, requests, max_workers):
+    """
+    Latency percentiles and throughput of DataBlockConnector.query, sequential and
+    from max_workers threads sharing the connection pool. Every request is a different
+    query, so none are coalesced.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from .dbc import DataBlockConnector
+    query = 'for $c in (AvgLandTemp) return $c[Lat({:.3f}), Long(8.80), ansi("2014-07")]'
+    results = {}
+    for workers in (1, max_workers):
+        dbc = DataBlockConnector(url, pool_maxsize=workers)
+
+        def timed(i):
+            start = time.perf_counter()
+            try:
+                dbc.query(query.format(53 + i / 1000))
+                return time.perf_counter() - start, True
+            except Exception:
+                return time.perf_counter() - start, False
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            samples = list(executor.map(timed, range(requests)))
+        elapsed = time.perf_counter() - start
+        dbc.close()
+        stats = latency_stats([latency for latency, _ in samples])
+        stats['errors'] = sum(1 for _, ok in samples if not ok)
+        stats['requests_per_s'] = requests / elapsed
+        results[f'workers_{workers}'] = stats
+    return results
+
+def bench_batch(url, operations, max_workers):
+    """
+    Wall-clock time of DatabaseOperation.execute_all_operations for a queue of point
+    queries - sequential, concurrent and with point batching.
+    """
+    from .main import DataCube
+    from .wdc import WebDataConnector
+    cube = DataCube("AvgLandTemp")
+    results = {}
+    modes = {'sequential': {}, 'concurrent': {'max_workers': max_workers},
+             'batched': {'batch_points': True}}
+    for mode, options in modes.items():
+        wdc = WebDataConnector(url, pool_maxsize=max_workers)
+        dbo = wdc.createDBO()
+        for i in range(operations):
+            dbo.add_operation(cube.get_avg(53.08 + i * 0.01, 8.80, ANSI))
+        start = time.perf_counter()
+        dbo.execute_all_operations(**options)
+        results[mode] = {'operations': operations, 'seconds': time.perf_counter() - start}
+        wdc.close()
+    return results
+
+def bench_instrumentation(url, requests):
+    """
+    Cost of tracing: time per query of execute_operation without sinks and with a
+    MetricsSink, and the phase histograms the sink collected.
+    """
+    from .wdc import WebDataConnector
+    instrumentation = Instrumentation()
+    wdc = WebDataConnector(url, instrumentation=instrumentation)
+    dbo = wdc.createDBO()
+    dbo.add_operation('for $c in (AvgLandTemp) return $c[Lat(53.08), Long(8.80), ansi("2014-07")]')
+    results = {'off_ms': _per_call(lambda: dbo.execute_operation(1), requests) * 1000}
+    sink = instrumentation.add_sink(MetricsSink())
+    results['on_ms'] = _per_call(lambda: dbo.execute_operation(1), requests) * 1000
+    results['metrics'] = sink.snapshot()
+    wdc.close()
+    return results
+
+def bench_overload(latency, requests, max_workers, capacity):
+    """
+    Queries against a server answering at most 'capacity' queries at once, with the
+    adaptive limiter and without it; both retry the rejected requests.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from .dbc import DataBlockConnector
+    from .limiter import RetryPolicy
+    results = {}
+    for mode, limiter in (('adaptive', True), ('fixed', None)):
+        with MockWCPSServer(latency=latency, capacity=capacity) as server:
+            dbc = DataBlockConnector(server.url, pool_maxsize=max_workers, limiter=limiter,
+                                     retry=RetryPolicy(attempts=50, base=latency / 2, cap=1.0))
+            queries = [f"for $c in (AvgLandTemp) return {i}" for i in range(requests)]
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(dbc.query, queries))
+            results[mode] = {'seconds': time.perf_counter() - start, 'requests': server.requests,
+                             'rejected': server.rejected}
+            dbc.close()
+    return results
+
+def bench_hedging(latency, requests, slow_rate=0.02, slow_latency=0.3):
+    """
+    Latency of sequential point queries against a server answering a fraction of them
+    slowly, with and without hedged requests.
+    """
+    from .dbc import DataBlockConnector
+    from .main import DataCube
+    cube = DataCube("AvgLandTemp")
+    results = {}
+    for mode, hedge in (('hedged', True), ('plain', None)):
+        with MockWCPSServer(latency=latency, slow_rate=slow_rate, slow_latency=slow_latency) as server:
+            dbc = DataBlockConnector(server.url, hedge=hedge)
+            samples = []
+            for i in range(requests):
+                start = time.perf_counter()
+                dbc.query(cube.get_avg(53.08 + i / 1000, 8.80, ANSI))
+                samples.append(time.perf_counter() - start)
+            results[mode] = dict(latency_stats(samples), requests=server.requests)
+            dbc.close()
+    return results
+
+def bench_local(url, requests):
+    """
+    Time per derived point query (min, max, avg, count above 15, kelvin) answered by the
+    server and by a LocalEvaluator holding the series.
+    """
+    from .local import LocalEvaluator
+    from .main import DataCube
+    from .wdc import WebDataConnector
+    cube = DataCube("AvgLandTemp")
+    methods = (cube.get_min, cube.get_max, cube.get_avg, cube.get_when_temp_more_than_15,
+               cube.get_celsius_to_kelvin)
+    results = {}
+    for mode, local in (('server', None), ('local', LocalEvaluator())):
+        wdc = WebDataConnector(url, local=local, coalesce=False)
+        dbo = wdc.createDBO()
+        dbo.add_operation(cube.get_3d_to_1d_subset(53.08, 8.80, ANSI))
+        dbo.execute_operation(1)
+        dbo.clear_operation()
+        for i in range(requests):
+            dbo.add_operation(methods[i % len(methods)](53.08, 8.80, ANSI))
+        start = time.perf_counter()
+        dbo.execute_all_operations()
+        results[mode] = {'queries': requests, 'per_query_us': (time.perf_counter() - start) / requests * 1e6}
+        wdc.close()
+    return results
+
+def bench_store(latency, reads=20):
+    """
+    Time to read a Lat/Long/ansi subset from the server and from a ChunkStore that holds it,
+    and the time of a first read that fetches its chunks.
+    """
+    import tempfile
+    from .metadata import Axis, CoverageMetadata
+    from .store import ChunkStore
+    from .wdc import WebDataConnector
+    grid = CoverageMetadata('Grid', 'EPSG:4326', [
+        Axis('Lat', -90.0, 90.0, 180, 1.0), Axis('Long', -180.0, 180.0, 360, 1.0),
+        Axis('ansi', '2000-01', '2009-12', 120, coefficients=[f"{y}-{m:02d}-01T00:00:00.000Z"
+                                                             for y in range(2000, 2010) for m in range(1, 13)])])
+    subset = {'Lat': '35:75', 'Long': '-10:30', 'ansi': '"2001-01":"2004-12"'}
+    with MockWCPSServer(latency=latency, grid=grid) as server, tempfile.TemporaryDirectory() as root:
+        wdc = WebDataConnector(server.url, coalesce=False)
+        store = ChunkStore(root, grid, wdc.createDBO(image_dir=None))
+        query = ('for $c in (Grid) return encode($c[Lat(35.5:74.5), Long(-9.5:29.5), '
+                 'ansi("2001-01":"2004-12")], "application/netcdf")')
+        server_ms = _per_call(lambda: wdc.dbc.query(query), reads) * 1000
+        start = time.perf_counter()
+        store.read(**subset)
+        first_ms = (time.perf_counter() - start) * 1000
+        chunks = store.fetched
+        stored_ms = _per_call(lambda: store.read(**subset), reads) * 1000
+        wdc.close()
+    return {'cells': 40 * 40 * 48, 'server_ms': server_ms, 'first_read_ms': first_ms,
+            'chunks_fetched': chunks, 'stored_read_ms': stored_ms}
+
+def bench_fan_out(url, coverages=10, locations=20):
+    """
+    Time to fetch a series for every coverage and location one request after another and
+    with DatabaseOperation.fan_out, which also aligns them into one array.
+    """
+    from .main import DataCube
+    from .wdc import WebDataConnector
+    names = [f"Coverage{i}" for i in range(coverages)]
+    points = [(50 + i / 10, 8.80) for i in range(locations)]
+    wdc = WebDataConnector(url, coalesce=False)
+    dbo = wdc.createDBO()
+    start = time.perf_counter()
+    sequential = [[decode_result(wdc.dbc.query(DataCube(name).get_3d_to_1d_subset(lat, long, ANSI)))
+                   for lat, long in points] for name in names]
+    sequential_s = time.perf_counter() - start
+    start = time.perf_counter()
+    result = dbo.fan_out('get_3d_to_1d_subset', names, points, ANSI, max_workers=16)
+    result.correlation()
+    fan_out_s = time.perf_counter() - start
+    wdc.close()
+    return {'queries': coverages * locations, 'shape': list(result.values.shape),
+            'sequential_s': sequential_s, 'fan_out_s': fan_out_s}
+
+def bench_decode(series_length=100000, repeat=20):
+    """
+    Size and decoding time of a series as CSV, JSON and netCDF, and of a '{...}' array,
+    compared with splitting the CSV text by hand.
+    """
+    values = np.random.default_rng(0).random(series_length) * 40
+    csv = ','.join(f"{v:.6f}" for v in values).encode()
+    rows = int(series_length ** 0.5)
+    grid = ','.join('{' + ','.join(f"{v:.6f}" for v in values[i * rows:(i + 1) * rows]) + '}'
+                    for i in range(rows)).encode()
+    netcdf = make_netcdf('AvgLandTemp', values, ('ansi',))
+    as_json = json.dumps(values.tolist()).encode()
+    return {
+        'series_length': series_length,
+        'csv_bytes': len(csv),
+        'json_bytes': len(as_json),
+        'netcdf_bytes': len(netcdf),
+        'csv_decode_ms': _per_call(lambda: decode_result(csv), repeat) * 1000,
+        'csv_split_ms': _per_call(lambda: [float(v) for v in csv.decode().split(',')], repeat) * 1000,
+        'array_decode_ms': _per_call(lambda: decode_result(grid), repeat) * 1000,
+        'json_decode_ms': _per_call(lambda: decode_result(as_json), repeat) * 1000,
+        'netcdf_decode_ms': _per_call(lambda: decode_result(netcdf), repeat) * 1000,
+    }
+
+def run(latency=0.02, requests=200, operations=50, max_workers=16, series_length=100000):
+    """
+    Runs every benchmark and returns the results as a dict.
+    """
+    report = {'python': platform.python_version(), 'numpy': np.__version__,
+              'latency_s': latency, 'import': bench_import(), 'query_build': bench_query_build(),
+              'decode': bench_decode(series_length)}
+    with MockWCPSServer(latency=latency) as server:
+        report['connector'] = bench_connector(server.url, requests, max_workers)
+        report['batch'] = bench_batch(server.url, operations, max_workers)
+        report['instrumentation'] = bench_instrumentation(server.url, requests)
+        report['local'] = bench_local(server.url, requests)
+        report['fan_out'] = bench_fan_out(server.url)
+        report['server_requests'] = server.requests
+    report['hedging'] = bench_hedging(latency, requests)
+    report['store'] = bench_store(latency)
+    report['overload'] = bench_overload(latency, requests, max_workers, max(max_workers // 4, 1))
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the WCPS library against a local mock server")
+    parser.add_argument('--latency', type=float, default=0.02, help="mock server latency in seconds")
+    parser.add_argument('--requests', type=int, default=200, help="requests per connector benchmark")
+    parser.add_argument('--operations', type=int, default=50, help="queued operations per batch benchmark")
+    parser.add_argument('--workers', type=int, default=16, help="threads for the concurrent benchmarks")
+    parser.add_argument('--series-length', type=int, default=100000, help="values per decoded series")
+    parser.add_argument('--output', help="write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    report = run(args.latency, args.requests, args.operations, args.workers, args.series_length)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    print(text)
+
+if __name__ == "__main__":
+    sys.exit(main())
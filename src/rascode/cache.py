@@ -0,0 +1,216 @@
+# Response cache
+# Two tiers: a size-bounded in-memory LRU backed by a persistent on-disk store
+# Entries are keyed by the normalized WCPS query text and the server URL
+
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+# Quoted literals are kept as they are, everything else is whitespace-normalized
+_TOKEN = re.compile(r'"[^"]*"|\'[^\']*\'|[^"\']+')
+_SPACE = re.compile(r'\s+')
+_AROUND_SYMBOL = re.compile(r'\s*([()\[\]{},:;=<>+\-*/])\s*')
+_TRAILING_ZEROS = re.compile(r'(?<![\w.])(\d+\.\d*[1-9])0+(?![\w.])')
+
+def normalize_query(query):
+    """
+    Returns the query with runs of whitespace collapsed, the whitespace around
+    brackets, separators and operators (including '-', which keeps negative
+    literals such as '-5' intact) removed and trailing zeros dropped from
+    decimal numbers, so queries that only differ in layout (such as the
+    triple-quoted queries of DataCube) map to the same text.
+    Only zeros after a non-zero fractional digit are dropped ('2.50' becomes '2.5'):
+    WCPS computes in floating point for 10.0 but in integers for 10.
+    """
+    parts = []
+    for token in _TOKEN.findall(query):
+        if token[0] in '"\'':
+            parts.append(token)
+        else:
+            token = _SPACE.sub(' ', token)
+            token = _AROUND_SYMBOL.sub(r'\1', token)
+            parts.append(_TRAILING_ZEROS.sub(r'\1', token))
+    return ''.join(parts).strip()
+
+def cache_key(query, url):
+    """
+    Returns the cache key of a query sent to the server at url.
+    """
+    text = f"{url}\n{normalize_query(query)}"
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class QueryCache:
+    """
+    Caches query results (bytes) in memory and, if a directory is given, on disk.
+    - 'max_entries' and 'max_bytes' bound the in-memory LRU.
+    - 'directory' enables the on-disk store, bounded by 'disk_max_bytes'.
+    - 'ttl' is the lifetime of an entry in seconds (None keeps entries until evicted).
+    """
+    def __init__(self, directory=None, max_entries=1024, max_bytes=64 * 2**20,
+                 disk_max_bytes=2**30, ttl=None):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'memory_hits': 0, 'disk_hits': 0,
+                       'evictions': 0, 'expired': 0}
+        self._disk_bytes = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._disk_bytes = sum(size for _, _, size in self._disk_entries())
+
+    @property
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_entries'] = len(self._memory)
+            stats['memory_bytes'] = self._memory_bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def get(self, query, url):
+        key = cache_key(query, url)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                stored, content = entry
+                if self._expired(stored, now):
+                    self._drop_memory(key)
+                    self._stats['expired'] += 1
+                else:
+                    self._memory.move_to_end(key)
+                    self._stats['hits'] += 1
+                    self._stats['memory_hits'] += 1
+                    return content
+
+        content, stored = self._read_disk(key, now)
+        with self._lock:
+            if content is None:
+                self._stats['misses'] += 1
+                return None
+            self._stats['hits'] += 1
+            self._stats['disk_hits'] += 1
+            self._store_memory(key, stored, content)
+        return content
+
+    def put(self, query, url, content):
+        key = cache_key(query, url)
+        stored = time.time()
+        with self._lock:
+            self._store_memory(key, stored, content)
+        self._write_disk(key, content)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        for path, _, _ in self._disk_entries():
+            os.remove(path)
+        self._disk_bytes = 0
+
+    def _expired(self, stored, now):
+        return self.ttl is not None and now - stored > self.ttl
+
+    # Memory tier - caller holds the lock
+    def _store_memory(self, key, stored, content):
+        if len(content) > self.max_bytes:
+            return
+        if key in self._memory:
+            self._drop_memory(key)
+        self._memory[key] = (stored, content)
+        self._memory_bytes += len(content)
+        while len(self._memory) > self.max_entries or self._memory_bytes > self.max_bytes:
+            self._drop_memory(next(iter(self._memory)))
+            self._stats['evictions'] += 1
+
+    def _drop_memory(self, key):
+        _, content = self._memory.pop(key)
+        self._memory_bytes -= len(content)
+
+    # Disk tier - one file per entry, the file's mtime is the time it was stored
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _read_disk(self, key, now):
+        if not self.directory:
+            return None, None
+        path = self._path(key)
+        try:
+            stored = os.path.getmtime(path)
+            if self._expired(stored, now):
+                size = os.path.getsize(path)
+                os.remove(path)
+                with self._lock:
+                    self._disk_bytes -= size
+                    self._stats['expired'] += 1
+                return None, None
+            with open(path, 'rb') as f:
+                return f.read(), stored
+        except FileNotFoundError:
+            return None, None
+
+    def _write_disk(self, key, content):
+        if not self.directory or len(content) > self.disk_max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        try:
+            replaced = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp, path)
+        with self._lock:
+            self._disk_bytes += len(content) - replaced
+            over_budget = self._disk_bytes > self.disk_max_bytes
+        if over_budget:
+            self._evict_disk()
+
+    def _disk_entries(self):
+        if not self.directory:
+            return []
+        entries = []
+        for folder in os.listdir(self.directory):
+            folder = os.path.join(self.directory, folder)
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(folder, name)
+                try:
+                    info = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((path, info.st_mtime, info.st_size))
+        return entries
+
+    # Remove the oldest files until the store fits into disk_max_bytes
+    def _evict_disk(self):
+        entries = self._disk_entries()
+        total = sum(size for _, _, size in entries)
+        for path, _, size in sorted(entries, key=lambda entry: entry[1]):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            with self._lock:
+                self._stats['evictions'] += 1
+            total -= size
+        with self._lock:
+            self._disk_bytes = total
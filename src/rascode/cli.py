@@ -0,0 +1,199 @@
+# Command line
+# Runs a batch of queries from a JSON-lines file (or stdin), writes every result as soon
+# as it arrives and prints a throughput and latency summary, e.g. from a cron job:
+#
+# PYTHONPATH=src python -m rascode queries.jsonl --workers 16 --cache-dir .cache --output-dir results
+#
+# Each line of the batch is one query spec, either a DataCube method with its arguments
+#   {"name": "bremen_max", "method": "get_max", "args": [53.08, 8.80, "\"2014-01\":\"2014-12\""]}
+#   {"method": "get_3d_to_2d_subset", "coverage": "AvgLandTemp", "kwargs": {"ansi": "\"2014-07\""}}
+# or a raw WCPS query, as a JSON string or in a "query" field
+#   "for $c in (AvgLandTemp) return avg($c[Lat(53.08), Long(8.80), ansi(\"2014-01\":\"2014-12\")])"
+# Blank lines and lines starting with '#' are skipped. Specs without a name are named by
+# their line number
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import time
+import zipfile
+
+from .cache import QueryCache
+from .images import ImageResult, detect_image, write_file
+from .instrumentation import Instrumentation, MetricsSink
+from .main import DataCube, serverUrl
+from .netcdf import is_netcdf
+from .wdc import WebDataConnector
+
+logger = logging.getLogger(__name__)
+
+_UNSAFE = re.compile(r'[^\w.-]')
+
+def read_specs(lines, coverage='AvgLandTemp'):
+    """
+    Yields (name, query) for each spec in the lines of a batch, or (name, exception) for a
+    spec that could not be turned into a query.
+    """
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        name = str(number)
+        try:
+            spec = json.loads(line)
+            if isinstance(spec, str):
+                yield name, spec
+                continue
+            name = str(spec.get('name', name))
+            if 'query' in spec:
+                yield name, spec['query']
+                continue
+            method = spec['method']
+            if method.startswith('_') or not callable(getattr(DataCube, method, None)):
+                raise ValueError(f"DataCube has no query method {method!r}")
+            cube = DataCube(spec.get('coverage', coverage))
+            yield name, getattr(cube, method)(*spec.get('args', ()), **spec.get('kwargs', {}))
+        except Exception as e:
+            yield name, ValueError(f"Invalid spec on line {number}: {e!r}")
+
+def result_extension(raw):
+    content_type = detect_image(raw)
+    if content_type is not None:
+        return ImageResult(raw, content_type).extension
+    return 'nc' if is_netcdf(raw) else 'txt'
+
+class NpzSink:
+    """
+    Writes numeric results to an .npz archive, one array per query named after it, as
+    they arrive. np.load() reads the archive once it is closed.
+    """
+    def __init__(self, path):
+        import numpy as np
+        self._np = np
+        self._zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+
+    # Returns False for results that are not numeric (images, text)
+    def write(self, name, raw):
+        from .results import decode_result
+        if detect_image(raw) is not None:
+            return False
+        try:
+            value = self._np.asarray(decode_result(raw))
+        except ValueError:
+            return False
+        with self._zip.open(f"{name}.npy", 'w', force_zip64=True) as f:
+            self._np.lib.format.write_array(f, value, allow_pickle=False)
+        return True
+
+    def close(self):
+        self._zip.close()
+
+def summarize(metrics, elapsed, count, failed):
+    """
+    One-line summary of a batch from the snapshot of its MetricsSink.
+    """
+    latency = metrics['latency'].get('total', {})
+    counters = metrics['counters']
+    rate = count / elapsed if elapsed else 0.0
+    return (f"{count} queries ({failed} failed) in {elapsed:.2f} s: {rate:.1f} queries/s, "
+            f"latency p50 {latency.get('p50', 0) * 1000:.1f} ms, p90 {latency.get('p90', 0) * 1000:.1f} ms, "
+            f"p99 {latency.get('p99', 0) * 1000:.1f} ms, max {latency.get('max', 0) * 1000:.1f} ms, "
+            f"{counters['bytes']} bytes, {counters['cache_hits']} cache hits, {counters['retries']} retries")
+
+def run_batch(wdc, specs, max_workers=8, output_dir=None, npz=None, out=None):
+    """
+    Runs (name, query) specs through a DBO of wdc with up to max_workers queries at once.
+    Each result is written to output_dir/<name>.<ext> and to the NpzSink npz, if given, and
+    reported by a JSON line on out (stdout) that holds text results themselves when neither
+    is given. Returns the number of queries and of failures.
+    """
+    out = out or sys.stdout
+    dbo = wdc.createDBO(image_dir=None)
+    names = []
+    count = failed = 0
+
+    def report(name, error):
+        logger.error("Query %s failed: %s", name, error)
+        out.write(json.dumps({'name': name, 'error': str(error)}) + '\n')
+
+    def queries():
+        nonlocal count, failed
+        seen = set()
+        for name, query in specs:
+            if isinstance(query, Exception):
+                count += 1
+                failed += 1
+                report(name, query)
+                continue
+            name = _UNSAFE.sub('_', name)
+            # A repeated name would overwrite the output of the earlier query; the suffix
+            # is bumped until the name is not taken, by an explicit name either
+            if name in seen:
+                suffix = 2
+                while f"{name}_{suffix}" in seen:
+                    suffix += 1
+                name = f"{name}_{suffix}"
+            seen.add(name)
+            names.append(name)
+            yield query
+
+    for position, raw in dbo.fetch_completed(queries(), max_workers):
+        name = names[position]
+        count += 1
+        if isinstance(raw, Exception):
+            failed += 1
+            report(name, raw)
+            continue
+        line = {'name': name, 'bytes': len(raw)}
+        if output_dir is not None:
+            line['path'] = write_file(os.path.join(output_dir, f"{name}.{result_extension(raw)}"), raw)
+        if npz is not None:
+            line['npz'] = npz.write(name, raw)
+        if output_dir is None and npz is None:
+            line['result'] = raw.decode('utf-8', 'replace') if result_extension(raw) == 'txt' else None
+        out.write(json.dumps(line) + '\n')
+    return count, failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m rascode',
+                                     description="Run a batch of WCPS query specs (JSON lines) against a server")
+    parser.add_argument('batch', nargs='?', default='-', help="JSON-lines file of query specs, '-' for stdin")
+    parser.add_argument('--url', default=serverUrl, help="WCPS endpoint of the server")
+    parser.add_argument('--coverage', default='AvgLandTemp', help="coverage of specs that name none")
+    parser.add_argument('--workers', type=int, default=8, help="queries in flight at once")
+    parser.add_argument('--timeout', type=float, default=30, help="seconds per request")
+    parser.add_argument('--cache-dir', help="keep results in this directory between runs")
+    parser.add_argument('--no-cache', action='store_true', help="send repeated queries again")
+    parser.add_argument('--output-dir', help="write each result to <name>.<ext> in this directory")
+    parser.add_argument('--npz', help="write numeric results to this .npz archive")
+    parser.add_argument('--summary', help="also write the summary and metrics as JSON to this file")
+    args = parser.parse_args(argv)
+
+    cache = None if args.no_cache else QueryCache(directory=args.cache_dir)
+    metrics = MetricsSink()
+    wdc = WebDataConnector(args.url, cache=cache, instrumentation=Instrumentation(metrics),
+                           timeout=args.timeout, pool_maxsize=max(args.workers, 10))
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    npz = NpzSink(args.npz) if args.npz else None
+    batch = sys.stdin if args.batch == '-' else open(args.batch)
+    start = time.perf_counter()
+    try:
+        count, failed = run_batch(wdc, read_specs(batch, args.coverage), args.workers, args.output_dir, npz)
+    finally:
+        elapsed = time.perf_counter() - start
+        if npz is not None:
+            npz.close()
+        if batch is not sys.stdin:
+            batch.close()
+        wdc.close()
+
+    snapshot = metrics.snapshot()
+    print(summarize(snapshot, elapsed, count, failed), file=sys.stderr)
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump({'queries': count, 'failed': failed, 'elapsed_s': elapsed, **snapshot}, f, indent=2)
+    return 1 if failed else 0
@@ -0,0 +1,159 @@
+# Operation graphs
+# Named operations with dependencies. Independent branches run concurrently, each
+# operation starts as soon as the results it depends on are ready, and identical
+# queries are sent once per run
+
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .cache import normalize_query
+from .exceptions import DependencyError
+
+logger = logging.getLogger(__name__)
+
+class Node:
+    """
+    One operation of an OperationGraph.
+    - 'operation' is a WCPS query (text or a query.Query tree), or a callable taking the
+      results of 'after' in order and returning one.
+    - With local=True 'operation' is a callable computing the result itself from those
+      results, without a query to the server.
+    """
+    __slots__ = ('name', 'operation', 'after', 'local')
+
+    def __init__(self, name, operation, after=(), local=False):
+        self.name = name
+        self.operation = operation
+        self.after = tuple(after)
+        self.local = local
+
+    def __repr__(self):
+        return f"Node({self.name!r}, after={self.after!r}{', local' if self.local else ''})"
+
+def _text(query):
+    return query.compile() if hasattr(query, 'compile') else query
+
+class OperationGraph:
+    """
+    Named operations and the operations they depend on.
+    run() executes the graph with an execute(query, name) function, such as
+    DatabaseOperation._execute_query, and returns name -> result. A failed operation
+    holds its exception and the operations depending on it a DependencyError.
+    """
+    def __init__(self, nodes=()):
+        self.nodes = {}
+        for node in nodes:
+            self._add(node)
+
+    def add(self, name, operation, after=()):
+        return self._add(Node(name, operation, after))
+
+    # A local computation on the results of 'after', e.g. a threshold from an average
+    def add_step(self, name, func, after=()):
+        return self._add(Node(name, func, after, local=True))
+
+    def _add(self, node):
+        if node.name in self.nodes:
+            raise ValueError(f"Operation {node.name!r} is already in the graph")
+        self.nodes[node.name] = node
+        return node
+
+    def remove(self, name):
+        del self.nodes[name]
+
+    def clear(self):
+        self.nodes.clear()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, name):
+        return name in self.nodes
+
+    # Names in an order where every operation follows its dependencies
+    def order(self):
+        for node in self.nodes.values():
+            for dependency in node.after:
+                if dependency not in self.nodes:
+                    raise ValueError(f"Operation {node.name!r} depends on unknown {dependency!r}")
+        order, state = [], {}
+
+        def visit(name, path):
+            if state.get(name) == 'done':
+                return
+            if state.get(name) == 'visiting':
+                raise ValueError(f"Dependency cycle: {' -> '.join(map(repr, path + [name]))}")
+            state[name] = 'visiting'
+            for dependency in self.nodes[name].after:
+                visit(dependency, path + [name])
+            state[name] = 'done'
+            order.append(name)
+
+        for name in self.nodes:
+            visit(name, [])
+        return order
+
+    # Longest chain of dependent operations, i.e. the number of round trips run() needs
+    def depth(self):
+        depths = {}
+        for name in self.order():
+            depths[name] = 1 + max((depths[d] for d in self.nodes[name].after), default=0)
+        return max(depths.values(), default=0)
+
+    def run(self, execute, max_workers=8):
+        self.order()
+        waiting = {name: set(node.after) for name, node in self.nodes.items()}
+        dependents = {name: [] for name in self.nodes}
+        for name, node in self.nodes.items():
+            for dependency in set(node.after):
+                dependents[dependency].append(name)
+
+        results = {}
+        running = {}
+        # normalized query -> future, so identical queries are sent once per run
+        queries = {}
+
+        def start(executor, name):
+            node = self.nodes[name]
+            args = [results[d] for d in node.after]
+            for dependency, arg in zip(node.after, args):
+                if isinstance(arg, BaseException):
+                    results[name] = DependencyError(name, dependency, arg)
+                    return finished(executor, name)
+            try:
+                if node.local:
+                    results[name] = node.operation(*args)
+                    return finished(executor, name)
+                query = _text(node.operation(*args) if callable(node.operation) else node.operation)
+                key = normalize_query(query)
+            except Exception as e:
+                logger.error("Operation %r failed: %s", name, e)
+                results[name] = e
+                return finished(executor, name)
+
+            future = queries.get(key)
+            if future is None:
+                future = queries[key] = executor.submit(execute, query, name)
+            else:
+                logger.debug("Operation %r shares the query of another operation", name)
+            running.setdefault(future, []).append(name)
+
+        def finished(executor, name):
+            for dependent in dependents[name]:
+                waiting[dependent].discard(name)
+                if not waiting[dependent]:
+                    start(executor, dependent)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for name in [name for name, after in waiting.items() if not after]:
+                start(executor, name)
+            while running:
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    error = future.exception()
+                    for name in running.pop(future):
+                        if error is not None:
+                            logger.error("Operation %r failed: %s", name, error)
+                        results[name] = error if error is not None else future.result()
+                        finished(executor, name)
+        return {name: results[name] for name in self.nodes}
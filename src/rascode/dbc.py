@@ -2,22 +2,348 @@
 # Several datacubes can use a single DBC object
 # One DBC instance is created when a WDC is created
 
-import requests
+import copy
+import logging
+import os
+import threading
+import time
+from functools import cached_property
+
+from .exceptions import ServerError
+from .hedging import HedgePolicy
+from .limiter import AdaptiveLimiter, RetryPolicy, is_overload, retry_after
+
+logger = logging.getLogger(__name__)
+
+# A request shared by every caller asking for the same query while it is in flight
+class _InFlight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
 
 class DataBlockConnector:
     # Set URL to that specified by user
-    def __init__(self, url):
+    # pool_connections - number of hosts to keep a connection pool for
+    # pool_maxsize - number of keep-alive connections kept open per host
+    # timeout - (connect, read) timeout in seconds used for every query
+    # compress - ask the server for gzip/deflate (and br/zstd when their decoders are
+    # installed) compressed responses, which are decompressed transparently
+    # coalesce - identical queries sent while one is already in flight wait for that
+    # request and share its result or error instead of going to the server again
+    # limiter - AdaptiveLimiter lowering the number of requests in flight when the server
+    # answers 5xx/429, times out or slows down (True for one starting at pool_maxsize,
+    # None to disable)
+    # retry - RetryPolicy for 5xx/429 answers, timeouts and dropped connections
+    # (True for the default policy, None to disable)
+    # hedge - HedgePolicy sending a duplicate of slow small queries and using the first
+    # answer (True for the default policy, None to disable)
+    def __init__(self, url, pool_connections=10, pool_maxsize=10, timeout=(5, 60), session=None,
+                 compress=True, coalesce=True, limiter=True, retry=True, hedge=None):
         self.url = url
-    
-    def query(self, query):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.compress = compress
+        self.coalesce = coalesce
+        self._session = session
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self.limiter = AdaptiveLimiter(initial=pool_maxsize, max_limit=pool_maxsize) if limiter is True else limiter
+        self.retry = RetryPolicy() if retry is True else retry
+        self.hedge = HedgePolicy() if hedge is True else hedge
+        self._executor = None
+
+    # Headers sent with every query; urllib3 lists the encodings it can decode
+    @cached_property
+    def headers(self):
+        from urllib3.util.request import ACCEPT_ENCODING
+        return {'Accept-Encoding': ACCEPT_ENCODING if self.compress else 'identity'}
+
+    # The pooled session is created on first use and shared by every thread and
+    # DatabaseOperation using this connector, so TCP/TLS connections are reused
+    # requests is only imported at that point
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+
+                    session = requests.Session()
+                    # Hedges need connections beyond those of the requests they duplicate
+                    extra = 0 if self.hedge is None else self.hedge.burst
+                    adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                                          pool_maxsize=self.pool_maxsize + extra,
+                                          pool_block=True)
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    self._session = session
+        return self._session
+
+    # Threads running hedged queries, created on the first one
+    def _hedge_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    from concurrent.futures import ThreadPoolExecutor
+                    self._executor = ThreadPoolExecutor(max_workers=max(4 * self.pool_maxsize, 32),
+                                                        thread_name_prefix="hedge")
+        return self._executor
+
+    # Close all pooled connections; a new pool is created if the connector is used again
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # trace is an optional QueryTrace (see instrumentation.py) that receives the time
+    # spent waiting for the server and downloading, and the number of bytes received
+    # (as transferred, before decompression)
+    def query(self, query, trace=None):
+        if not self.coalesce:
+            return self._send(query, trace)
+
+        # The first caller of a query sends it, identical queries arriving meanwhile wait
+        with self._in_flight_lock:
+            call = self._in_flight.get(query)
+            leader = call is None
+            if leader:
+                call = self._in_flight[query] = _InFlight()
+        if not leader:
+            return self._join(call, trace)
+
+        try:
+            call.result = self._send(query, trace)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[query]
+            call.done.set()
+
+    @staticmethod
+    def _join(call, trace):
+        if trace is None:
+            call.done.wait()
+        else:
+            trace.shared = True
+            with trace.phase('wait'):
+                call.done.wait()
+        if call.error is not None:
+            # Each waiter raises its own copy, so tracebacks and notes added while one
+            # thread handles the error do not show up in the others
+            try:
+                error = copy.copy(call.error)
+            except Exception:
+                error = None
+            if error is None:
+                raise call.error
+            raise error from call.error
+        return call.result
+
+    # Errors of requests worth retrying besides the statuses of the RetryPolicy
+    @cached_property
+    def transient_errors(self):
+        from requests.exceptions import ConnectionError, Timeout
+        return (ConnectionError, Timeout)
+
+    # Runs send(), retrying retryable failures after a jittered backoff; every attempt goes
+    # through _limited unless limited=False leaves the limiter to the caller
+    def _call(self, send, trace, retry=True, limited=True):
+        attempt = 0
+        while True:
+            try:
+                return self._limited(send, trace) if limited else send()
+            except Exception as e:
+                attempt += 1
+                if not (retry and self._retryable(e)) or attempt >= self.retry.attempts:
+                    raise
+                delay = self.retry.delay(attempt - 1, getattr(e, 'retry_after', None))
+                logger.debug("Retrying query in %.2fs after: %s", delay, e)
+                if trace is None:
+                    time.sleep(delay)
+                else:
+                    trace.retries += 1
+                    with trace.phase('backoff'):
+                        time.sleep(delay)
+
+    # Errors of requests that signal overload besides the statuses of is_overload
+    @cached_property
+    def timeout_errors(self):
+        from requests.exceptions import Timeout
+        return (Timeout,)
+
+    def _retryable(self, error):
+        return self.retry is not None and self.retry.retryable(error, self.transient_errors)
+
+    # Runs send() in a slot of the limiter, if any; overload answers and timeouts tell the
+    # limiter to lower the number of requests in flight
+    def _limited(self, send, trace):
+        if self.limiter is None:
+            return send()
+        started = self._acquire(trace)
+        try:
+            result = send()
+        except BaseException as e:
+            self.limiter.release(started, ok=False, overloaded=is_overload(e, self.timeout_errors))
+            raise
+        self.limiter.release(started, ok=True)
+        return result
+
+    # Waits for a slot of the limiter; the time spent is the 'queue' phase
+    def _acquire(self, trace):
+        if trace is None:
+            return self.limiter.acquire()
+        with trace.phase('queue'):
+            return self.limiter.acquire()
+
+    def _send(self, query, trace):
+        if self.hedge is not None and self.hedge.applies(query):
+            return self._limited(lambda: self._send_hedged(query, trace), trace)
+        return self._call(lambda: self._post(query, trace), trace)
+
+    # Sends the query from a worker thread and, if it has not answered after the delay of
+    # the HedgePolicy and the budget allows, a duplicate; the first success is returned
+    # and the other request is left to finish on its own. Both share the caller's slot
+    # of the limiter. The trace receives the measurements of the request that answered
+    # and 'hedged' is set if a duplicate went out
+    def _send_hedged(self, query, trace):
+        from concurrent.futures import FIRST_COMPLETED, wait
+
+        def attempt():
+            attempt_trace = None if trace is None else type(trace)(query, trace.index)
+            start = time.perf_counter()
+            result = self._call(lambda: self._post(query, attempt_trace), attempt_trace, limited=False)
+            self.hedge.record(time.perf_counter() - start)
+            return result, attempt_trace
+
+        executor = self._hedge_executor()
+        pending = {executor.submit(attempt)}
+        delay = self.hedge.delay()
+        if delay is not None and not wait(pending, timeout=delay).done and self.hedge.acquire():
+            logger.debug("Hedging query after %.3fs", delay)
+            pending.add(executor.submit(attempt))
+            if trace is not None:
+                trace.hedged = True
+
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = error or future.exception()
+                    continue
+                result, attempt_trace = future.result()
+                if trace is not None:
+                    for name, seconds in attempt_trace.timings.items():
+                        trace.timings[name] = trace.timings.get(name, 0.0) + seconds
+                    trace.bytes += attempt_trace.bytes
+                    trace.retries += attempt_trace.retries
+                return result
+        raise error
+
+    def _post(self, query, trace):
         # Send query to the server
-        response = requests.post(self.url, params={'query': query})
-        
-        # Print HTTP request for debugging purposes
-        print("HTTP Request:", response.request.url)
-        
+        if trace is None:
+            response = self.session.post(self.url, params={'query': query}, timeout=self.timeout,
+                                         headers=self.headers)
+        else:
+            with trace.phase('wait'):
+                response = self.session.post(self.url, params={'query': query}, timeout=self.timeout,
+                                             headers=self.headers, stream=True)
+            with trace.phase('download'):
+                response.content
+            trace.bytes += response.raw.tell()
+
+        # Log HTTP request for debugging purposes
+        logger.debug("HTTP Request: %s", response.request.url)
+
         # If  successful, return response; if unsuccessful, display error message
         if response.status_code == 200:
             return response.content
         else:
-            raise Exception(f"Error: {response.status_code}, {response.text}")
\ No newline at end of file
+            raise self._error(response.status_code, response.text, response.headers)
+
+    # Send a WCS request such as DescribeCoverage with its key-value parameters and
+    # return the response body; failures are retried and raised like those of queries
+    def wcs_request(self, request, **params):
+        params = {'SERVICE': 'WCS', 'VERSION': '2.0.1', 'REQUEST': request, **params}
+        return self._call(lambda: self._get(params), None)
+
+    def _get(self, params):
+        response = self.session.get(self.url, params=params, timeout=self.timeout, headers=self.headers)
+        logger.debug("HTTP Request: %s", response.request.url)
+        if response.status_code != 200:
+            raise self._error(response.status_code, response.text, response.headers)
+        return response.content
+
+    @staticmethod
+    def _error(status, text, headers):
+        return ServerError(f"Error: {status}, {text}", status, retry_after(headers))
+
+    # Send query to the server and write the response in chunks to destination, which
+    # is a file path or a writable binary object - the response is never held in memory
+    # Returns the number of bytes written; trace is an optional QueryTrace as for query
+    # A path is written through a temporary file and only replaced once the whole response
+    # has arrived, so a failed query leaves no partial file behind
+    # Only queries written to a path are retried, as a writer may already hold part of the data
+    def query_to(self, query, destination, chunk_size=2**16, trace=None):
+        retry = isinstance(destination, (str, os.PathLike))
+        return self._call(lambda: self._stream_to(query, destination, chunk_size, trace), trace, retry)
+
+    def _stream_to(self, query, destination, chunk_size, trace):
+        if trace is None:
+            response = self.session.post(self.url, params={'query': query}, timeout=self.timeout,
+                                         headers=self.headers, stream=True)
+        else:
+            with trace.phase('wait'):
+                response = self.session.post(self.url, params={'query': query}, timeout=self.timeout,
+                                             headers=self.headers, stream=True)
+        with response:
+            logger.debug("HTTP Request: %s", response.request.url)
+            if response.status_code != 200:
+                raise self._error(response.status_code, response.text, response.headers)
+
+            if isinstance(destination, (str, os.PathLike)):
+                tmp = f"{os.fspath(destination)}.{threading.get_ident()}.tmp"
+                try:
+                    with open(tmp, 'wb') as f:
+                        written = self._copy(response, f, chunk_size, trace)
+                    os.replace(tmp, destination)
+                except BaseException:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                    raise
+            else:
+                written = self._copy(response, destination, chunk_size, trace)
+            if trace is not None:
+                trace.bytes += response.raw.tell()
+            return written
+
+    @staticmethod
+    def _copy(response, writer, chunk_size, trace=None):
+        if trace is not None:
+            with trace.phase('download'):
+                return DataBlockConnector._copy(response, writer, chunk_size)
+        written = 0
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            writer.write(chunk)
+            written += len(chunk)
+        return written
@@ -1,57 +1,387 @@
 # Datacube Object
 # Stores operations (queries) in the operations array
 
+import itertools
 import logging
-from PIL import Image
-import io
+import mmap
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, CancelledError, wait
+import threading
+
+from .batch import fold_point_queries
+from .dag import Node, OperationGraph
+from .images import ImageResult, ImageWriter, detect_image
+from .netcdf import is_netcdf
+
+logger = logging.getLogger(__name__)
 
 class DatabaseOperation:
-    def __init__(self, dbc):
+    # adbc is the optional AsyncDataBlockConnector used by the *_async methods
+    # cache is an optional QueryCache consulted before a query is sent to the server
+    # typed=True returns numeric results as QueryResult objects (NumPy value + raw bytes)
+    # instrumentation is an optional Instrumentation receiving a QueryTrace per query
+    # local is an optional LocalEvaluator answering queries derived from series fetched
+    # before (see local.py); every result is offered to it
+    # Image results are written unchanged to image_dir/output_image_{index}.{ext} by a
+    # background writer; with image_dir=None they are only kept in memory
+    # writer is an optional ImageWriter shared with other DBOs and closed by its owner;
+    # without one the DBO uses its own, stopped once the images of a run are written
+    def __init__(self, dbc, adbc=None, cache=None, typed=False, instrumentation=None, image_dir='.',
+                 local=None, writer=None):
         self.dbc = dbc
+        self.adbc = adbc
+        self.cache = cache
+        self.typed = typed
+        self.instrumentation = instrumentation
+        self.image_dir = image_dir
+        self.local = local
         self.operations = []
-        logging.basicConfig(level=logging.DEBUG)
+        self.graph = OperationGraph()
+        self._futures = []
+        self._cancelled = threading.Event()
+        self._writer = writer
+        self._owns_writer = writer is None
+        self._writer_lock = threading.Lock()
 
     def add_operation(self, operation):
         self.operations.append(operation)
-        print("Operation added...")
+        logger.debug("Operation added...")
 
     def pop_operation(self):
         self.operations.pop()
-        print("Operation popped...")
+        logger.debug("Operation popped...")
 
     def clear_operation(self):
         self.operations.clear()
-        print("Operations cleared...")
+        self.graph.clear()
+        logger.debug("Operations cleared...")
+
+    # Named operation for execute_graph - operation is a query, or a callable building the
+    # query from the results of the operations named in 'after' (in that order)
+    # Queued operations can be named in 'after' by their 1-based index
+    def add_node(self, name, operation, after=()):
+        self.graph.add(name, operation, after)
+        logger.debug("Operation %r added...", name)
+
+    # Named local computation for execute_graph on the results of the operations in 'after'
+    def add_step(self, name, func, after=()):
+        self.graph.add_step(name, func, after)
+        logger.debug("Step %r added...", name)
 
     def execute_operation(self, index):
-        logging.debug(f"Executing query {index}")
-        logging.debug(f"Query: {self.operations[index-1]}")
+        return self._execute_query(self.operations[index-1], index)
+
+    def _execute_query(self, query, index):
+        logger.debug("Executing query %s", index)
 
     # Perform the query
-        result = self.dbc.query(self.operations[index-1])
+        trace = self._start_trace(query, index)
+        if trace is None:
+            return self._process_result(index, self._query(query))
+        with self.instrumentation.record(trace):
+            result = self._query(query, trace)
+            with trace.phase('decode'):
+                return self._process_result(index, result)
+
+    # Returns a new QueryTrace, or None while instrumentation is off
+    def _start_trace(self, query, index=None):
+        if self.instrumentation is None:
+            return None
+        return self.instrumentation.start(query, index)
+
+    # Streaming version of execute_operation - the result is written in chunks to
+    # destination (a file path or a writable binary object) instead of being returned
+    # With mmap=True and a file path, a read-only memory map of the file is returned (to be
+    # decoded with e.g. netcdf_array without reading it), otherwise the number of bytes
+    # written; streamed results bypass the cache
+    # Failed queries are only retried when destination is a path (see DBC.query_to)
+    def execute_operation_to(self, index, destination, mmap=False, chunk_size=2**16):
+        logger.debug("Streaming query %s to %s", index, destination)
+        query = self.operations[index-1]
+        trace = self._start_trace(query, index)
+        if trace is None:
+            written = self.dbc.query_to(query, destination, chunk_size)
+        else:
+            with self.instrumentation.record(trace):
+                written = self.dbc.query_to(query, destination, chunk_size, trace)
+        if mmap:
+            return open_mmap(destination)
+        return written
+
+    async def execute_operation_async(self, index):
+        logger.debug("Executing query %s", index)
+
+        query = self.operations[index-1]
+        trace = self._start_trace(query, index)
+        if trace is None:
+            return self._process_result(index, await self._query_async(query))
+        with self.instrumentation.record(trace):
+            result = await self._query_async(query, trace)
+            with trace.phase('decode'):
+                return self._process_result(index, result)
+
+    # Send a query through the connector, answering it locally or from the cache when possible
+    def _query(self, query, trace=None):
+        result = self._local_get(query, trace)
+        if result is not None:
+            return result
+        if self.cache is None:
+            result = self.dbc.query(query, trace)
+        else:
+            result = self._cache_get(query, self.dbc.url, trace)
+            if result is None:
+                result = self.dbc.query(query, trace)
+                self.cache.put(query, self.dbc.url, result)
+        if self.local is not None:
+            self.local.learn(query, result)
+        return result
+
+    async def _query_async(self, query, trace=None):
+        result = self._local_get(query, trace)
+        if result is not None:
+            return result
+        if self.cache is None:
+            result = await self.adbc.query(query, trace)
+        else:
+            result = self._cache_get(query, self.adbc.url, trace)
+            if result is None:
+                result = await self.adbc.query(query, trace)
+                self.cache.put(query, self.adbc.url, result)
+        if self.local is not None:
+            self.local.learn(query, result)
+        return result
+
+    def _local_get(self, query, trace):
+        if self.local is None:
+            return None
+        if trace is None:
+            return self.local.evaluate(query)
+        with trace.phase('local'):
+            result = self.local.evaluate(query)
+        if result is not None:
+            trace.cache = 'local'
+        return result
+
+    def _cache_get(self, query, url, trace):
+        if trace is None:
+            return self.cache.get(query, url)
+        with trace.phase('cache'):
+            result = self.cache.get(query, url)
+        trace.cache = 'miss' if result is None else 'hit'
+        return result
+
+    # Raw query for fetch_all, traced without a decode phase
+    def _fetch(self, query):
+        trace = self._start_trace(query)
+        if trace is None:
+            return self._query(query)
+        with self.instrumentation.record(trace):
+            return self._query(query, trace)
+
+    def _fetch_isolated(self, query):
+        try:
+            return self._fetch(query)
+        except Exception as e:
+            return e
+
+    def _process_result(self, index, result):
+        # Images are recognised by their magic bytes, without a trial text decode
+        content_type = detect_image(result)
+        # GeoTIFF holds data values rather than a picture; typed DBOs decode it to NumPy
+        if content_type == 'image/tiff' and self.typed:
+            from .results import QueryResult
+            return QueryResult(result)
+        if content_type is not None:
+            return self._process_image(index, result, content_type)
+        # netCDF results are binary and always returned as NumPy-backed QueryResults
+        if is_netcdf(result):
+            from .results import QueryResult
+            return QueryResult(result)
+
+        if self.typed:
+            from .results import QueryResult
+            typed_result = QueryResult(result)
+            try:
+                typed_result.value
+                return typed_result
+            except ValueError:
+                pass
 
-    # Assuming result is a bytes object that might represent an image or text
+    # Assuming result is a bytes object that represents text
         try:
-            # Try to decode as text
             text_output = result.decode('utf-8')
-            logging.debug(f"Result: {text_output}")
-            print(f"Text Result: {text_output}")
+            logger.debug("Text result of query %s: %d characters", index, len(text_output))
             return text_output
         except UnicodeDecodeError:
-            # If decode fails, assume it's an image
-            try:
-                # Load the image from bytes
-                image = Image.open(io.BytesIO(result))
-                image.show()  # This will display the image if possible (works in GUI environments)
-
-                # Optionally, save the image to disk
-                image_path = f"output_image_{index}.png"
-                image.save(image_path)
-                logging.debug(f"Image saved to {image_path}")
-                print(f"Image Result: Saved to {image_path}")
-            except IOError:
-                logging.error("Failed to process image data")
-
-    def execute_all_operations(self):
-        for i in range(len(self.operations)):
-            self.execute_operation(i+1)
+            logger.error("Result of query %s is neither text nor a known image format", index)
+            return result
+
+    # The image is returned as an ImageResult right away, its file is written in the background
+    def _process_image(self, index, result, content_type):
+        image = ImageResult(result, content_type)
+        if self.image_dir is not None:
+            image.path = os.path.join(self.image_dir, f"output_image_{index}.{image.extension}")
+            image.future = self._image_writer().write(image.path, result)
+            logger.debug("Image result of query %s queued for %s", index, image.path)
+        return image
+
+    def _image_writer(self):
+        if self._writer is None:
+            with self._writer_lock:
+                if self._writer is None:
+                    self._writer = ImageWriter()
+        return self._writer
+
+    # Waits until every image result has been written to disk; the DBO's own writer
+    # thread is stopped as well
+    def flush_images(self):
+        if self._writer is None:
+            return
+        if self._owns_writer:
+            self._writer.close()
+        else:
+            self._writer.flush()
+
+    # Runs every queued operation and returns the results in queue order
+    # With max_workers > 1 the queries run concurrently on a bounded thread pool, otherwise
+    # one after another. In both modes a failed operation puts its exception in its slot
+    # instead of aborting the rest, and operations that had not started when cancel() was
+    # called hold a CancelledError
+    # With batch_points=True point queries on the same coverage are folded into
+    # requests of up to max_points points and their results split back per operation
+    # Image files are written while later queries run; they are all on disk on return
+    def execute_all_operations(self, max_workers=1, batch_points=False, max_points=100):
+        if batch_points:
+            results = self._execute_batches(self.operations, max_workers, max_points)
+        else:
+            jobs = [(query, i+1) for i, query in enumerate(self.operations)]
+            results = self._execute_many(jobs, max_workers)
+        self.flush_images()
+        return results
+
+    # Runs the queued operations (named 1, 2, ...) and the named operations, each as soon as
+    # the operations it depends on have finished, with up to max_workers queries at once
+    # Identical queries are sent once. Returns name -> result; a failed operation holds its
+    # exception and the operations depending on it a DependencyError
+    def execute_graph(self, max_workers=8):
+        queued = [Node(i + 1, query) for i, query in enumerate(self.operations)]
+        graph = OperationGraph(queued + list(self.graph.nodes.values()))
+        results = graph.run(self._execute_query, max_workers)
+        self.flush_images()
+        return results
+
+    # Runs a DataCube point method (e.g. cube.get_single_value or cube.get_avg) for
+    # every (lat, long, ansi) point in as few requests as possible
+    # Returns one result per point, in the order of points
+    def execute_points(self, method, points, max_workers=1, max_points=100):
+        queries = [method(*point) for point in points]
+        return self._execute_batches(queries, max_workers, max_points)
+
+    # A folded batch that fails is retried one point at a time, so that a single bad point
+    # only fails itself and the errors reported are those of the points' own queries
+    def _execute_batches(self, queries, max_workers, max_points):
+        batches = fold_point_queries(queries, max_points)
+        jobs = [(batch.query, batch.indices[0]+1) for batch in batches]
+        results = [None] * len(queries)
+        retry = []
+        for batch, output in zip(batches, self._execute_many(jobs, max_workers)):
+            if batch.batched and isinstance(output, Exception) and not isinstance(output, CancelledError):
+                logger.info("Batch of %d points failed (%s), sending them one at a time", len(batch.indices), output)
+                retry.extend(batch.indices)
+                continue
+            for i, value in zip(batch.indices, batch.split(output)):
+                results[i] = value
+        if retry:
+            jobs = [(queries[i], i+1) for i in retry]
+            for i, value in zip(retry, self._execute_many(jobs, max_workers)):
+                results[i] = value
+        return results
+
+    # Fetches the tiles of a TiledQuery (see DataCube.tiled) in parallel and returns the
+    # stitched array, or the combined aggregate for DataCube.tiled_aggregation
+    def execute_tiled(self, tiled, max_workers=8):
+        return tiled.combine(self.fetch_all(tiled.queries, max_workers))
+
+    # Sends the given queries (not the queued operations) in parallel and returns the raw
+    # result bytes in order; the first failing query raises, unless return_exceptions=True
+    # puts the exceptions in place of the failed results
+    def fetch_all(self, queries, max_workers=8, return_exceptions=False):
+        fetch = self._fetch_isolated if return_exceptions else self._fetch
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(fetch, queries))
+
+    # Sends queries from any iterable in parallel and yields (position, raw result) pairs as
+    # they complete, with the exception in place of a failed result
+    # At most 2 * max_workers queries are taken from the iterable ahead of their results,
+    # so a long stream of queries is never held in memory at once
+    def fetch_completed(self, queries, max_workers=8):
+        queries = enumerate(queries)
+        pending = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                for i, query in itertools.islice(queries, 2 * max_workers - len(pending)):
+                    pending[executor.submit(self._fetch_isolated, query)] = i
+                if not pending:
+                    return
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+
+    # Applies one query template to every coverage and (lat, long) location in parallel and
+    # returns a FanOutResult holding a (coverage, location, time) array (see fanout.py)
+    # template is a DataCube method name, WCPS text with $coverage, $lat and $long
+    # placeholders, or a callable; args and kwargs follow lat and long
+    def fan_out(self, template, coverages, locations, *args, max_workers=8, **kwargs):
+        from .fanout import FanOutResult, build_queries
+        queries = build_queries(template, coverages, locations, *args, **kwargs)
+        return FanOutResult.from_raw(coverages, locations, self.fetch_all(queries, max_workers, True))
+
+    # jobs is a list of (query, index) pairs, index names the operation in logs and output files
+    def _execute_many(self, jobs, max_workers):
+        self._cancelled.clear()
+        if max_workers <= 1:
+            return [self._execute_isolated(query, index) for query, index in jobs]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            self._futures = [executor.submit(self._execute_isolated, query, index)
+                             for query, index in jobs]
+            results = []
+            for future in self._futures:
+                try:
+                    results.append(future.result())
+                except CancelledError as e:
+                    results.append(e)
+        self._futures = []
+        return results
+
+    # asyncio version of execute_all_operations - every queued query is awaited on the
+    # running event loop, the ADBC semaphore limits how many are in flight at once
+    # Results are returned in queue order with exceptions in place of failed operations
+    async def execute_all_operations_async(self):
+        import asyncio
+        return await asyncio.gather(
+            *(self.execute_operation_async(i+1) for i in range(len(self.operations))),
+            return_exceptions=True)
+
+    # Cancel the operations of a running execute_all_operations that have not started yet
+    # (safe to call from another thread)
+    def cancel(self):
+        self._cancelled.set()
+        for future in self._futures:
+            future.cancel()
+
+    def _execute_isolated(self, query, index):
+        if self._cancelled.is_set():
+            return CancelledError(f"Operation {index} cancelled")
+        try:
+            return self._execute_query(query, index)
+        except Exception as e:
+            logger.error("Operation %s failed: %s", index, e)
+            return e
+
+# Memory-map a result file read-only, so large results can be used without loading them
+def open_mmap(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
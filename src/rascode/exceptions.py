@@ -1,7 +1,21 @@
 class ServerError(Exception):
     """Exception raised for errors in the interaction with the WCPS server."""
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class OverloadError(ServerError):
+    """Exception raised when too many requests are already waiting for the WCPS server."""
     pass
 
 class QueryError(Exception):
     """Exception raised for errors in the WCPS query formation."""
-    pass
\ No newline at end of file
+    pass
+
+class DependencyError(Exception):
+    """Exception standing in for the result of an operation whose dependency failed."""
+    def __init__(self, name, dependency, error):
+        super().__init__(f"Operation {name!r} skipped: {dependency!r} failed with {error!r}")
+        self.dependency = dependency
+        self.error = error
@@ -0,0 +1,131 @@
+# Multi-coverage fan-out
+# One query template applied to many coverages and locations, fetched in parallel and
+# collected into one (coverage, location, time) array for comparisons across variables
+
+import logging
+from string import Template
+
+import numpy as np
+
+from .main import DataCube
+from .results import decode_result
+
+logger = logging.getLogger(__name__)
+
+def build_queries(template, coverages, locations, *args, **kwargs):
+    """
+    Queries of a template for every coverage and (lat, long) location, coverage-major.
+    'template' is one of
+    - the name of a DataCube method taking (lat, long, ...), e.g. 'get_3d_to_1d_subset',
+      called with args and kwargs after lat and long;
+    - WCPS text with $coverage, $lat and $long placeholders and placeholders named by
+      kwargs (string.Template syntax); other $names such as $c are WCPS variables and are
+      left as they are, like the braces of WCPS structs;
+    - a callable (coverage, lat, long, *args, **kwargs) returning a query.
+    """
+    if callable(template):
+        build = template
+    elif template.isidentifier():
+        def build(coverage, lat, long, *args, **kwargs):
+            return getattr(DataCube(coverage), template)(lat, long, *args, **kwargs)
+    else:
+        text = Template(template)
+        def build(coverage, lat, long, **kwargs):
+            return text.safe_substitute(kwargs, coverage=coverage, lat=lat, long=long)
+    return [build(coverage, lat, long, *args, **kwargs) for coverage in coverages for lat, long in locations]
+
+def correlate(values):
+    """
+    Pearson correlation between the series of every pair of coverages at each location,
+    for values of shape (coverage, location, time). Returns (location, coverage, coverage).
+    Time steps missing (NaN) in either series of a pair are left out of that pair.
+    """
+    x = np.moveaxis(np.asarray(values, dtype=np.float64), 0, 1)
+    valid = ~np.isnan(x)
+    both = valid[:, :, None, :] & valid[:, None, :, :]
+    a = np.where(both, x[:, :, None, :], 0.0)
+    b = np.where(both, x[:, None, :, :], 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        n = both.sum(axis=-1)
+        a = np.where(both, a - a.sum(axis=-1, keepdims=True) / n[..., None], 0.0)
+        b = np.where(both, b - b.sum(axis=-1, keepdims=True) / n[..., None], 0.0)
+        return (a * b).sum(axis=-1) / np.sqrt((a * a).sum(axis=-1) * (b * b).sum(axis=-1))
+
+class FanOutResult:
+    """
+    Results of a fan-out.
+    - 'values' has shape (coverage, location, time), or (coverage, location) when every
+      query returned a single value. Series shorter than the longest are padded with NaN.
+    - 'errors' maps (coverage, location) to the exception of a failed query, whose
+      cells are NaN.
+    Series are aligned by position, so the queries should select the same dates.
+    """
+    def __init__(self, coverages, locations, values, errors):
+        self.coverages = list(coverages)
+        self.locations = list(locations)
+        self.values = values
+        self.errors = errors
+
+    def __repr__(self):
+        return (f"FanOutResult({len(self.coverages)} coverages, {len(self.locations)} locations, "
+                f"shape={self.values.shape}, errors={len(self.errors)})")
+
+    def series(self, coverage, location=0):
+        """
+        Values of one coverage (by name) at one location (by index or (lat, long)).
+        """
+        if not isinstance(location, int):
+            location = self.locations.index(tuple(location))
+        return self.values[self.coverages.index(coverage), location]
+
+    def correlation(self):
+        """
+        (location, coverage, coverage) correlations over time, see correlate.
+        """
+        return correlate(self._series())
+
+    def standardized(self):
+        """
+        Values as z-scores of each series, so variables in different units can be compared.
+        """
+        values = self._series()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (values - np.nanmean(values, axis=-1, keepdims=True)) / np.nanstd(values, axis=-1, keepdims=True)
+
+    def _series(self):
+        if self.values.ndim != 3:
+            raise ValueError("The fan-out returned single values, not series")
+        return self.values
+
+    @classmethod
+    def from_raw(cls, coverages, locations, results):
+        """
+        Builds the result from raw result bytes (or exceptions) ordered coverage-major.
+        """
+        coverages, locations = list(coverages), [tuple(location) for location in locations]
+        decoded, errors = [], {}
+        for i, raw in enumerate(results):
+            key = (coverages[i // len(locations)], locations[i % len(locations)])
+            if not isinstance(raw, BaseException):
+                try:
+                    decoded.append(np.asarray(decode_result(raw), dtype=np.float64))
+                    continue
+                except ValueError as e:
+                    raw = e
+            logger.error("Fan-out query for %s at %s failed: %s", key[0], key[1], raw)
+            errors[key] = raw
+            decoded.append(None)
+
+        shapes = [value.shape for value in decoded if value is not None]
+        if any(len(shape) > 1 for shape in shapes):
+            raise ValueError(f"Fan-out results must be single values or series, got shapes {set(shapes)}")
+        scalar = all(len(shape) == 0 for shape in shapes)
+        steps = max((shape[0] for shape in shapes if shape), default=1)
+        values = np.full((len(coverages), len(locations)) + (() if scalar else (steps,)), np.nan)
+        # One row per query, a view of values
+        rows = values.reshape(len(decoded), -1)
+        for row, value in zip(rows, decoded):
+            if value is not None:
+                value = np.atleast_1d(value)
+                row[:len(value)] = value
+        return cls(coverages, locations, values, errors)
@@ -0,0 +1,76 @@
+# Hedged requests
+# A query that takes longer than most recent ones is sent a second time and the first
+# answer is used, which cuts the latency tail of small queries at a bounded extra load
+
+import collections
+import re
+import threading
+
+# Encoded results (CSV, images, netCDF...) and image>>/diagram>> queries can be large
+_LARGE_RESULT = re.compile(r'\bencode\s*\(|^\s*\w+>>', re.IGNORECASE)
+
+def is_small_query(query):
+    """
+    True for queries returning a scalar (a single value, an aggregate or a struct of them),
+    i.e. queries that do not encode a coverage.
+    """
+    return _LARGE_RESULT.search(query) is None
+
+class HedgePolicy:
+    """
+    When to send a duplicate of a slow request.
+    - The duplicate is sent once a request has been running longer than the 'percentile'
+      of the last 'window' latencies, but never earlier than min_delay seconds and not
+      before min_samples latencies are known.
+    - 'budget' is the extra load allowed: each hedgeable query earns 'budget' tokens, each
+      duplicate costs one, and at most 'burst' tokens are saved up; 0.1 adds at most 10%.
+    - Only queries accepted by 'hedgeable' are hedged, by default those with small results.
+    WCPS queries only read, so sending one twice is always safe.
+    """
+    def __init__(self, percentile=95, window=256, min_samples=20, min_delay=0.005, budget=0.1,
+                 burst=10, hedgeable=is_small_query):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.budget = budget
+        self.burst = burst
+        self.hedgeable = hedgeable
+        self.sent = 0
+        self._latencies = collections.deque(maxlen=window)
+        self._threshold = None
+        self._stale = 0
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+
+    def applies(self, query):
+        return self.hedgeable(query)
+
+    # Seconds to wait for the first request before hedging, None while too few are known
+    # Each call also earns the query its share of the budget
+    def delay(self):
+        with self._lock:
+            self._tokens = min(self._tokens + self.budget, self.burst)
+            if len(self._latencies) < self.min_samples:
+                return None
+            # Sorting the window again only every few samples keeps record() cheap
+            if self._threshold is None or self._stale >= max(len(self._latencies) // 8, 1):
+                ordered = sorted(self._latencies)
+                rank = min(int(len(ordered) * self.percentile / 100), len(ordered) - 1)
+                self._threshold = ordered[rank]
+                self._stale = 0
+            return max(self._threshold, self.min_delay)
+
+    # Spends a token for a duplicate request; False when the budget is used up
+    def acquire(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            self.sent += 1
+            return True
+
+    # Latency of a request that answered
+    def record(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+            self._stale += 1
@@ -0,0 +1,130 @@
+# Image results
+# Image answers are recognised by their magic bytes, written to disk unchanged by a
+# background writer and only decoded (to NumPy) when asked for
+
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import cached_property
+
+logger = logging.getLogger(__name__)
+
+# Magic bytes -> (content type, file extension)
+IMAGE_FORMATS = {
+    b'\x89PNG\r\n\x1a\n': ('image/png', 'png'),
+    b'\xff\xd8\xff': ('image/jpeg', 'jpg'),
+    b'II*\x00': ('image/tiff', 'tif'),
+    b'MM\x00*': ('image/tiff', 'tif'),
+    b'GIF87a': ('image/gif', 'gif'),
+    b'GIF89a': ('image/gif', 'gif'),
+}
+_EXTENSIONS = dict(IMAGE_FORMATS.values())
+
+def detect_image(data, content_type=None):
+    """
+    Returns the content type of an image result, or None if data is not an image.
+    A content type given by the server is trusted; otherwise the magic bytes decide.
+    """
+    if content_type is not None:
+        content_type = content_type.split(';')[0].strip().lower()
+        return content_type if content_type in _EXTENSIONS else None
+    for magic, (kind, _) in IMAGE_FORMATS.items():
+        if data[:len(magic)] == magic:
+            return kind
+    return None
+
+def decode_image(data):
+    """
+    Decodes encoded image bytes to a (height, width[, bands]) array.
+    """
+    import numpy as np
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as image:
+        return np.asarray(image)
+
+class ImageResult:
+    """
+    Image returned by a query.
+    - 'raw' is the encoded bytes as sent by the server, 'content_type' their format.
+    - 'path' is the file the bytes are written to, if any; wait() blocks until it is written.
+    - 'array' is the decoded NumPy array, computed on first access.
+    """
+    def __init__(self, raw, content_type, path=None, future=None):
+        self.raw = raw
+        self.content_type = content_type
+        self.path = path
+        self.future = future
+
+    @property
+    def extension(self):
+        return _EXTENSIONS[self.content_type]
+
+    @cached_property
+    def array(self):
+        return decode_image(self.raw)
+
+    def __array__(self, dtype=None, copy=None):
+        import numpy as np
+        return np.asarray(self.array, dtype=dtype)
+
+    # Waits for the background write and raises the error it failed with, if any
+    def wait(self, timeout=None):
+        if self.future is not None:
+            self.future.result(timeout)
+        return self.path
+
+    def __repr__(self):
+        return f"ImageResult({self.content_type}, {len(self.raw)} bytes, path={self.path!r})"
+
+def write_file(path, data):
+    """
+    Writes data to path atomically (through a temporary file in the same directory).
+    """
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return path
+
+class ImageWriter:
+    """
+    Writes files on a background thread so queries are not held up by disk I/O.
+    write() returns a Future; flush() waits for every pending write. The thread is
+    started by the first write and stopped by close(); a later write starts it again.
+    """
+    def __init__(self, max_workers=1):
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = set()
+
+    def write(self, path, data):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix="image-writer")
+            future = self._executor.submit(write_file, path, data)
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Failed to write image: %s", future.exception())
+
+    # Waits for the pending writes; failures are logged and raised by the write's Future
+    def flush(self):
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending)
+
+    # Waits for the pending writes and stops the thread
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
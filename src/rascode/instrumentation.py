@@ -0,0 +1,193 @@
+# Instrumentation
+# Per-query traces (phase timings, bytes, cache hits, retries) are handed to pluggable
+# sinks. Nothing is measured while no sink is registered
+
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PHASES = ('local', 'cache', 'queue', 'wait', 'download', 'backoff', 'decode', 'total')
+
+class QueryTrace:
+    """
+    Measurements of one query.
+    - 'timings' maps phases to seconds: 'local' (LocalEvaluator), 'cache' (lookup), 'queue'
+      (waiting for a slot of the adaptive limiter), 'wait' (sending the request until the
+      response headers arrive, including connection setup), 'download' (reading the body),
+      'backoff' (sleeping before retries), 'decode' (turning the bytes into a result) and 'total'.
+    - 'bytes' is the size of the response bodies received from the server.
+    - 'cache' is 'hit', 'miss', 'local' when the LocalEvaluator answered, or None.
+    - 'retries' is the number of times the request was sent again.
+    - 'shared' is True when the query joined an identical request already in flight.
+    - 'hedged' is True when a duplicate of a slow request was sent (see hedging.py).
+    - 'error' is the exception the query failed with, if any.
+    """
+    __slots__ = ('query', 'index', 'timings', 'bytes', 'cache', 'retries', 'shared', 'hedged', 'error',
+                 'started')
+
+    def __init__(self, query, index=None):
+        self.query = query
+        self.index = index
+        self.timings = {}
+        self.bytes = 0
+        self.cache = None
+        self.retries = 0
+        self.shared = False
+        self.hedged = False
+        self.error = None
+        self.started = time.perf_counter()
+
+    # Times a phase; phases entered more than once (e.g. on retries) add up
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+    def to_dict(self):
+        return {'query': self.query, 'index': self.index, 'timings': dict(self.timings),
+                'bytes': self.bytes, 'cache': self.cache, 'retries': self.retries,
+                'shared': self.shared, 'hedged': self.hedged, 'error': None if self.error is None else repr(self.error)}
+
+class Instrumentation:
+    """
+    Collects a QueryTrace for every query and passes it to each sink when the query ends.
+    A sink is any callable taking the trace, e.g. a MetricsSink or a LogSink.
+    Without sinks start() returns None and the connectors skip all measurements.
+    """
+    def __init__(self, *sinks):
+        self.sinks = list(sinks)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def start(self, query, index=None):
+        if not self.sinks:
+            return None
+        return QueryTrace(query, index)
+
+    # Ends the trace when the block exits and records the exception it raised, if any
+    @contextmanager
+    def record(self, trace):
+        try:
+            yield trace
+        except BaseException as e:
+            trace.error = e
+            raise
+        finally:
+            self.finish(trace)
+
+    def finish(self, trace):
+        trace.timings['total'] = time.perf_counter() - trace.started
+        for sink in list(self.sinks):
+            try:
+                sink(trace)
+            except Exception:
+                logger.exception("Instrumentation sink %r failed", sink)
+
+class Histogram:
+    """
+    Latency histogram with logarithmic buckets from 'low' to 'high' seconds
+    (buckets_per_decade per factor of ten). Percentiles are accurate to one bucket.
+    """
+    def __init__(self, low=1e-6, high=100.0, buckets_per_decade=10):
+        bounds = []
+        bound = low
+        while bound < high:
+            bounds.append(bound)
+            bound *= 10 ** (1 / buckets_per_decade)
+        self.bounds = bounds + [high]
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    # Upper bound of the bucket holding the given percentile (0-100)
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'p50': self.percentile(50),
+                'p90': self.percentile(90), 'p99': self.percentile(99), 'max': self.max}
+
+class MetricsSink:
+    """
+    Aggregates traces into counters and one latency Histogram per phase.
+    snapshot() returns the current values as a dict.
+    """
+    def __init__(self, **histogram_options):
+        self._options = histogram_options
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {'queries': 0, 'errors': 0, 'bytes': 0, 'cache_hits': 0,
+                             'cache_misses': 0, 'local_hits': 0, 'retries': 0, 'shared': 0, 'hedged': 0}
+
+    def __call__(self, trace):
+        with self._lock:
+            counters = self.counters
+            counters['queries'] += 1
+            counters['errors'] += trace.error is not None
+            counters['bytes'] += trace.bytes
+            counters['cache_hits'] += trace.cache == 'hit'
+            counters['cache_misses'] += trace.cache == 'miss'
+            counters['local_hits'] += trace.cache == 'local'
+            counters['retries'] += trace.retries
+            counters['shared'] += trace.shared
+            counters['hedged'] += trace.hedged
+            for name, seconds in trace.timings.items():
+                if name not in self.histograms:
+                    self.histograms[name] = Histogram(**self._options)
+                self.histograms[name].add(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {'counters': dict(self.counters),
+                    'latency': {name: h.to_dict() for name, h in self.histograms.items()}}
+
+class LogSink:
+    """
+    Logs one line per query to the 'rascode.trace' logger (or the given logger).
+    """
+    def __init__(self, level=logging.INFO, log=None):
+        self.level = level
+        self.log = log or logging.getLogger('rascode.trace')
+
+    def __call__(self, trace):
+        if not self.log.isEnabledFor(self.level):
+            return
+        timings = ' '.join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in trace.timings.items())
+        self.log.log(self.level, "query %s: %s bytes=%d cache=%s retries=%d shared=%s hedged=%s%s",
+                     trace.index, timings, trace.bytes, trace.cache, trace.retries, trace.shared, trace.hedged,
+                     '' if trace.error is None else f" error={trace.error!r}")
@@ -0,0 +1,210 @@
+# Adaptive concurrency
+# AIMD limit on the number of requests in flight to one server with a bounded wait queue,
+# and a retry policy with jittered exponential backoff for retryable failures
+
+import collections
+import random
+import threading
+import time
+
+from .exceptions import OverloadError, ServerError
+
+# HTTP statuses worth sending the same query again for
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# HTTP statuses by which a server says, or shows, that it has too much load
+OVERLOAD_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+def is_overload(error, timeouts=()):
+    """
+    Whether a failed request should lower the concurrency limit: the server answered
+    with a status in OVERLOAD_STATUSES or the request hit one of the timeout errors
+    named by the connector. Other failures (e.g. a malformed query) leave it alone.
+    """
+    if isinstance(error, ServerError):
+        return error.status in OVERLOAD_STATUSES
+    return isinstance(error, timeouts)
+
+class AIMDController:
+    """
+    Concurrency limit adjusted from the latency and outcome of each request.
+    - Until the first sign of overload the limit grows by one per success (slow start,
+      doubling every round trip); afterwards by 1/limit (one per round trip).
+    - An overload (see is_overload), or a smoothed round-trip time above 'tolerance'
+      times the baseline, multiplies the limit by 'backoff'. Requests that started
+      before the last decrease are ignored, so one burst of failures only counts once.
+    - The smoothed round-trip time is an exponential average with weight 'smoothing'.
+      The baseline is the lowest latency seen, drifting up by 'drift' per sample so
+      that a server that stays slower becomes the new normal. tolerance=None ignores
+      latency.
+    """
+    def __init__(self, initial=4, min_limit=1, max_limit=64, backoff=0.5, tolerance=3.0,
+                 smoothing=0.125, drift=0.01):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.drift = drift
+        self.baseline = None
+        self.smoothed = None
+        self._slow_start = True
+        self._decreased = float('-inf')
+
+    # Number of requests allowed in flight
+    @property
+    def slots(self):
+        return max(int(self.limit), self.min_limit)
+
+    def on_success(self, started, latency):
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        else:
+            self.baseline *= 1 + self.drift
+        if self.smoothed is None:
+            self.smoothed = latency
+        else:
+            self.smoothed += self.smoothing * (latency - self.smoothed)
+        if self.tolerance is not None and self.smoothed > self.tolerance * self.baseline:
+            self.on_overload(started)
+            return
+        step = 1 if self._slow_start else 1 / self.limit
+        self.limit = min(self.limit + step, self.max_limit)
+
+    def on_overload(self, started):
+        if started < self._decreased:
+            return
+        self._slow_start = False
+        self.limit = max(self.limit * self.backoff, self.min_limit)
+        self._decreased = time.perf_counter()
+
+class AdaptiveLimiter:
+    """
+    Blocks callers while the requests in flight fill the slots of an AIMDController.
+    At most max_queue callers wait (None for no bound); further callers, and callers that
+    waited longer than queue_timeout seconds, get an OverloadError so they can back off.
+    Extra keyword arguments configure the controller.
+    """
+    def __init__(self, max_queue=None, queue_timeout=None, controller=None, **controller_options):
+        self.controller = controller or AIMDController(**controller_options)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    # Waits for a free slot and returns the start time to pass to release
+    def acquire(self):
+        with self._condition:
+            if self.in_flight >= self.controller.slots:
+                if self.max_queue is not None and self.waiting >= self.max_queue:
+                    raise OverloadError(f"{self.waiting} requests are already waiting for the server")
+                self.waiting += 1
+                try:
+                    if not self._condition.wait_for(lambda: self.in_flight < self.controller.slots,
+                                                    self.queue_timeout):
+                        raise OverloadError(f"No request slot became free within {self.queue_timeout}s")
+                finally:
+                    self.waiting -= 1
+            self.in_flight += 1
+        return time.perf_counter()
+
+    # ok - the request succeeded; overloaded - it failed in a way that signals overload
+    def release(self, started, ok, overloaded=False):
+        with self._condition:
+            self.in_flight -= 1
+            if overloaded:
+                self.controller.on_overload(started)
+            elif ok:
+                self.controller.on_success(started, time.perf_counter() - started)
+            # The limit may have grown by more than one slot
+            self._condition.notify_all()
+
+class AsyncAdaptiveLimiter:
+    """
+    asyncio version of AdaptiveLimiter, used by the event loop of one AsyncDataBlockConnector.
+    """
+    def __init__(self, max_queue=None, queue_timeout=None, controller=None, **controller_options):
+        self.controller = controller or AIMDController(**controller_options)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._waiters = collections.deque()
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    async def acquire(self):
+        import asyncio
+        while self.in_flight >= self.controller.slots:
+            if self.max_queue is not None and self.waiting >= self.max_queue:
+                raise OverloadError(f"{self.waiting} requests are already waiting for the server")
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, self.queue_timeout)
+            except asyncio.TimeoutError:
+                raise OverloadError(f"No request slot became free within {self.queue_timeout}s")
+            except asyncio.CancelledError:
+                # Pass on a slot this waiter was woken for
+                if waiter.done() and not waiter.cancelled():
+                    self._wake()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.in_flight += 1
+        return time.perf_counter()
+
+    def release(self, started, ok, overloaded=False):
+        self.in_flight -= 1
+        if overloaded:
+            self.controller.on_overload(started)
+        elif ok:
+            self.controller.on_success(started, time.perf_counter() - started)
+        self._wake()
+
+    def _wake(self):
+        free = self.controller.slots - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+class RetryPolicy:
+    """
+    Retries of failed requests, up to 'attempts' tries in total.
+    Server errors with a status in 'statuses' are retried, as are the transient errors
+    (timeouts, dropped connections) named by the connector.
+    Before retry n the caller sleeps a random time between 0 and min(cap, base * 2**n)
+    ("full jitter"), or the Retry-After time of the server when that is longer.
+    """
+    def __init__(self, attempts=3, base=0.1, cap=10.0, statuses=RETRY_STATUSES, seed=None):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.statuses = frozenset(statuses)
+        self._random = random.Random(seed)
+
+    def retryable(self, error, transient=()):
+        if isinstance(error, ServerError):
+            return error.status in self.statuses
+        return isinstance(error, transient)
+
+    # Seconds to wait before retry number 'retry' (0 for the first retry)
+    def delay(self, retry, retry_after=None):
+        delay = self._random.uniform(0, min(self.cap, self.base * 2 ** retry))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.cap))
+        return delay
+
+def retry_after(headers):
+    """
+    Seconds from a Retry-After header given in seconds, or None.
+    """
+    try:
+        return max(float(headers.get('Retry-After')), 0.0)
+    except (TypeError, ValueError):
+        return None
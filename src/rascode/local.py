@@ -0,0 +1,277 @@
+# Local evaluation
+# Queries derived from a time series at one location (single values, aggregates,
+# thresholds, unit conversions, differences between dates) are answered with NumPy
+# from series fetched before, instead of another request to the server
+
+import collections
+import re
+import threading
+from functools import lru_cache
+
+import numpy as np
+
+from .cache import normalize_query
+from .metadata import parse_bounds
+from .results import decode_result
+from .timeseries import add_steps, parse_date
+
+_NUMBER = r'-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?'
+_HEAD = re.compile(r'^(?:\w+>>)?\s*for\s*\$c\s*in\s*\(\s*(?P<coverage>[\w.-]+)\s*\)\s*'
+                   r'(?:let\s*\$v0\s*:=\s*(?P<let>\$c\[[^\[\]]*\]))?\s*return\s*(?P<body>.*)$', re.DOTALL)
+_ENCODE = re.compile(r'^encode\((?P<expr>.*),\s*["\'](?P<format>[\w/+.-]+)["\']\s*\)$', re.DOTALL)
+_SUBSET = r'\$c\[\s*Lat\((?P<lat{0}>[^()]+)\),\s*Long\((?P<long{0}>[^()]+)\),\s*ansi\((?P<ansi{0}>[^()]+)\)\s*\]'
+_SERIES = re.compile(rf'^{_SUBSET.format(0)}$')
+_MAP = re.compile(rf'^{_SUBSET.format(0)}\s*(?P<op>[-+*/])\s*(?P<number>{_NUMBER})$')
+_DIFFERENCE = re.compile(rf'^{_SUBSET.format(0)}\s*-\s*{_SUBSET.format(1)}$')
+_AGGREGATE = re.compile(rf'^(?P<func>min|max|avg|add)\(\s*{_SUBSET.format(0)}\s*\)$')
+_COUNT = re.compile(rf'^count\(\s*{_SUBSET.format(0)}\s*(?P<op>[<>]=?|!=|=)\s*'
+                    rf'(?:(?P<number>{_NUMBER})|{_SUBSET.format(1)})\s*\)$')
+_STRUCT = re.compile(r'^\{(?P<fields>[^{}]*)\}$')
+# DataCube.classify_data on a subset, as rendered by query.Switch with the let binding inlined
+_SWITCH = re.compile(rf'^switch\s*(?P<cases>(?:case\s*\$c\[[^\[\]]*\]\s*<\s*{_NUMBER}\s*return\s*\d+\s*)+)'
+                     r'default\s*return\s*(?P<default>\d+)$')
+_CASE = re.compile(rf'case\s*{_SUBSET.format(0)}\s*<\s*(?P<number>{_NUMBER})\s*return\s*(?P<label>\d+)')
+
+# Encodings a local result can be written in; others (netCDF, images) go to the server
+TEXT_FORMATS = {'text/csv', 'text/plain', 'application/json'}
+
+_COMPARE = {'>': np.greater, '<': np.less, '>=': np.greater_equal, '<=': np.less_equal,
+            '=': np.equal, '!=': np.not_equal}
+_ARITHMETIC = {'+': np.add, '-': np.subtract, '*': np.multiply, '/': np.divide}
+_REDUCE = {'min': np.min, 'max': np.max, 'avg': np.mean, 'add': np.sum}
+
+class _NotLocal(Exception):
+    pass
+
+def classify(values, thresholds):
+    """
+    Class labels of values as computed by DataCube.classify_data: the 1-based index of
+    the first threshold a value is below, or 0 when it is below none.
+    """
+    values = np.asarray(values)
+    labels = np.zeros(values.shape, dtype=np.int64)
+    for label in range(len(thresholds), 0, -1):
+        labels[values < thresholds[label - 1]] = label
+    return labels
+
+def _dates(ansi):
+    # (first, last, monthly) of an ansi subset; extract_seasonal_data writes 'YYYY-MM:MM'
+    bounds = parse_bounds(ansi)
+    if len(bounds) == 1 and ':' in bounds[0]:
+        bounds = bounds[0].split(':')
+    if not 1 <= len(bounds) <= 2 or '*' in bounds:
+        raise _NotLocal()
+    if len(bounds) == 2 and len(bounds[1]) == 2 and len(bounds[0]) == 7:
+        bounds[1] = f"{bounds[0][:4]}-{bounds[1]}"
+    try:
+        first, monthly = parse_date(bounds[0])
+        last, last_monthly = parse_date(bounds[-1])
+    except (ValueError, IndexError):
+        raise _NotLocal()
+    if monthly != last_monthly or last < first:
+        raise _NotLocal()
+    return first, last, monthly
+
+def _steps(first, last, monthly):
+    if monthly:
+        return (last.year - first.year) * 12 + last.month - first.month
+    return (last - first).days
+
+@lru_cache(maxsize=1024)
+def parse_local_query(query):
+    """
+    Splits a query into (coverage, expression, output format), or returns None if it is
+    not a query on $c. A let binding of $v0 is inlined.
+    """
+    match = _HEAD.match(normalize_query(query))
+    if match is None:
+        return None
+    body, let = match.group('body').strip(), match.group('let')
+    if let is not None:
+        body = body.replace('$v0[', let[:-1] + ',').replace('$v0', let)
+    encoded = _ENCODE.match(body)
+    if encoded is None:
+        return match.group('coverage'), body, 'text/plain'
+    return match.group('coverage'), encoded.group('expr').strip(), encoded.group('format')
+
+def _format(value, output_format):
+    # Text the server would return: a scalar, a struct in braces or values separated by commas
+    # Rounding to 15 digits hides the binary noise of sums such as 2.83 + 273.15, repr keeps
+    # the decimal point that marks floating-point results for decode_result
+    def text(v):
+        return str(int(v)) if isinstance(v, (int, np.integer)) else repr(float(format(float(v), '.15g')))
+    if isinstance(value, tuple):
+        return ('{' + ','.join(map(text, value)) + '}').encode()
+    if np.ndim(value) == 0:
+        return text(value).encode()
+    joined = ','.join(map(text, np.asarray(value).tolist()))
+    return (f"[{joined}]" if output_format == 'application/json' else joined).encode()
+
+class PointSeries:
+    """
+    Values of a coverage at one (Lat, Long) location for consecutive time steps
+    (months, or days) starting at 'start'.
+    """
+    __slots__ = ('start', 'monthly', 'values')
+
+    def __init__(self, start, monthly, values):
+        self.start = start
+        self.monthly = monthly
+        self.values = values
+
+    @property
+    def end(self):
+        return add_steps(self.start, len(self.values) - 1, self.monthly)
+
+    # Values from first to last, or None if the series does not cover them
+    def slice(self, first, last, monthly):
+        if monthly != self.monthly:
+            return None
+        begin = _steps(self.start, first, monthly)
+        stop = _steps(self.start, last, monthly) + 1
+        if begin < 0 or stop > len(self.values):
+            return None
+        return self.values[begin:stop]
+
+    # Joins an overlapping or adjacent series; False if there is a gap between them
+    def merge(self, other):
+        if other.monthly != self.monthly:
+            return False
+        if _steps(self.start, other.start, self.monthly) > len(self.values) \
+                or _steps(other.start, self.start, self.monthly) > len(other.values):
+            return False
+        start = min(self.start, other.start)
+        end = max(self.end, other.end)
+        values = np.empty(_steps(start, end, self.monthly) + 1, dtype=np.result_type(self.values, other.values))
+        for series in (self, other):
+            begin = _steps(start, series.start, self.monthly)
+            values[begin:begin + len(series.values)] = series.values
+        self.start, self.values = start, values
+        return True
+
+class LocalEvaluator:
+    """
+    Answers point queries from series held locally.
+    - learn() keeps the result of every series query ($c[Lat(x), Long(y), ansi(a:b)],
+      plain or encoded as CSV/JSON/netCDF); hold() adds a series directly.
+    - evaluate() returns the result bytes of a query computed from those series - the
+      series itself or a part of it, a value at one date, min/max/avg/add, counts above a
+      threshold, arithmetic with a constant (e.g. get_celsius_to_kelvin), differences
+      between dates, summary structs and classify switches - or None when the query
+      needs the server.
+    Results are computed in float64 from the values as received, so the last digits of
+    an average can differ from the server's. At most max_series locations are kept.
+    """
+    def __init__(self, max_series=1024):
+        self.max_series = max_series
+        self.hits = 0
+        self.misses = 0
+        self._series = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def hold(self, coverage, lat, long, start, values):
+        first, monthly = parse_date(start)
+        self._hold((coverage, float(lat), float(long)), PointSeries(first, monthly, np.asarray(values)))
+
+    def _hold(self, key, series):
+        with self._lock:
+            held = self._series.get(key)
+            if held is None or not held.merge(series):
+                self._series[key] = series
+            self._series.move_to_end(key)
+            while len(self._series) > self.max_series:
+                self._series.popitem(last=False)
+
+    # Values of a coverage at a location from first to last, or None if not held
+    def series(self, coverage, lat, long, first, last, monthly):
+        with self._lock:
+            held = self._series.get((coverage, float(lat), float(long)))
+            return None if held is None else held.slice(first, last, monthly)
+
+    # Keeps the result of a series query; returns True if it was kept
+    def learn(self, query, raw):
+        parsed = parse_local_query(query)
+        if parsed is None:
+            return False
+        coverage, expr, _ = parsed
+        match = _SERIES.match(expr)
+        if match is None:
+            return False
+        try:
+            first, last, monthly = _dates(match.group('ansi0'))
+            values = np.atleast_1d(decode_result(raw))
+        except (_NotLocal, ValueError):
+            return False
+        # A result of another length means the time steps are not what the dates suggest
+        if values.ndim != 1 or len(values) != _steps(first, last, monthly) + 1:
+            return False
+        self._hold((coverage, float(match.group('lat0')), float(match.group('long0'))),
+                   PointSeries(first, monthly, values))
+        return True
+
+    def evaluate(self, query):
+        parsed = parse_local_query(query)
+        if parsed is not None and parsed[2] in TEXT_FORMATS:
+            coverage, expr, output_format = parsed
+            try:
+                value = self._evaluate(coverage, expr)
+            except (_NotLocal, ValueError):
+                value = None
+            if value is not None:
+                self.hits += 1
+                return _format(value, output_format)
+        self.misses += 1
+        return None
+
+    def _subset(self, coverage, match, n=0):
+        first, last, monthly = _dates(match.group(f'ansi{n}'))
+        try:
+            values = self.series(coverage, match.group(f'lat{n}'), match.group(f'long{n}'), first, last, monthly)
+        except ValueError:
+            raise _NotLocal()
+        if values is None:
+            raise _NotLocal()
+        # A single date gives a value, a range a series
+        return values[0] if first == last else values
+
+    def _evaluate(self, coverage, expr):
+        match = _SERIES.match(expr)
+        if match:
+            return self._subset(coverage, match)
+        match = _MAP.match(expr)
+        if match:
+            return _ARITHMETIC[match.group('op')](self._subset(coverage, match), float(match.group('number')))
+        match = _DIFFERENCE.match(expr)
+        if match:
+            return np.subtract(self._subset(coverage, match), self._subset(coverage, match, 1))
+        match = _STRUCT.match(expr)
+        if match:
+            fields = [field.split(':', 1) for field in match.group('fields').split(';')]
+            if not all(len(field) == 2 for field in fields):
+                raise _NotLocal()
+            values = tuple(self._evaluate(coverage, value.strip()) for _, value in fields)
+            if any(np.ndim(value) for value in values):
+                raise _NotLocal()
+            return values
+        match = _SWITCH.match(expr)
+        if match:
+            cases = list(_CASE.finditer(match.group('cases')))
+            subsets = {(case.group('lat0'), case.group('long0'), case.group('ansi0')) for case in cases}
+            labels = [int(case.group('label')) for case in cases]
+            if len(subsets) != 1 or labels != list(range(1, len(cases) + 1)) or match.group('default') != '0':
+                raise _NotLocal()
+            return classify(self._subset(coverage, cases[0]), [float(case.group('number')) for case in cases])
+        return self._reduce(coverage, expr)
+
+    def _reduce(self, coverage, expr):
+        match = _AGGREGATE.match(expr)
+        if match:
+            return _REDUCE[match.group('func')](self._subset(coverage, match))
+        match = _COUNT.match(expr)
+        if match:
+            values = self._subset(coverage, match)
+            other = float(match.group('number')) if match.group('number') is not None \
+                else self._subset(coverage, match, 1)
+            with np.errstate(invalid='ignore'):
+                return int(np.count_nonzero(_COMPARE[match.group('op')](values, other)))
+        raise _NotLocal()
@@ -1,13 +1,64 @@
 # Main method file to test library
 
-from wdc import WebDataConnector
+from .wdc import WebDataConnector
+from .query import Query, Subset, BinOp, Call, Switch, Struct, Encode, Var, FORMATS
+from .exceptions import QueryError
+
+# Short names accepted wherever DataCube takes an output format
+ENCODINGS = {'csv': 'text/csv', 'json': 'application/json', 'netcdf': 'application/netcdf',
+             'geotiff': 'image/tiff', 'tiff': 'image/tiff', 'png': 'image/png'}
+
+# Query prefixes expected by the server for some encodings
+PREFIXES = {'image/png': 'image>>', 'text/csv': 'diagram>>'}
 
 class DataCube:
     """
     Provides an interface for constructing and executing dynamic WCPS queries tailored to specific data coverage.
+    Every query built here goes to the server when it is run. Subsets of a coverage that
+    are read again and again are better read with a ChunkStore (WebDataConnector.open_store),
+    which keeps the cells it fetched on disk and only requests chunks it does not hold yet.
     """
-    def __init__(self, coverage):
+    def __init__(self, coverage, metadata=None, snap=False, max_bytes=None):
+        """
+        - 'metadata' is the CoverageMetadata of the coverage (see WebDataConnector.describe_coverage);
+          when given, Lat/Long/ansi subsets are validated locally before a query is built.
+        - 'snap' moves Lat/Long slices to the centre of their grid cell.
+        - 'max_bytes' rejects queries whose estimated result is larger.
+        """
         self.coverage = coverage
+        self.metadata = metadata
+        self.snap = snap
+        self.max_bytes = max_bytes
+
+    def estimate_size(self, lat=None, long=None, ansi=None):
+        """
+        Estimates the result size in bytes of a Lat/Long/ansi subset, using the coverage metadata.
+        Axes left as None are counted in full.
+        """
+        return self.metadata.estimate_size(self._subsets(lat, long, ansi))
+
+    def _subsets(self, lat, long, ansi):
+        return {name: value for name, value in (("Lat", lat), ("Long", long), ("ansi", ansi))
+                if value is not None}
+
+    # Validates a subset against the coverage metadata (when available) and returns
+    # Lat and Long, snapped to the grid if requested
+    def _check(self, lat=None, long=None, ansi=None):
+        if self.metadata is None:
+            return lat, long
+        subsets = self._subsets(lat, long, ansi)
+        self.metadata.validate(subsets)
+        if self.max_bytes is not None:
+            size = self.metadata.estimate_size(subsets)
+            if size > self.max_bytes:
+                raise QueryError(f"Estimated result of {size} bytes exceeds max_bytes={self.max_bytes}; "
+                                 "use a smaller subset or DataCube.tiled")
+        if self.snap:
+            if lat is not None and ':' not in str(lat):
+                lat = self.metadata.axis("Lat").snap(lat)
+            if long is not None and ':' not in str(long):
+                long = self.metadata.axis("Long").snap(long)
+        return lat, long
 
     def most_basic_query(self):
         return f"""
@@ -16,41 +67,51 @@ class DataCube:
     
     # Returns a single value at specific point
     def get_single_value(self, lat, long, ansi):
+        lat, long = self._check(lat, long, ansi)
         return f"""
         for $c in ({self.coverage}) 
         return $c[Lat({lat}), Long({long}), ansi({ansi})]
         """
 
     # Transforms the 3d data into 1 dimensional data
-    def get_3d_to_1d_subset(self, lat, long, ansi):
+    # output_format can be a binary encoding such as "application/netcdf" or "json"
+    def get_3d_to_1d_subset(self, lat, long, ansi, output_format="text/csv"):
+        lat, long = self._check(lat, long, ansi)
+        prefix, output_format = self._encoding(output_format)
         return f"""
-        diagram>>for $c in ({self.coverage})
+        {prefix}for $c in ({self.coverage})
         return encode(
                     $c[Lat({lat}), Long({long}), ansi({ansi})]
-                , "text/csv")
+                , "{output_format}")
         """
 
     # Transforms the 3d data into 2 dimensional data
-    def get_3d_to_2d_subset(self, ansi):
+    # output_format "image/tiff" (GeoTIFF) or "application/netcdf" keeps the values unscaled
+    def get_3d_to_2d_subset(self, ansi, output_format="image/png"):
+        self._check(ansi=ansi)
+        prefix, output_format = self._encoding(output_format)
         return f"""
-        image>>for $c in ({self.coverage})
+        {prefix}for $c in ({self.coverage})
         return encode(
                     $c[ansi({ansi})]
-                , "image/png")
+                , "{output_format}")
         """
 
     # Converts celsius data to kelvin
-    def get_celsius_to_kelvin(self, lat, long, ansi):
+    def get_celsius_to_kelvin(self, lat, long, ansi, output_format="text/csv"):
+        lat, long = self._check(lat, long, ansi)
+        prefix, output_format = self._encoding(output_format)
         return f"""
-        diagram>>for $c in ({self.coverage}) 
+        {prefix}for $c in ({self.coverage}) 
         return encode(
                         $c[Lat({lat}), Long({long}), ansi({ansi})] 
                         + 273.15
-                , "text/csv")
+                , "{output_format}")
         """
 
     # Gets the minimum out of the data
     def get_min(self, lat, long, ansi):
+        lat, long = self._check(lat, long, ansi)
         return f"""
         for $c in ({self.coverage}) 
         return 
@@ -59,6 +120,7 @@ class DataCube:
 
     # Gets the maximum out of the data
     def get_max(self, lat, long, ansi):
+        lat, long = self._check(lat, long, ansi)
         return f"""
         for $c in ({self.coverage}) 
         return 
@@ -67,6 +129,7 @@ class DataCube:
 
     # Gets the average of the data
     def get_avg(self, lat, long, ansi):
+        lat, long = self._check(lat, long, ansi)
         return f"""
         for $c in ({self.coverage}) 
         return 
@@ -75,6 +138,7 @@ class DataCube:
 
     # Finds out when the temperature is more than 15 
     def get_when_temp_more_than_15(self, lat, long, ansi):
+        lat, long = self._check(lat, long, ansi)
         return f"""
         for $c in ({self.coverage})
         return count(
@@ -82,23 +146,28 @@ class DataCube:
             > 15)
         """
 
+    # Gets several statistics in a single request instead of one request per statistic
+    # - aggregates: any of "min", "max", "avg", "add" and "count" (number of values)
+    # - thresholds: counts the values above each threshold, like get_when_temp_more_than_15
+    # - group_by: "month", "season", "year" or a dict of label -> (start, end) date ranges
+    # The returned query is used like any other; query.parse(result) gives a record
+    # (or a dict of label -> record when grouped)
+    def get_summary(self, lat, long, ansi, aggregates=("min", "max", "avg", "count"), thresholds=(15,), group_by=None):
+        lat, long = self._check(lat, long, ansi)
+        from .summary import summary_query
+        return summary_query(self.coverage, lat, long, ansi, aggregates, thresholds, group_by)
+
     # Change the colors of an image, essentially creating a heat map out of an image
+    # The subset is computed once in a let binding and shared by every case
     def get_on_the_fly_coloring(self, lat, long, ansi):
-        return f"""
-        image>>for $c in ({self.coverage}) 
-        return encode(
-            switch 
-                    case $c[ansi("{ansi}"), Lat({lat}), Long({long})] = 99999 
-                        return {{red: 255; green: 255; blue: 255}} 
-                    case 18 > $c[ansi("{ansi}"), Lat({lat}), Long({long})] 
-                        return {{red: 0; green: 0; blue: 255}} 
-                    case 23 > $c[ansi("{ansi}"), Lat({lat}), Long({long})] 
-                        return {{red: 255; green: 255; blue: 0}} 
-                    case 30 > $c[ansi("{ansi}"), Lat({lat}), Long({long})]  
-                        return {{red: 255; green: 140; blue: 0}} 
-                    default return {{red: 255; green: 0; blue: 0}}
-                , "image/png")
-        """
+        lat, long = self._check(lat, long, ansi)
+        subset = Subset("$c", ("ansi", f'"{ansi}"'), ("Lat", lat), ("Long", long))
+        coloring = Switch([(subset.eq(99999), Struct(red=255, green=255, blue=255)),
+                           (BinOp(">", 18, subset), Struct(red=0, green=0, blue=255)),
+                           (BinOp(">", 23, subset), Struct(red=255, green=255, blue=0)),
+                           (BinOp(">", 30, subset), Struct(red=255, green=140, blue=0))],
+                          Struct(red=255, green=0, blue=0))
+        return Query(self.coverage, Encode(coloring, "image/png"), "image>>").compile()
 
     # Constructs a gradient-looking image, to represent the coverage
     def get_coverage_consturctor(self):
@@ -118,26 +187,34 @@ class DataCube:
         Dynamically constructs a WCPS query from specified parameters.
         - 'select' defines what to select in the query.
         - 'conditions' adds conditions to the query.
-        - 'return_format' specifies the output format of the result.
+        - 'return_format' specifies the output format of the result, a MIME type or a short
+          name from ENCODINGS; binary encodings ('netcdf', 'geotiff') and 'json' are decoded
+          straight to NumPy by results.decode_result.
         """
         query = f"for $c in ({self.coverage})"
         if conditions:
             query += f" where {conditions}"
+        prefix = ""
         if return_format:
+            prefix, return_format = self._encoding(return_format)
             select = f"encode({select}, '{return_format}')"
         query += f" return {select}"
+        return prefix + query
 
-        match return_format:
-            case "image/png":
-                query = f"image>>" + query
-            case "text/csv":
-                query =f"diagram>>" + query
-        return query
+    # Returns the query prefix and MIME type of an output format given by MIME type or short name
+    # Short names must be known; MIME types the library does not know (e.g. image/gif or
+    # server-specific ones) are passed to the server as they are, their results stay raw
+    def _encoding(self, output_format):
+        output_format = ENCODINGS.get(output_format, output_format)
+        if output_format not in FORMATS and '/' not in output_format:
+            raise QueryError(f"Unknown output format '{output_format}'")
+        return PREFIXES.get(output_format, ""), output_format
 
     def retrieve_temperature_data(self, lat, long, date_range, output_format="text/csv"):
         """
         Retrieves temperature data over a specified date range at given coordinates.
         """
+        lat, long = self._check(lat, long, date_range)
         select = f"$c[Lat({lat}), Long({long}), ansi('{date_range}')]"
         return self.generate_query(select, return_format=output_format)
 
@@ -145,6 +222,7 @@ class DataCube:
         """
         Calculates aggregate values such as min, max, or avg temperature over a specified date range at given coordinates.
         """
+        lat, long = self._check(lat, long, date_range)
         select = f"avg($c[Lat({lat}), Long({long}), ansi('{date_range}')])"
         return self.generate_query(select, return_format=None)
 
@@ -152,9 +230,12 @@ class DataCube:
         """
         Visualizes temperature data across a latitude and longitude range using a color scale.
         """
-        conditions = f"Lat({lat_range}), Long({long_range}), ansi('{date}')"
-        select = f"switch case $c > {color_scale['high']} then {{red: 255; green: 0; blue: 0}} case $c < {color_scale['low']} then {{red: 0; green: 0; blue: 255}} default {{red: 255; green: 255; blue: 0}}"
-        return self.generate_query(select, conditions = date , return_format="image/png")
+        self._check(lat_range, long_range, date)
+        subset = Subset("$c", ("Lat", lat_range), ("Long", long_range), ("ansi", f"'{date}'"))
+        coloring = Switch([(subset > color_scale['high'], Struct(red=255, green=0, blue=0)),
+                           (subset < color_scale['low'], Struct(red=0, green=0, blue=255))],
+                          Struct(red=255, green=255, blue=0))
+        return Query(self.coverage, Encode(coloring, "image/png"), "image>>").compile()
 
     def advanced_query_capabilities(self, lat, long, criteria, processing_steps):
         """
@@ -164,12 +245,13 @@ class DataCube:
         full_query = " and ".join(query_parts)
         return self.generate_query(full_query, conditions=criteria)
     
-    def get_data_series(self, lat, long, start_date, end_date, freq):
+    def get_data_series(self, lat, long, start_date, end_date, freq, output_format="text/csv"):
         """
         Retrieves a series of data based on frequency over a given date range at specific coordinates.
         """
+        lat, long = self._check(lat, long, f'"{start_date}":"{end_date}"')
         select = f"$c[Lat({lat}), Long({long}), ansi('{start_date}:{end_date}:{freq}')]"
-        return self.generate_query(select, return_format="text/csv")
+        return self.generate_query(select, return_format=output_format)
 
     def apply_threshold_filter(self, threshold, above=True):
         """
@@ -191,6 +273,10 @@ class DataCube:
             'winter': f'12:{year}-02:{int(year)+1}'
         }
         date_range = season_months.get(season, '01:12')
+        # Validated on the months the season spans, winter ending in February of the next year
+        start, end = (f'"{year}-12"', f'"{int(year)+1}-02"') if season == 'winter' else \
+            (f'"{year}-{date_range[:2]}"', f'"{year}-{date_range[-2:]}"')
+        lat, long = self._check(lat, long, f"{start}:{end}")
         select = f"$c[Lat({lat}), Long({long}), ansi('{year}-{date_range}')]"
         return self.generate_query(select, return_format=output_format)
 
@@ -198,23 +284,73 @@ class DataCube:
         """
         Performs spatial aggregation over a specified area and date.
         """
+        self._check(lat_range, long_range, date)
         select = f"{aggregate_func}($c[Lat({lat_range}), Long({long_range}), ansi('{date}')])"
         return self.generate_query(select, return_format="text/plain")
 
+    def tiled(self, method, lat_range, long_range, *args, tile_size=10, resolution=None):
+        """
+        Splits a query over a Lat/Long extent into disjoint tiles of at most tile_size
+        degrees, on the grid of the coverage metadata or of the given resolution.
+        - 'method' is a DataCube method taking the Lat and Long ranges first,
+          such as get_on_the_fly_coloring or visualize_temperature.
+        - 'args' are passed to the method after the ranges.
+        The returned TiledQuery is run with DatabaseOperation.execute_tiled.
+        """
+        from .tiling import TiledQuery, split_extent
+        lat_tiles = split_extent(lat_range, tile_size, resolution, self._grid_axis("Lat"))
+        long_tiles = split_extent(long_range, tile_size, resolution, self._grid_axis("Long"))
+        queries = [method(lat, long, *args) for lat in lat_tiles for long in long_tiles]
+        return TiledQuery(queries, (len(lat_tiles), len(long_tiles)))
+
+    # Axis of the coverage metadata for tiling on its grid, None without metadata
+    def _grid_axis(self, name):
+        return None if self.metadata is None else self.metadata.axis(name)
+
+    def tiled_aggregation(self, lat_range, long_range, date, aggregate_func="avg", tile_size=10, resolution=None):
+        """
+        Tiled version of spatial_aggregation for min, max, count, add and avg.
+        Each tile returns a partial aggregate (a sum and cell count for avg),
+        which DatabaseOperation.execute_tiled combines into the overall value.
+        """
+        from .tiling import TiledQuery, split_extent
+        lat_tiles = split_extent(lat_range, tile_size, resolution, self._grid_axis("Lat"))
+        long_tiles = split_extent(long_range, tile_size, resolution, self._grid_axis("Long"))
+        queries = []
+        for lat in lat_tiles:
+            for long in long_tiles:
+                subset = Subset("$c", ("Lat", lat), ("Long", long), ("ansi", f"'{date}'"))
+                if aggregate_func == "avg":
+                    select = Struct(total=Call("add", subset), cells=Call("count", subset.eq(subset)))
+                else:
+                    select = Call(aggregate_func, subset)
+                queries.append(Query(self.coverage, select).compile())
+        return TiledQuery(queries, (len(lat_tiles), len(long_tiles)), aggregate_func)
+
     def difference_between_dates(self, lat, long, date1, date2):
         """
         Calculates the difference in data values between two dates at a specific location.
         """
-        select = f"$c[Lat({lat}), Long({long}), ansi('{date1}')]" + " - " + f"$c[Lat({lat}), Long({long}), ansi('{date2}')]"
-        return self.generate_query(select, return_format="text/plain")
+        self._check(lat, long, date1)
+        lat, long = self._check(lat, long, date2)
+        point = Subset("$c", ("Lat", lat), ("Long", long))
+        difference = Subset(point, ("ansi", f"'{date1}'")) - Subset(point, ("ansi", f"'{date2}'"))
+        return Query(self.coverage, Encode(difference, "text/plain")).compile()
 
-    def classify_data(self, thresholds):
-        """
-        Classifies data into categories based on provided thresholds and returns the class labels.
-        """
-        cases = " ".join([f"case $c < {th} then '{idx+1}'" for idx, th in enumerate(thresholds)])
-        select = f"switch {cases} default '0'"
-        return self.generate_query(select, return_format="text/plain")
+    def classify_data(self, thresholds, lat=None, long=None, ansi=None):
+        """
+        Classifies data into categories based on provided thresholds and returns the class labels:
+        the 1-based index of the first threshold a value is below, or 0 when it is below none.
+        - 'lat', 'long' and 'ansi' classify a subset instead of the whole coverage.
+        """
+        target = Var("$c")
+        if lat is not None or long is not None or ansi is not None:
+            lat, long = self._check(lat, long, ansi)
+            axes = [(name, value) for name, value in (("Lat", lat), ("Long", long), ("ansi", ansi))
+                    if value is not None]
+            target = Subset("$c", *axes)
+        cases = [(target < threshold, index + 1) for index, threshold in enumerate(thresholds)]
+        return Query(self.coverage, Encode(Switch(cases, 0), "text/plain")).compile()
 
     def correlation_between_variables(self, variable1, variable2, lat_range, long_range, date_range):
         """
@@ -225,17 +361,14 @@ class DataCube:
         return self.generate_query(select, conditions, "text/plain")
 
 serverUrl = "https://ows.rasdaman.org/rasdaman/ows"
-    
-# Initialize library object and one DataCube
-wdc_instance = WebDataConnector(serverUrl)
-dbo = wdc_instance.createDBO()
-cube = DataCube("AvgLandTemp")
-
 
-
-# Example of using the DataCube class
+# Example of using the DataCube class (python -m rascode.main with src on PYTHONPATH)
+# Nothing is created at import time; the connector, DBO and DataCube only exist here
 if __name__ == "__main__":
-    
+    wdc_instance = WebDataConnector(serverUrl)
+    dbo = wdc_instance.createDBO()
+    cube = DataCube("AvgLandTemp")
+
     dbo.add_operation(cube.get_max(53.08, 8.80, '"2014-01":"2014-12"'))
     dbo.add_operation(cube.calculate_aggregate_temperature(53.08, 8.80, '"2014-01":"2014-12"'))
     dbo.add_operation(cube.get_when_temp_more_than_15(53.08, 8.80, '"2014-01":"2014-12"'))
@@ -246,9 +379,11 @@ if __name__ == "__main__":
     dbo.add_operation(cube.get_3d_to_2d_subset("2014-07"))
     dbo.add_operation(cube.get_on_the_fly_coloring('35:75', '-20:40', "2014-07"))
     dbo.add_operation(cube.get_coverage_consturctor())
-    dbo.execute_all_operations()
+    for result in dbo.execute_all_operations():
+        print(result)
 
     dbo.clear_operation()
 
+    wdc_instance.close()
     print("Success.")
 
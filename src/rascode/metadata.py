@@ -0,0 +1,259 @@
+# Coverage metadata
+# Describes the axes, extents, resolution and CRS of coverages (from WCS DescribeCoverage)
+# so that subsets can be validated, snapped to the grid and sized before a query is sent
+
+import json
+import math
+import os
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+from .exceptions import QueryError
+
+_TOKEN = re.compile(r'"[^"]*"|\S+')
+_BOUND = re.compile(r'"[^"]*"|\'[^\']*\'|[^:]+')
+
+def parse_bounds(value):
+    """
+    Splits a subset such as 53.08, '35:75' or '"2014-01":"2014-12"' into its bounds
+    (one for a slice, two for a trim), without quotes.
+    """
+    bounds = [bound.strip().strip('"\'') for bound in _BOUND.findall(str(value))]
+    return [bound for bound in bounds if bound]
+
+def _to_time(value):
+    value = value.strip('"\'').rstrip('Z')
+    value = value + '-01' if len(value) == 7 else value
+    return datetime.fromisoformat(value[:26])
+
+class Axis:
+    """
+    One axis of a coverage.
+    - 'lower', 'upper' are the extent (floats, or ISO strings for time axes).
+    - 'size' is the number of grid cells, 'resolution' the cell size of regular numeric axes.
+    - 'coefficients' are the cell positions of irregular axes (e.g. the dates of ansi).
+    """
+    def __init__(self, name, lower, upper, size, resolution=None, coefficients=None):
+        self.name = name
+        self.lower = lower
+        self.upper = upper
+        self.size = size
+        self.resolution = resolution
+        self.coefficients = coefficients
+
+    @property
+    def temporal(self):
+        return isinstance(self.lower, str)
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    # Checks that the bounds of a subset lie within the extent of the axis
+    def validate(self, bounds):
+        try:
+            if len(bounds) > 1 and '*' not in bounds and self._order(bounds[0]) > self._order(bounds[1]):
+                raise QueryError(f"Subset {self.name}({':'.join(bounds)}) has its bounds reversed")
+            for bound in bounds:
+                if bound != '*' and not self._within(bound, self.lower, self.upper):
+                    raise QueryError(f"{self.name}({bound}) is outside of the coverage extent "
+                                     f"{self.lower}:{self.upper}")
+        except ValueError:
+            raise QueryError(f"Invalid subset {self.name}({':'.join(bounds)})")
+
+    def _order(self, value):
+        return str(value) if self.temporal else float(value)
+
+    # Dates are compared at the coarser precision of the two, so '2014-07' lies within a
+    # coverage starting at '2014-07-01T00:00:00.000Z' and '2014-12-01T00:00:00.000Z'
+    # within one ending at '2014-12'
+    @staticmethod
+    def _within(value, low, high):
+        if isinstance(low, str):
+            value = str(value)
+            return low[:len(value)] <= value[:len(low)] and value[:len(high)] <= high[:len(value)]
+        return float(low) <= float(value) <= float(high)
+
+    # Returns the centre of the grid cell containing value
+    def snap(self, value):
+        if self.temporal or not self.resolution:
+            return value
+        index = min(max(math.floor((float(value) - self.lower) / self.resolution), 0), self.size - 1)
+        return round(self.lower + (index + 0.5) * self.resolution, 10)
+
+    # Returns the first and last grid index covered by the bounds of a subset: the cell
+    # containing a slice, or the cells whose centre (or date, on irregular axes) lies
+    # within a trim. Indices count from the lower end of the extent
+    def indices(self, bounds):
+        low, high = bounds[0], bounds[-1]
+        if self.coefficients:
+            inside = [i for i, c in enumerate(self.coefficients)
+                      if (low == '*' or c[:len(low)] >= low) and (high == '*' or c[:len(high)] <= high)]
+            if not inside:
+                raise QueryError(f"Subset {self.name}({low}:{high}) selects no cells")
+            return inside[0], inside[-1]
+        if self.temporal or not self.resolution:
+            raise QueryError(f"Axis {self.name} has no regular grid or time coefficients")
+        if len(bounds) == 1:
+            index = math.floor((float(low) - self.lower) / self.resolution)
+            return (min(max(index, 0), self.size - 1),) * 2
+        # Small tolerances keep cell centres given as bounds inside their cell
+        first = 0 if low == '*' else max(math.ceil((float(low) - self.lower) / self.resolution - 0.5 - 1e-9), 0)
+        last = self.size - 1 if high == '*' else \
+            min(math.floor((float(high) - self.lower) / self.resolution - 0.5 + 1e-9), self.size - 1)
+        if last < first:
+            raise QueryError(f"Subset {self.name}({low}:{high}) selects no cells")
+        return first, last
+
+    # Returns a trim subset selecting exactly the cells first..last, for use in a query
+    def subset(self, first, last):
+        if self.coefficients:
+            return f'"{self.coefficients[first]}":"{self.coefficients[last]}"'
+        return ':'.join(str(round(self.lower + (i + 0.5) * self.resolution, 10)) for i in (first, last))
+
+    # Returns the number of grid cells covered by the bounds of a subset
+    def cell_count(self, bounds):
+        if len(bounds) < 2:
+            return 1
+        low = self.lower if bounds[0] == '*' else bounds[0]
+        high = self.upper if bounds[1] == '*' else bounds[1]
+        if self.coefficients:
+            return max(sum(1 for c in self.coefficients if self._within(c, str(low), str(high))), 1)
+        if self.temporal:
+            span = (_to_time(self.upper) - _to_time(self.lower)).total_seconds() or 1
+            part = (_to_time(str(high)) - _to_time(str(low))).total_seconds()
+            return max(math.ceil(self.size * part / span) + 1, 1)
+        if self.resolution:
+            return max(math.floor(abs(float(high) - float(low)) / self.resolution) + 1, 1)
+        return self.size
+
+class CoverageMetadata:
+    """
+    Axes and CRS of one coverage, parsed from a DescribeCoverage response.
+    """
+    def __init__(self, coverage, crs, axes):
+        self.coverage = coverage
+        self.crs = crs
+        self.axes = {axis.name: axis for axis in axes}
+
+    def axis(self, name):
+        if name not in self.axes:
+            raise QueryError(f"Coverage {self.coverage} has no axis '{name}'")
+        return self.axes[name]
+
+    # subsets maps axis names to subset values, e.g. {'Lat': 53.08, 'ansi': '"2014-01":"2014-12"'}
+    def validate(self, subsets):
+        for name, value in subsets.items():
+            self.axis(name).validate(parse_bounds(value))
+
+    # Estimated number of bytes returned for a subset; axes that are not subset count fully
+    def estimate_size(self, subsets, bytes_per_cell=4):
+        cells = 1
+        for name, axis in self.axes.items():
+            cells *= axis.cell_count(parse_bounds(subsets[name])) if name in subsets else axis.size
+        return cells * bytes_per_cell
+
+    def to_dict(self):
+        return {'coverage': self.coverage, 'crs': self.crs,
+                'axes': [axis.to_dict() for axis in self.axes.values()]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['coverage'], data['crs'], [Axis(**axis) for axis in data['axes']])
+
+    @classmethod
+    def from_xml(cls, coverage, xml):
+        root = ET.fromstring(xml)
+        envelope = root.find('.//{*}Envelope')
+        if envelope is None:
+            raise QueryError(f"No extent in the description of coverage {coverage}")
+        labels = envelope.get('axisLabels', '').split()
+        lower = _TOKEN.findall(envelope.find('{*}lowerCorner').text)
+        upper = _TOKEN.findall(envelope.find('{*}upperCorner').text)
+
+        # Grid sizes are listed in the order of the grid axes, which can differ from the envelope
+        grid_labels = labels
+        grid_axis_labels = root.find('.//{*}domainSet//{*}axisLabels')
+        if grid_axis_labels is not None and grid_axis_labels.text:
+            grid_labels = grid_axis_labels.text.split()
+        sizes = {}
+        grid = root.find('.//{*}GridEnvelope')
+        if grid is not None:
+            low = grid.find('{*}low').text.split()
+            high = grid.find('{*}high').text.split()
+            for label, l, h in zip(grid_labels, low, high):
+                sizes[label] = int(h) - int(l) + 1
+
+        coefficients = {}
+        for general_axis in root.iter():
+            if general_axis.tag.endswith('GeneralGridAxis'):
+                spanned = general_axis.find('.//{*}gridAxesSpanned')
+                values = general_axis.find('.//{*}coefficients')
+                if spanned is not None and values is not None and values.text:
+                    coefficients[spanned.text.strip()] = _TOKEN.findall(values.text)
+
+        axes = []
+        for label, low, high in zip(labels, lower, upper):
+            size = sizes.get(label, 1)
+            if low.startswith('"'):
+                axes.append(Axis(label, low.strip('"'), high.strip('"'), size,
+                                 coefficients=[c.strip('"') for c in coefficients.get(label, [])] or None))
+            else:
+                low, high = float(low), float(high)
+                axes.append(Axis(label, low, high, size, (high - low) / size if size else None))
+        return cls(coverage, envelope.get('srsName'), axes)
+
+class MetadataCache:
+    """
+    Coverage descriptions fetched once per server and kept in memory and, if a path is
+    given, in a JSON file. Entries older than max_age seconds are fetched again.
+    """
+    def __init__(self, path=None, max_age=24 * 3600):
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._entries = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self._entries = json.load(f)
+
+    def describe(self, dbc, coverage, refresh=False):
+        """
+        Returns the CoverageMetadata of coverage on the server of dbc.
+        Raises ServerError if the server cannot describe it.
+        """
+        entry = self._get(dbc.url, coverage)
+        if entry is None or refresh:
+            xml = dbc.wcs_request('DescribeCoverage', COVERAGEID=coverage)
+            entry = CoverageMetadata.from_xml(coverage, xml).to_dict()
+            self._put(dbc.url, coverage, entry)
+        return CoverageMetadata.from_dict(entry)
+
+    def coverages(self, dbc, refresh=False):
+        """
+        Returns the ids of the coverages offered by the server of dbc (GetCapabilities).
+        """
+        entry = self._get(dbc.url, '')
+        if entry is None or refresh:
+            root = ET.fromstring(dbc.wcs_request('GetCapabilities'))
+            entry = [element.text.strip() for element in root.iter() if element.tag.endswith('CoverageId')]
+            self._put(dbc.url, '', entry)
+        return entry
+
+    def _get(self, url, key):
+        with self._lock:
+            entry = self._entries.get(url, {}).get(key)
+        if entry is None or time.time() - entry['fetched'] > self.max_age:
+            return None
+        return entry['data']
+
+    def _put(self, url, key, data):
+        with self._lock:
+            self._entries.setdefault(url, {})[key] = {'fetched': time.time(), 'data': data}
+            if self.path:
+                tmp = self.path + '.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump(self._entries, f)
+                os.replace(tmp, self.path)
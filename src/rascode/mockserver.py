@@ -0,0 +1,309 @@
+# Mock WCPS server
+# Local stand-in for a rasdaman endpoint, used by the benchmarks.
+# Answers with scalars, CSV series, '{...}' structs, JSON arrays, netCDF files or PNG
+# images depending on the query, after a configurable latency and with a configurable
+# rate of server errors
+
+import gzip
+import json
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+from .exceptions import QueryError
+
+_FIELD = re.compile(r'[{;]\s*\w+\s*:')
+
+def make_png(width, height):
+    """
+    Returns an uncompressed 8-bit greyscale PNG of the given size.
+    """
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    rows = b''.join(b'\x00' + bytes((x + y) % 256 for x in range(width)) for y in range(height))
+    header = struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header)
+            + chunk(b'IDAT', zlib.compress(rows, 0)) + chunk(b'IEND', b''))
+
+def _name(name):
+    data = name.encode()
+    return struct.pack('>I', len(data)) + data + b'\x00' * (-len(data) % 4)
+
+def make_netcdf(name, values, dimensions, fill_value=None, coordinates=None):
+    """
+    Returns a classic (CDF-1) netCDF file holding one float32 variable with the given
+    dimension names, e.g. make_netcdf('AvgLandTemp', values, ('ansi',)).
+    'coordinates' optionally maps dimension names to the values of their coordinate variable.
+    """
+    values = np.asarray(values, dtype='>f4')
+    header = b'CDF\x01' + struct.pack('>I', 0)
+    header += struct.pack('>II', 10, len(dimensions))
+    for dimension, length in zip(dimensions, values.shape):
+        header += _name(dimension) + struct.pack('>I', length)
+    header += struct.pack('>II', 0, 0)
+
+    # (name, dimension ids, attributes, nc type, data) of every variable
+    variables = []
+    for dimension, coordinate in (coordinates or {}).items():
+        data = np.asarray(coordinate, dtype='>f8').tobytes()
+        variables.append((dimension, [dimensions.index(dimension)], struct.pack('>II', 0, 0), 6, data))
+    attributes = struct.pack('>II', 0, 0)
+    if fill_value is not None:
+        attributes = struct.pack('>II', 12, 1) + _name('_FillValue') + struct.pack('>IIf', 5, 1, fill_value)
+    variables.append((name, list(range(len(dimensions))), attributes, 5, values.tobytes()))
+
+    def entry(variable, begin):
+        name, dimids, attributes, nc_type, data = variable
+        return (_name(name) + struct.pack('>I', len(dimids)) + b''.join(struct.pack('>I', i) for i in dimids)
+                + attributes + struct.pack('>III', nc_type, len(data) + (-len(data) % 4), begin))
+    begin = len(header) + 8 + sum(len(entry(variable, 0)) for variable in variables)
+    body = b''
+    header += struct.pack('>II', 11, len(variables))
+    for variable in variables:
+        data = variable[4] + b'\x00' * (-len(variable[4]) % 4)
+        header += entry(variable, begin + len(body))
+        body += data
+    return header + body
+
+_SUBSET = re.compile(r'\$c\[([^\[\]]*)\]')
+_AXIS = re.compile(r'(\w+)\(([^()]*)\)')
+_LET = re.compile(r'(\$v\d+)\s*:=\s*(\$c\[[^\[\]]*\])')
+_AGGREGATE = re.compile(r'\b(add|count|min|max|avg)\(\s*\$c\[([^\[\]]*)\]')
+_POINT = re.compile(r'Lat\(\s*(-?[\d.]+)\s*\),\s*Long\(\s*(-?[\d.]+)\s*\)')
+
+def point_value(lat, long):
+    """
+    Value answered for a struct field on the point (lat, long), e.g. of a folded point batch.
+    """
+    return float(lat) * 1000 + float(long)
+
+def grid_values(*indices):
+    """
+    Value of the synthetic grid coverage at the given grid indices (in axis order).
+    """
+    value = 0
+    for index in indices:
+        value = value * 100 + np.asarray(index)
+    return value
+
+class MockWCPSServer:
+    """
+    Threaded HTTP server on localhost answering WCPS queries.
+    - 'latency' is the delay in seconds before each answer (plus up to 'jitter' seconds).
+    - 'series_length' is the number of values in CSV answers.
+    - Structs are answered with 20, 21, ... per field, or point_value for fields on a point.
+    - 'image_size' is the (width, height) of PNG answers.
+    - 'error_rate' is the fraction of queries answered with HTTP 500.
+    - Queries containing the text 'fail_on' are answered with HTTP 400, like a query the
+      server rejects.
+    - 'compress' gzips answers for clients that accept it.
+    - 'slow_rate' is the fraction of queries delayed by another 'slow_latency' seconds.
+    - 'grid' is an optional CoverageMetadata; netCDF queries on a subset of it are answered
+      with the cells of a synthetic coverage (see grid_values), Lat running north to south,
+      and add/count/min/max/avg of a subset with the aggregate of those cells. Subsets
+      reaching outside of its extent are answered with HTTP 400, as rasdaman does.
+    - 'capacity' is the number of queries answered at once; queries beyond it get HTTP 503
+      at once. 'rejected' counts them and 'peak' is the most queries seen at once.
+    'requests' counts the queries received and 'queries' holds their text; 'connections'
+    counts the TCP connections the clients opened.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, series_length=12, image_size=(64, 64),
+                 error_rate=0.0, seed=0, compress=False, capacity=None, slow_rate=0.0, slow_latency=1.0,
+                 grid=None, fail_on=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.series_length = series_length
+        self.error_rate = error_rate
+        self.compress = compress
+        self.capacity = capacity
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.grid = grid
+        self.fail_on = fail_on
+        self.requests = 0
+        self.connections = 0
+        self.queries = []
+        self.bytes_sent = 0
+        self.rejected = 0
+        self.peak = 0
+        self._active = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._png = make_png(*image_size)
+        series = [20 + (i % 12) * 0.5 for i in range(series_length)]
+        self._csv = ','.join(f"{v:.6f}" for v in series).encode()
+        self._json = json.dumps(series).encode()
+        self._netcdf = make_netcdf('AvgLandTemp', series, ('ansi',))
+        self._server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}/rasdaman/ows"
+
+    def start(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately; without this every answer
+            # waits for the client's delayed ACK
+            disable_nagle_algorithm = True
+
+            # One handler serves every request of a kept-alive connection
+            def setup(self):
+                super().setup()
+                with mock._lock:
+                    mock.connections += 1
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                query = parse_qs(urlparse(self.path).query).get('query', [''])[0]
+                status, content_type, body = mock.answer(query)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                if mock.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    body = gzip.compress(body, 6)
+                    self.send_header('Content-Encoding', 'gzip')
+                with mock._lock:
+                    mock.bytes_sent += len(body)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 1024
+
+        self._server = Server(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # Cells of the grid coverage selected by a subset such as 'Lat(5:25), ansi("2014-07")'
+    # Returns the grid indices per axis and the names of the axes that are not sliced
+    def _grid_cells(self, subset):
+        from .metadata import parse_bounds
+        subsets = dict(_AXIS.findall(subset))
+        ranges, names = [], []
+        for name, axis in self.grid.axes.items():
+            bounds = parse_bounds(subsets[name]) if name in subsets else ['*']
+            axis.validate(bounds)
+            first, last = axis.indices(bounds)
+            ranges.append(np.arange(first, last + 1))
+            if len(bounds) > 1 or name not in subsets:
+                names.append(name)
+        return ranges, names
+
+    # netCDF file with the cells of the grid coverage selected by the subset of the query,
+    # with dimensions in reverse axis order and Lat from north to south like rasdaman
+    def _grid_netcdf(self, query):
+        ranges, names = self._grid_cells(_SUBSET.search(query).group(1))
+        values = grid_values(*np.meshgrid(*ranges, indexing='ij'))
+        values = values.reshape([len(r) for r, name in zip(ranges, self.grid.axes) if name in names])
+        coordinates = {}
+        for i, name in enumerate(names):
+            axis = self.grid.axes[name]
+            cells = ranges[list(self.grid.axes).index(name)]
+            coordinates[name] = cells if axis.temporal else axis.lower + (cells + 0.5) * axis.resolution
+            if name == 'Lat':
+                values = np.flip(values, i)
+                coordinates[name] = coordinates[name][::-1]
+        values = values.transpose(range(len(names) - 1, -1, -1))
+        return make_netcdf('value', values, tuple(reversed(names)), coordinates=coordinates)
+
+    # Aggregate of the grid cells of a subset; count counts every cell
+    def _grid_aggregate(self, func, subset):
+        ranges, _ = self._grid_cells(subset)
+        values = grid_values(*np.meshgrid(*ranges, indexing='ij'))
+        if func == 'count':
+            return str(values.size)
+        return repr(float({'add': np.sum, 'min': np.min, 'max': np.max, 'avg': np.mean}[func](values)))
+
+    # Returns (status, content type, body) for a query
+    def answer(self, query):
+        with self._lock:
+            self.requests += 1
+            self.queries.append(query)
+            self.peak = max(self.peak, self._active + 1)
+            if self.capacity is not None and self._active >= self.capacity:
+                self.rejected += 1
+                return 503, 'text/plain', b'Server busy'
+            self._active += 1
+        try:
+            return self._answer(query)
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def _answer(self, query):
+        with self._lock:
+            delay = self.latency + self._random.random() * self.jitter
+            if self._random.random() < self.slow_rate:
+                delay += self.slow_latency
+            failed = self._random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if failed:
+            return 500, 'text/plain', b'Internal server error'
+        if self.fail_on is not None and self.fail_on in query:
+            return 400, 'text/plain', b'Invalid query'
+        try:
+            return self._result(query)
+        except QueryError as e:
+            return 400, 'text/plain', f"Subsetting error: {e}".encode()
+
+    # Returns (status, content type, body) for a query the server accepts
+    def _result(self, query):
+        for variable, value in _LET.findall(query):
+            query = query.replace(variable, value)
+        if 'image/png' in query or query.lstrip().startswith('image>>'):
+            return 200, 'image/png', self._png
+        if 'text/csv' in query:
+            return 200, 'text/csv', self._csv
+        if 'json' in query:
+            return 200, 'application/json', self._json
+        if 'netcdf' in query:
+            if self.grid is not None and _SUBSET.search(query):
+                return 200, 'application/netcdf', self._grid_netcdf(query)
+            return 200, 'application/netcdf', self._netcdf
+        body = query.split('return', 1)[-1]
+        fields = _FIELD.split(body)[1:]
+        if fields:
+            values = []
+            for i, field in enumerate(fields):
+                point = _POINT.search(field)
+                aggregate = self.grid is not None and _AGGREGATE.search(field)
+                if aggregate:
+                    values.append(self._grid_aggregate(*aggregate.groups()))
+                else:
+                    values.append(f"{point_value(*point.groups()):.6f}" if point else str(20 + i % 7))
+            return 200, 'text/plain', ('{' + ','.join(values) + '}').encode()
+        aggregate = self.grid is not None and _AGGREGATE.search(body)
+        if aggregate:
+            return 200, 'text/plain', self._grid_aggregate(*aggregate.groups()).encode()
+        return 200, 'text/plain', b'25.984251'
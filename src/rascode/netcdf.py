@@ -0,0 +1,156 @@
+# netCDF results
+# Reads netCDF results (application/netcdf) straight into NumPy arrays. Classic files
+# (CDF-1, CDF-2 and CDF-5) are parsed here; netCDF-4 files need the optional h5py
+# NumPy is imported on first use so that is_netcdf stays cheap to import
+
+import io
+from collections import namedtuple
+
+CLASSIC_MAGIC = b'CDF'
+HDF5_MAGIC = b'\x89HDF\r\n\x1a\n'
+
+_DIMENSION, _VARIABLE, _ATTRIBUTE = 10, 11, 12
+_TYPES = {1: 'i1', 2: 'S1', 3: 'i2', 4: 'i4', 5: 'f4', 6: 'f8',
+          7: 'u1', 8: 'u2', 9: 'u4', 10: 'i8', 11: 'u8'}
+_STREAMING = 0xFFFFFFFF
+
+Variable = namedtuple('Variable', ['dimensions', 'data', 'attributes'])
+
+def is_netcdf(raw):
+    return raw[:3] == CLASSIC_MAGIC or raw[:8] == HDF5_MAGIC
+
+class _Header:
+    # Cursor over the big-endian header of a classic file
+    def __init__(self, raw):
+        self.raw = raw
+        self.version = raw[3]
+        if raw[:3] != CLASSIC_MAGIC or self.version not in (1, 2, 5):
+            raise ValueError("Not a classic netCDF file")
+        self.pos = 4
+        self.count_size = 8 if self.version == 5 else 4
+        self.offset_size = 4 if self.version == 1 else 8
+
+    def _int(self, size):
+        value = int.from_bytes(self.raw[self.pos:self.pos + size], 'big')
+        self.pos += size
+        return value
+
+    def count(self):
+        return self._int(self.count_size)
+
+    def offset(self):
+        return self._int(self.offset_size)
+
+    def tag(self):
+        return self._int(4)
+
+    def name(self):
+        size = self.count()
+        name = self.raw[self.pos:self.pos + size].decode('utf-8')
+        self.pos += -(-size // 4) * 4
+        return name
+
+    def values(self, nc_type, size):
+        import numpy as np
+        dtype = np.dtype('>' + _TYPES[nc_type])
+        data = np.frombuffer(self.raw, dtype, size, self.pos)
+        self.pos += -(-size * dtype.itemsize // 4) * 4
+        if nc_type == 2:
+            return data.tobytes().decode('utf-8', 'replace').rstrip('\x00')
+        return data[0].item() if size == 1 else data.astype(dtype.newbyteorder('='))
+
+    # Tagged list of items read by read_item; ABSENT lists are a zero tag and count
+    def items(self, expected, read_item):
+        tag, size = self.tag(), self.count()
+        if tag not in (0, expected):
+            raise ValueError("Malformed netCDF header")
+        return [read_item() for _ in range(size)]
+
+    def attributes(self):
+        def attribute():
+            name = self.name()
+            nc_type = self.tag()
+            return name, self.values(nc_type, self.count())
+        return dict(self.items(_ATTRIBUTE, attribute))
+
+def read_netcdf(raw):
+    """
+    Parses a netCDF file held in memory.
+    Returns (dimensions, variables, attributes): dimension name -> length, variable name ->
+    Variable(dimensions, data, attributes) and the global attributes.
+    """
+    import numpy as np
+    if raw[:8] == HDF5_MAGIC:
+        return _read_hdf5(raw)
+    header = _Header(raw)
+    records = header.count()
+    dims = header.items(_DIMENSION, lambda: (header.name(), header.count()))
+    attributes = header.attributes()
+
+    def variable():
+        name = header.name()
+        dimids = [header.count() for _ in range(header.count())]
+        attrs = header.attributes()
+        nc_type = header.tag()
+        vsize = header.count()
+        return name, dimids, attrs, nc_type, vsize, header.offset()
+    specs = header.items(_VARIABLE, variable)
+
+    record_specs = [spec for spec in specs if spec[1] and dims[spec[1][0]][1] == 0]
+    # A single record variable is not padded; otherwise each record slab is
+    record_size = sum(spec[4] for spec in record_specs)
+    if len(record_specs) == 1:
+        spec = record_specs[0]
+        record_size = int(np.prod([dims[i][1] for i in spec[1][1:]], dtype=np.int64)) \
+            * np.dtype(_TYPES[spec[3]]).itemsize
+    if records == _STREAMING and record_specs:
+        records = (len(raw) - min(spec[5] for spec in record_specs)) // max(record_size, 1)
+
+    variables = {}
+    for name, dimids, attrs, nc_type, vsize, begin in specs:
+        dtype = np.dtype('>' + _TYPES[nc_type])
+        shape = [dims[i][1] for i in dimids]
+        strides = list(np.cumprod([1] + shape[:0:-1])[::-1] * dtype.itemsize) if shape else []
+        if name in (spec[0] for spec in record_specs):
+            shape[0], strides[0] = records, record_size
+        data = np.ndarray(shape, dtype, raw, begin, strides).astype(dtype.newbyteorder('='))
+        variables[name] = Variable(tuple(dims[i][0] for i in dimids), data, attrs)
+    return {name: (length or records) for name, length in dims}, variables, attributes
+
+def _read_hdf5(raw):
+    try:
+        import h5py
+    except ImportError:
+        raise ValueError("Decoding netCDF-4 results requires h5py; request a classic netCDF "
+                         "encoding or install h5py")
+    with h5py.File(io.BytesIO(raw), 'r') as f:
+        dims = {}
+        variables = {}
+        for name, dataset in f.items():
+            attrs = {key: value for key, value in dataset.attrs.items()
+                     if key not in ('CLASS', 'NAME', 'DIMENSION_LIST', 'REFERENCE_LIST', '_Netcdf4Dimid')}
+            if dataset.attrs.get('CLASS') == b'DIMENSION_SCALE':
+                dims[name] = dataset.shape[0]
+            dimensions = tuple(dataset.dims[i][0].name.lstrip('/') if len(dataset.dims[i]) else ''
+                               for i in range(dataset.ndim))
+            variables[name] = Variable(dimensions, dataset[()], attrs)
+        return dims, variables, dict(f.attrs)
+
+def netcdf_array(raw, variable=None):
+    """
+    Returns the data of one variable of a netCDF result as an array, with _FillValue
+    cells of floating-point variables set to NaN. Without a variable name the result
+    must hold exactly one variable that is not a coordinate variable.
+    """
+    import numpy as np
+    dims, variables, _ = read_netcdf(raw)
+    if variable is None:
+        data_variables = [name for name in variables if name not in dims]
+        if len(data_variables) != 1:
+            raise ValueError(f"netCDF result has data variables {data_variables}, choose one")
+        variable = data_variables[0]
+    _, data, attrs = variables[variable]
+    fill = attrs.get('_FillValue', attrs.get('missing_value'))
+    if fill is not None and data.dtype.kind == 'f':
+        data = np.where(data == fill, np.nan, data)
+    return data
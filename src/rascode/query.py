@@ -0,0 +1,298 @@
+# Query expression tree
+# DataCube queries can be built as a tree of expressions and compiled to WCPS text.
+# The compiler validates the tree and hoists repeated subexpressions into let bindings
+
+import re
+from abc import ABC, abstractmethod
+from functools import lru_cache
+
+from .exceptions import QueryError
+
+AGGREGATES = {'min', 'max', 'avg', 'count', 'add', 'some', 'all'}
+FUNCTIONS = AGGREGATES | {'abs', 'sqrt', 'exp', 'log', 'ln', 'pow', 'sin', 'cos', 'tan'}
+OPERATORS = {'+', '-', '*', '/', '>', '<', '>=', '<=', '=', '!=', 'and', 'or', 'xor'}
+FORMATS = {'image/png', 'image/jpeg', 'image/tiff', 'text/csv', 'text/plain', 'application/json',
+           'application/netcdf', 'application/x-netcdf', 'application/gml+xml',
+           'png', 'jpeg', 'tiff', 'csv', 'json', 'netcdf', 'gml'}
+_NAME = re.compile(r'^[A-Za-z_][\w.-]*$')
+
+class Expr(ABC):
+    """
+    Base class of all expression nodes. Nodes are immutable and compare by structure,
+    so identical subexpressions can be found and compiled queries cached.
+    Subclasses implement render(name), returning their WCPS text with name(child)
+    standing for the text of each child.
+    Arithmetic and comparison operators build BinOp nodes; use eq() for '='.
+    """
+    # Nodes that are worth binding to a variable when they occur more than once
+    hoistable = True
+
+    def __init__(self, *fields):
+        self._fields = fields
+        self._hash = hash((type(self), fields))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._fields == other._fields
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return f"{type(self).__name__}{self._fields!r}"
+
+    def children(self):
+        return ()
+
+    @abstractmethod
+    def render(self, name):
+        pass
+
+    def validate(self):
+        pass
+
+    def __add__(self, other): return BinOp('+', self, other)
+    def __radd__(self, other): return BinOp('+', other, self)
+    def __sub__(self, other): return BinOp('-', self, other)
+    def __rsub__(self, other): return BinOp('-', other, self)
+    def __mul__(self, other): return BinOp('*', self, other)
+    def __rmul__(self, other): return BinOp('*', other, self)
+    def __truediv__(self, other): return BinOp('/', self, other)
+    def __rtruediv__(self, other): return BinOp('/', other, self)
+    def __gt__(self, other): return BinOp('>', self, other)
+    def __lt__(self, other): return BinOp('<', self, other)
+    def __ge__(self, other): return BinOp('>=', self, other)
+    def __le__(self, other): return BinOp('<=', self, other)
+
+    def eq(self, other):
+        return BinOp('=', self, other)
+
+def wrap(value):
+    """
+    Returns value as an expression - numbers become literals.
+    """
+    if isinstance(value, Expr):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return Literal(value)
+    raise QueryError(f"Cannot use {value!r} in a query expression")
+
+class Var(Expr):
+    hoistable = False
+
+    def __init__(self, name='$c'):
+        super().__init__(name)
+
+    def render(self, name):
+        return self._fields[0]
+
+class Literal(Expr):
+    hoistable = False
+
+    # The type is part of the fields, as 1 == 1.0 but they render as '1' and '1.0'
+    def __init__(self, value):
+        super().__init__(value, type(value))
+
+    def render(self, name):
+        return str(self._fields[0])
+
+class Subset(Expr):
+    """
+    Subset of a coverage (or of another expression) on one or more axes.
+    Each axis is (name, low) for a slice or (name, low, high) for a trim;
+    bounds are numbers or WCPS text such as '"2014-07"'.
+    """
+    def __init__(self, base, *axes):
+        super().__init__(wrap(base) if not isinstance(base, str) else Var(base),
+                         tuple(tuple(axis) for axis in axes))
+
+    def children(self):
+        return (self._fields[0],)
+
+    def render(self, name):
+        base, axes = self._fields
+        parts = []
+        for axis in axes:
+            bounds = ':'.join(str(bound) for bound in axis[1:])
+            parts.append(f"{axis[0]}({bounds})")
+        return f"{name(base)}[{', '.join(parts)}]"
+
+    def validate(self):
+        axes = self._fields[1]
+        if not axes:
+            raise QueryError("Subset needs at least one axis")
+        for axis in axes:
+            if len(axis) not in (2, 3) or not _NAME.match(str(axis[0])):
+                raise QueryError(f"Invalid subset axis {axis!r}")
+            if any(bound is None or str(bound).strip() == '' for bound in axis[1:]):
+                raise QueryError(f"Empty bound in subset axis {axis[0]}")
+
+class BinOp(Expr):
+    def __init__(self, op, left, right):
+        super().__init__(op, wrap(left), wrap(right))
+
+    def children(self):
+        return self._fields[1:]
+
+    def render(self, name):
+        op, left, right = self._fields
+        return f"{_operand(left, name)} {op} {_operand(right, name)}"
+
+    def validate(self):
+        if self._fields[0] not in OPERATORS:
+            raise QueryError(f"Unknown operator '{self._fields[0]}'")
+
+_VARIABLE = re.compile(r'^\$\w+$')
+
+# Nested operations are put in brackets unless they were replaced by a variable
+def _operand(expr, name):
+    text = name(expr)
+    return f"({text})" if isinstance(expr, BinOp) and not _VARIABLE.match(text) else text
+
+class Call(Expr):
+    """
+    Function or aggregate call such as avg($c[...]).
+    """
+    def __init__(self, func, *args):
+        super().__init__(func, tuple(wrap(arg) for arg in args))
+
+    def children(self):
+        return self._fields[1]
+
+    def render(self, name):
+        return f"{self._fields[0]}({', '.join(name(arg) for arg in self._fields[1])})"
+
+    def validate(self):
+        func, args = self._fields
+        if func not in FUNCTIONS:
+            raise QueryError(f"Unknown function '{func}'")
+        if not args or (func in AGGREGATES and len(args) != 1):
+            raise QueryError(f"Wrong number of arguments for '{func}'")
+
+class Struct(Expr):
+    """
+    Struct (multi-band) value such as {red: 255; green: 0; blue: 0}.
+    """
+    hoistable = False
+
+    def __init__(self, **fields):
+        super().__init__(tuple((key, wrap(value)) for key, value in fields.items()))
+
+    def children(self):
+        return tuple(value for _, value in self._fields[0])
+
+    def render(self, name):
+        return '{' + '; '.join(f"{key}: {name(value)}" for key, value in self._fields[0]) + '}'
+
+    def validate(self):
+        if not self._fields[0]:
+            raise QueryError("Struct needs at least one field")
+
+class Switch(Expr):
+    """
+    switch case <condition> return <value> ... default return <value>
+    'cases' is a list of (condition, value) pairs.
+    """
+    def __init__(self, cases, default):
+        super().__init__(tuple((wrap(cond), wrap(value)) for cond, value in cases), wrap(default))
+
+    def children(self):
+        cases, default = self._fields
+        return tuple(node for case in cases for node in case) + (default,)
+
+    def render(self, name):
+        cases, default = self._fields
+        parts = [f"case {name(cond)} return {name(value)}" for cond, value in cases]
+        return f"switch {' '.join(parts)} default return {name(default)}"
+
+    def validate(self):
+        if not self._fields[0]:
+            raise QueryError("Switch needs at least one case")
+
+class Encode(Expr):
+    hoistable = False
+
+    def __init__(self, expr, fmt):
+        super().__init__(wrap(expr), fmt)
+
+    def children(self):
+        return (self._fields[0],)
+
+    def render(self, name):
+        return f'encode({name(self._fields[0])}, "{self._fields[1]}")'
+
+    def validate(self):
+        if self._fields[1] not in FORMATS:
+            raise QueryError(f"Unknown encoding format '{self._fields[1]}'")
+
+class Query(Expr):
+    """
+    Root of a query: for $c in (coverage) [let ...] return expr
+    'prefix' is the optional 'image>>' or 'diagram>>' marker used by DataCube.
+    """
+    hoistable = False
+
+    def __init__(self, coverage, expr, prefix=''):
+        super().__init__(coverage, wrap(expr), prefix)
+
+    def children(self):
+        return (self._fields[1],)
+
+    def validate(self):
+        if not _NAME.match(str(self._fields[0])):
+            raise QueryError(f"Invalid coverage name '{self._fields[0]}'")
+
+    def render(self, name):
+        return compile_query(self)
+
+    def compile(self):
+        return compile_query(self)
+
+def _walk(node, visit):
+    visit(node)
+    for child in node.children():
+        _walk(child, visit)
+
+@lru_cache(maxsize=1024)
+def compile_query(query):
+    """
+    Validates the query tree and compiles it to WCPS text. Subexpressions that occur
+    more than once are computed once in a let binding. Results are cached per tree.
+    """
+    def check(node):
+        node.validate()
+        if isinstance(node, Encode) and node is not query._fields[1]:
+            raise QueryError("encode is only allowed as the outermost return expression")
+        if isinstance(node, Query) and node is not query:
+            raise QueryError("Queries cannot be nested")
+    _walk(query, check)
+
+    # Count occurrences, expanding every repeated node only once so that the parts of a
+    # repeated expression are not counted again for each repetition
+    seen = {}
+    order = []
+    def count(node):
+        seen[node] = seen.get(node, 0) + 1
+        if node.hoistable and seen[node] > 1:
+            return
+        for child in node.children():
+            count(child)
+        if seen[node] == 1:
+            order.append(node)
+    count(query)
+
+    names = {}
+    def name(node):
+        return names.get(node) or node.render(name)
+
+    bindings = []
+    for node in order:
+        if node.hoistable and seen[node] > 1:
+            text = node.render(name)
+            names[node] = f"$v{len(bindings)}"
+            bindings.append(f"{names[node]} := {text}")
+
+    coverage, expr, prefix = query._fields
+    text = f"{prefix}for $c in ({coverage}) "
+    if bindings:
+        text += f"let {', '.join(bindings)} "
+    return text + f"return {name(expr)}"
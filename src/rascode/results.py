@@ -0,0 +1,93 @@
+# Result decoding
+# Turns the results returned by the server for DataCube queries (scalars, CSV series,
+# '{...}' and JSON arrays, netCDF and GeoTIFF files) into NumPy scalars and arrays
+
+import json
+from functools import cached_property
+
+import numpy as np
+
+from .images import detect_image, decode_image
+from .netcdf import is_netcdf, netcdf_array
+
+_BRACES = bytes.maketrans(b'{}', b'  ')
+_BRACKETS = bytes.maketrans(b'[]', b'{}')
+_FLOAT_CHARS = b'.eEnNiI'
+
+def _shape(raw):
+    # Each '{' opens a group one level deeper; the number of groups per level gives the shape
+    chars = np.frombuffer(raw, dtype=np.uint8)
+    opening = chars == ord('{')
+    if not opening.any():
+        return None
+    depth = np.cumsum(opening.astype(np.int64) - (chars == ord('}')))
+    groups = np.bincount(depth[opening])[1:]
+    shape = [int(groups[0])] if groups[0] > 1 else []
+    for outer, inner in zip(groups[:-1], groups[1:]):
+        shape.append(int(inner // outer))
+    return shape
+
+def decode_result(raw):
+    """
+    Decodes a scalar ('25.984251'), CSV ('2.83,4.48,...'), array ('{1,2},{3,4}') or
+    JSON array ('[[1,2],[3,4]]') result into a NumPy scalar or array, parsing straight
+    from the bytes. Integer results get an int64 dtype, everything else float64.
+    netCDF and GeoTIFF results are read into arrays of their stored dtype.
+    Raises ValueError if the result is not numeric.
+    """
+    if isinstance(raw, str):
+        raw = raw.encode('utf-8')
+    if is_netcdf(raw):
+        return netcdf_array(raw)
+    if detect_image(raw) == 'image/tiff':
+        return decode_image(raw)
+    raw = raw.strip()
+    if not raw:
+        return np.empty(0)
+    if raw[:1] == b'[':
+        return _decode_json(raw)
+
+    dtype = np.float64 if any(c in raw for c in _FLOAT_CHARS) else np.int64
+    expected = raw.count(b',') + 1
+    values = np.fromstring(raw.translate(_BRACES), dtype=dtype, sep=',')
+    if values.size != expected:
+        raise ValueError(f"Result is not numeric: {raw[:80]!r}")
+
+    shape = _shape(raw)
+    if shape is None:
+        # Plain text - a single value is a scalar, a CSV series is one-dimensional
+        return values[0] if expected == 1 else values
+    last = values.size // int(np.prod(shape)) if shape else values.size
+    if last > 1 or not shape:
+        shape.append(last)
+    return values.reshape(shape)
+
+def _decode_json(raw):
+    # Numeric JSON arrays have the layout of '{...}' arrays; null and nested objects
+    # need the JSON parser
+    try:
+        return decode_result(raw.translate(_BRACKETS))
+    except ValueError:
+        try:
+            return np.array(json.loads(raw), dtype=np.float64)
+        except (ValueError, TypeError):
+            raise ValueError(f"Result is not a numeric JSON array: {raw[:80]!r}")
+
+class QueryResult:
+    """
+    Typed result of one query.
+    - 'raw' is the bytes returned by the server.
+    - 'value' is the decoded NumPy scalar or array, computed on first access.
+    """
+    def __init__(self, raw):
+        self.raw = raw
+
+    @cached_property
+    def value(self):
+        return decode_result(self.raw)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.value, dtype=dtype)
+
+    def __repr__(self):
+        return f"QueryResult({self.value!r})"
@@ -0,0 +1,227 @@
+# Chunked array store
+# Coverage values fetched once are kept on disk in fixed-size chunks (a Zarr v2 layout
+# of raw, uncompressed chunk files), so later subsets are assembled from memory-mapped
+# chunks and only the chunks never fetched before are requested from the server
+
+import itertools
+import json
+import logging
+import os
+
+import numpy as np
+
+from .exceptions import QueryError
+from .images import write_file
+from .metadata import CoverageMetadata, parse_bounds
+from .netcdf import read_netcdf
+
+logger = logging.getLogger(__name__)
+
+# Cells per chunk along numeric axes (Lat, Long) and along time axes (ansi)
+DEFAULT_CHUNK = 64
+DEFAULT_TIME_CHUNK = 12
+
+def decode_grid(raw, names):
+    """
+    Array of a netCDF subset result with its dimensions in the order of 'names' (matched
+    without case) and every axis running from the lower to the upper end of the extent:
+    axes whose coordinate variable descends, like Lat in most results, are flipped.
+    """
+    dims, variables, _ = read_netcdf(raw)
+    data_variables = [name for name in variables if name not in dims]
+    if len(data_variables) != 1:
+        raise ValueError(f"netCDF result has data variables {data_variables}, expected one")
+    dimensions, data, attrs = variables[data_variables[0]]
+    fill = attrs.get('_FillValue', attrs.get('missing_value'))
+    if fill is not None and data.dtype.kind == 'f':
+        data = np.where(data == fill, np.nan, data)
+
+    lower = [dimension.lower() for dimension in dimensions]
+    if sorted(lower) != sorted(name.lower() for name in names):
+        raise ValueError(f"netCDF result has dimensions {dimensions}, expected {tuple(names)}")
+    data = data.transpose([lower.index(name.lower()) for name in names])
+    for i, name in enumerate(names):
+        dimension = dimensions[lower.index(name.lower())]
+        coordinate = variables.get(dimension)
+        if coordinate is not None and len(coordinate.data) > 1 and coordinate.data[0] > coordinate.data[-1]:
+            data = np.flip(data, i)
+    return data
+
+class ChunkStore:
+    """
+    Local copy of one coverage, kept in chunks of 'chunks' cells per axis under
+    root/<coverage>/ in the Zarr v2 layout (.zarray, .zattrs and one raw chunk file
+    named 'i.j.k' per chunk), readable by zarr and xarray.
+    - read() returns the cells of a subset, fetching the chunks it needs that are not
+      stored yet through 'dbo' in parallel (netCDF subsets of whole chunks).
+    - Without a dbo only stored chunks can be read, e.g. offline with ChunkStore.open().
+    Arrays have the axes of the coverage in order, each running from the lower to the
+    upper end of the extent (Lat from south to north). Time axes need their coefficients.
+    A store keeps the chunk sizes it was created with; when the coverage grows, chunks on
+    the old edge are fetched again. 'dtype' must be a floating point type, as cells
+    outside of the extent and missing values are NaN.
+    """
+    def __init__(self, root, metadata, dbo=None, chunks=None, dtype='float32', max_workers=8):
+        self.metadata = metadata
+        self.names = list(metadata.axes)
+        self.path = os.path.join(root, metadata.coverage)
+        self.dbo = dbo
+        self.max_workers = max_workers
+        self.fetched = 0
+        dtype = np.dtype(dtype)
+        # Cells never fetched and missing values are NaN, which only floats can hold
+        if dtype.kind != 'f':
+            raise QueryError(f"ChunkStore needs a floating point dtype, not {dtype}")
+        os.makedirs(self.path, exist_ok=True)
+        self._open(chunks, dtype)
+
+    @classmethod
+    def open(cls, root, coverage, dbo=None, max_workers=8):
+        """
+        Opens an existing store with the coverage description saved in it.
+        """
+        with open(os.path.join(root, coverage, '.zattrs')) as f:
+            metadata = CoverageMetadata.from_dict(json.load(f)['coverage'])
+        return cls(root, metadata, dbo, max_workers=max_workers)
+
+    def _open(self, chunks, dtype):
+        shape = [axis.size for axis in self.metadata.axes.values()]
+        array_path = os.path.join(self.path, '.zarray')
+        stored = None
+        if os.path.exists(array_path):
+            with open(array_path) as f:
+                stored = json.load(f)
+            with open(os.path.join(self.path, '.zattrs')) as f:
+                self._check_grid(CoverageMetadata.from_dict(json.load(f)['coverage']))
+        if stored is not None:
+            self.chunks = tuple(stored['chunks'])
+            self.dtype = np.dtype(stored['dtype'])
+            self._drop_edges(stored['shape'], shape)
+        else:
+            self.chunks = tuple(self._chunk_sizes(chunks))
+            self.dtype = dtype
+        self.shape = tuple(shape)
+        if stored is None or stored['shape'] != shape:
+            self._write_metadata()
+
+    def _chunk_sizes(self, chunks):
+        chunks = dict(chunks or {})
+        for name in chunks:
+            self.metadata.axis(name)
+        return [min(chunks.get(name, DEFAULT_TIME_CHUNK if axis.temporal else DEFAULT_CHUNK), max(axis.size, 1))
+                for name, axis in self.metadata.axes.items()]
+
+    # A store only fits a coverage whose cells keep their grid indices
+    def _check_grid(self, stored):
+        for name, axis in self.metadata.axes.items():
+            old = stored.axes.get(name)
+            if old is None or len(stored.axes) != len(self.metadata.axes):
+                raise ValueError(f"Store {self.path} has axes {list(stored.axes)}, not {self.names}")
+            if axis.coefficients or old.coefficients:
+                same = (axis.coefficients or [])[:len(old.coefficients or [])] == (old.coefficients or [])
+            else:
+                same = axis.lower == old.lower and axis.resolution == old.resolution
+            if not same:
+                raise ValueError(f"Axis {name} of {self.metadata.coverage} no longer matches the "
+                                 f"grid of store {self.path}")
+
+    # Chunks that held the last cells of a grown axis lack the new cells
+    def _drop_edges(self, old_shape, shape):
+        for i, (old, new) in enumerate(zip(old_shape, shape)):
+            if new > old and old % self.chunks[i]:
+                edge = str(old // self.chunks[i])
+                for name in os.listdir(self.path):
+                    if not name.startswith('.') and name.split('.')[i] == edge:
+                        os.remove(os.path.join(self.path, name))
+
+    def _write_metadata(self):
+        array = {'zarr_format': 2, 'shape': list(self.shape), 'chunks': list(self.chunks),
+                 'dtype': self.dtype.str, 'compressor': None, 'fill_value': 'NaN', 'order': 'C',
+                 'filters': None, 'dimension_separator': '.'}
+        attrs = {'_ARRAY_DIMENSIONS': self.names, 'coverage': self.metadata.to_dict()}
+        write_file(os.path.join(self.path, '.zarray'), json.dumps(array, indent=2).encode())
+        write_file(os.path.join(self.path, '.zattrs'), json.dumps(attrs, indent=2).encode())
+
+    # Grid index ranges (first, stop) of a subset and whether each axis is kept
+    def _ranges(self, subsets):
+        for name in subsets:
+            self.metadata.axis(name)
+        ranges, kept = [], []
+        for name, axis in self.metadata.axes.items():
+            bounds = parse_bounds(subsets[name]) if name in subsets else ['*', '*']
+            axis.validate(bounds)
+            first, last = axis.indices(bounds)
+            ranges.append((first, last + 1))
+            kept.append(len(bounds) > 1)
+        return ranges, kept
+
+    def _keys(self, ranges):
+        return list(itertools.product(*(range(first // size, (stop - 1) // size + 1)
+                                         for (first, stop), size in zip(ranges, self.chunks))))
+
+    def _chunk_path(self, key):
+        return os.path.join(self.path, '.'.join(map(str, key)))
+
+    # Grid index range of each axis covered by a chunk, clipped to the extent
+    def _chunk_ranges(self, key):
+        return [(i * size, min((i + 1) * size, extent)) for i, size, extent in zip(key, self.chunks, self.shape)]
+
+    def missing(self, **subsets):
+        """
+        Keys of the chunks a subset needs that are not stored.
+        """
+        ranges, _ = self._ranges(subsets)
+        return [key for key in self._keys(ranges) if not os.path.exists(self._chunk_path(key))]
+
+    def read(self, **subsets):
+        """
+        Cells of a subset given per axis like DataCube methods, e.g.
+        read(Lat='35:75', Long='-10:30', ansi='"2014-01":"2014-12"'). Trims select the cells
+        whose centre (or date) lies within them, a slice selects one cell and drops its
+        axis, and axes not given are read in full.
+        """
+        ranges, kept = self._ranges(subsets)
+        keys = self._keys(ranges)
+        self.fetch([key for key in keys if not os.path.exists(self._chunk_path(key))])
+
+        out = np.empty([stop - first for first, stop in ranges], dtype=self.dtype)
+        for key in keys:
+            chunk = np.memmap(self._chunk_path(key), dtype=self.dtype, mode='r', shape=self.chunks)
+            source, target = [], []
+            for (first, stop), (begin, end) in zip(ranges, self._chunk_ranges(key)):
+                low, high = max(first, begin), min(stop, end)
+                source.append(slice(low - begin, high - begin))
+                target.append(slice(low - first, high - first))
+            out[tuple(target)] = chunk[tuple(source)]
+        return out.reshape([len(range(*r)) for r, keep in zip(ranges, kept) if keep])
+
+    def fetch(self, keys):
+        """
+        Fetches the given chunks from the server and stores them.
+        """
+        if not keys:
+            return
+        if self.dbo is None:
+            raise QueryError(f"{len(keys)} chunks of {self.metadata.coverage} are not stored and the "
+                             f"store has no connection to fetch them")
+        logger.debug("Fetching %d chunks of %s", len(keys), self.metadata.coverage)
+        results = self.dbo.fetch_all([self.chunk_query(key) for key in keys], self.max_workers)
+        for key, raw in zip(keys, results):
+            self._store(key, decode_grid(raw, self.names))
+        self.fetched += len(keys)
+
+    # Query for the cells of one chunk; trims at cell centres so no neighbouring cell is included
+    def chunk_query(self, key):
+        subsets = ', '.join(f"{name}({axis.subset(first, stop - 1)})" for (name, axis), (first, stop)
+                            in zip(self.metadata.axes.items(), self._chunk_ranges(key)))
+        return (f'for $c in ({self.metadata.coverage}) '
+                f'return encode($c[{subsets}], "application/netcdf")')
+
+    def _store(self, key, data):
+        expected = tuple(stop - first for first, stop in self._chunk_ranges(key))
+        if data.shape != expected:
+            raise ValueError(f"Chunk {key} of {self.metadata.coverage} has shape {data.shape}, "
+                             f"expected {expected}")
+        block = np.full(self.chunks, np.nan, dtype=self.dtype)
+        block[tuple(slice(0, n) for n in expected)] = data
+        write_file(self._chunk_path(key), block.tobytes())
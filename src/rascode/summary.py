@@ -0,0 +1,113 @@
+# Summary statistics
+# Several aggregates and threshold counts over one location, optionally grouped into
+# time buckets, are requested as one struct and parsed back into typed records
+
+from collections import namedtuple
+from datetime import date
+
+from .query import Query, Subset, Call, Struct
+from .results import decode_result
+from .timeseries import parse_date, format_date, add_steps
+
+SEASONS = {'spring': (3, 5), 'summer': (6, 8), 'autumn': (9, 11), 'winter': (12, 14)}
+
+def threshold_name(threshold):
+    """
+    Record field name of the count of values above a threshold, e.g. above_15.
+    """
+    return "above_" + str(threshold).replace('-', 'minus').replace('.', '_')
+
+def time_buckets(start, end, group_by):
+    """
+    Splits the inclusive date range start..end into labelled (start, end) buckets.
+    group_by is 'month', 'season' or 'year', or a dict of label -> (start, end).
+    Seasons follow extract_seasonal_data, winter runs from December to February.
+    """
+    if isinstance(group_by, dict):
+        return list(group_by.items())
+    first, monthly = parse_date(start)
+    last, _ = parse_date(end)
+    buckets = []
+    match group_by:
+        case "month":
+            day = first
+            while day <= last:
+                buckets.append((format_date(day, True), (format_date(day, True),) * 2))
+                day = add_steps(day, 1, True)
+        case "year":
+            for year in range(first.year, last.year + 1):
+                buckets.append((str(year), _clip(date(year, 1, 1), date(year, 12, 1), first, last, monthly)))
+        case "season":
+            for year in range(first.year - 1, last.year + 1):
+                for season, (low, high) in SEASONS.items():
+                    bucket_start = date(year, low, 1)
+                    bucket_end = add_steps(bucket_start, high - low, True)
+                    if bucket_end < first or bucket_start > last:
+                        continue
+                    buckets.append((f"{year}_{season}", _clip(bucket_start, bucket_end, first, last, monthly)))
+        case _:
+            raise ValueError(f"Unknown group_by '{group_by}'")
+    return buckets
+
+def _clip(bucket_start, bucket_end, first, last, monthly):
+    bucket_start = max(bucket_start, first)
+    if not monthly:
+        # Daily data - the bucket ends on the last day of its final month
+        bucket_end = add_steps(add_steps(bucket_end, 1, True), -1, False)
+    bucket_end = min(bucket_end, last)
+    return format_date(bucket_start, monthly), format_date(bucket_end, monthly)
+
+class SummaryQuery(str):
+    """
+    WCPS text of a summary query, usable like any other DataCube query.
+    parse() turns its result into a record (a namedtuple of the requested statistics),
+    or a dict of label -> record for grouped queries.
+    """
+    def __new__(cls, text, names, groups):
+        query = super().__new__(cls, text)
+        query.record = namedtuple('SummaryStats', names)
+        query.groups = groups
+        query.counts = {name for name in names if name == "count" or name.startswith("above_")}
+        return query
+
+    def parse(self, result):
+        values = decode_result(getattr(result, 'raw', result)).ravel()
+        size = len(self.record._fields)
+        records = []
+        for i in range(0, len(values), size):
+            stats = zip(self.record._fields, values[i:i + size])
+            records.append(self.record(*(int(v) if name in self.counts else v.item() for name, v in stats)))
+        if self.groups is None:
+            return records[0]
+        return dict(zip(self.groups, records))
+
+def summary_query(coverage, lat, long, ansi, aggregates, thresholds, group_by):
+    """
+    Builds the SummaryQuery behind DataCube.get_summary.
+    """
+    names = list(aggregates) + [threshold_name(t) for t in thresholds]
+    if group_by is None:
+        subsets = [("all", ansi)]
+        groups = None
+    else:
+        start, end = ansi.split('":"') if '":"' in ansi else ansi.split(':')
+        buckets = time_buckets(start, end, group_by)
+        subsets = [(label, f'"{low}":"{high}"') for label, (low, high) in buckets]
+        groups = [label for label, _ in buckets]
+
+    # Grouped queries slice every bucket out of the same Lat/Long series
+    point = Subset("$c", ("Lat", lat), ("Long", long))
+    fields = {}
+    for _, time_range in subsets:
+        if groups is None:
+            subset = Subset("$c", ("Lat", lat), ("Long", long), ("ansi", time_range))
+        else:
+            subset = Subset(point, ("ansi", time_range))
+        for func in aggregates:
+            # count is the number of cells; NaN cells are not equal to themselves
+            stat = Call("count", subset.eq(subset)) if func == "count" else Call(func, subset)
+            fields[f"f{len(fields)}"] = stat
+        for threshold in thresholds:
+            fields[f"f{len(fields)}"] = Call("count", subset > threshold)
+    text = Query(coverage, Struct(**fields)).compile()
+    return SummaryQuery(text, names, groups)
@@ -1,6 +1,39 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import types
 import unittest
-from wdc import WebDataConnector
-from main import DataCube
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+import numpy as np
+from rascode.wdc import WebDataConnector
+from rascode.main import DataCube
+from rascode.cache import QueryCache, normalize_query
+from rascode.batch import fold_point_queries
+from rascode.results import decode_result, QueryResult
+from rascode.netcdf import netcdf_array
+from rascode.tiling import split_extent, combine_aggregate
+from rascode.timeseries import chunk_dates, TimeSeriesFetcher
+from rascode.query import Query, Subset, Call, Encode, Expr, Literal
+from rascode.exceptions import DependencyError, OverloadError, QueryError, ServerError
+from rascode.metadata import CoverageMetadata, Axis
+from rascode.mockserver import MockWCPSServer, grid_values, make_netcdf, make_png, point_value
+from rascode.images import ImageResult, detect_image
+from rascode.dbc import DataBlockConnector
+from rascode.dbo import DatabaseOperation
+from rascode.instrumentation import Instrumentation, MetricsSink, Histogram
+from rascode.benchmark import bench_import
+from rascode.limiter import AIMDController, AdaptiveLimiter, RetryPolicy, is_overload
+from rascode.hedging import HedgePolicy, is_small_query
+from rascode.dag import OperationGraph
+from rascode.local import LocalEvaluator, classify
+from rascode.store import ChunkStore
+from rascode.fanout import build_queries, correlate
+from rascode.cli import main as cli_main, run_batch
 
 serverUrl = "https://ows.rasdaman.org/rasdaman/ows"
     
@@ -148,5 +181,950 @@ class TestDataCube(unittest.TestCase):
         dbo.pop_operation()
         self.assertIn(result, "Result: 9'", "Error")
 
+# Stands in for the DBC: answers each query with its own text after 'delay' seconds and
+# fails queries containing 'fail'; 'peak' is the most queries answered at once
+class FakeConnector:
+
+    url = "http://localhost/rasdaman/ows"
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.peak = 0
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def query(self, query, *args):
+        with self._track():
+            time.sleep(self.delay)
+            return self._answer(query)
+
+    @contextlib.contextmanager
+    def _track(self):
+        with self._lock:
+            self._active += 1
+            self.peak = max(self.peak, self._active)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    @staticmethod
+    def _answer(query):
+        if "fail" in query:
+            raise Exception(f"Error: 400, {query}")
+        return query.encode()
+
+class TestConcurrentMode(unittest.TestCase):
+
+    # Up to max_workers operations run at once; results come back in queue order with
+    # the exception of a failed operation in its slot
+    def test_concurrent_order(self):
+        connector = FakeConnector(delay=0.05)
+        concurrent_dbo = DatabaseOperation(connector)
+        for i in range(8):
+            concurrent_dbo.add_operation("fail 3" if i == 3 else f"query {i}")
+        results = concurrent_dbo.execute_all_operations(max_workers=4)
+        self.assertEqual(results[:3] + results[4:], [f"query {i}" for i in (0, 1, 2, 4, 5, 6, 7)], "Error")
+        self.assertIsInstance(results[3], Exception, "Error")
+        self.assertEqual(connector.peak, 4, "Error")
+
+    # Operations that have not started when cancel() is called hold a CancelledError
+    def test_cancel(self):
+        cancel_dbo = DatabaseOperation(FakeConnector(delay=0.2))
+        for i in range(6):
+            cancel_dbo.add_operation(f"query {i}")
+        threading.Timer(0.1, cancel_dbo.cancel).start()
+        results = cancel_dbo.execute_all_operations(max_workers=2)
+        self.assertEqual(results[:2], ["query 0", "query 1"], "Error")
+        self.assertTrue(all(isinstance(result, CancelledError) for result in results[2:]), "Error")
+
+# asyncio counterpart of FakeConnector, standing in for the ADBC
+class FakeAsyncConnector(FakeConnector):
+
+    async def query(self, query, *args):
+        with self._track():
+            await asyncio.sleep(self.delay)
+            return self._answer(query)
+
+class TestAsyncMode(unittest.TestCase):
+
+    # Queued operations are awaited together and come back in queue order, with the
+    # exception of a failed operation in its slot
+    def test_execute_all_async(self):
+        connector = FakeAsyncConnector(delay=0.05)
+        async_dbo = DatabaseOperation(FakeConnector(), connector)
+        for i in range(6):
+            async_dbo.add_operation("fail 2" if i == 2 else f"query {i}")
+        results = asyncio.run(async_dbo.execute_all_operations_async())
+        self.assertEqual(results[:2] + results[3:], [f"query {i}" for i in (0, 1, 3, 4, 5)], "Error")
+        self.assertIsInstance(results[2], Exception, "Error")
+        self.assertEqual(connector.peak, 6, "Error")
+        self.assertEqual(asyncio.run(async_dbo.execute_operation_async(1)), "query 0", "Error")
+
+class TestQueryCache(unittest.TestCase):
+
+    # Queries that only differ in layout share one cache entry
+    def test_normalize_query(self):
+        query = cube.get_avg(53.08, 8.80, '"2014-01":"2014-12"')
+        compact = 'for $c in (AvgLandTemp) return avg($c[Lat(53.08),Long(8.80),ansi("2014-01":"2014-12")])'
+        self.assertEqual(normalize_query(query), normalize_query(compact), "Error")
+        self.assertNotEqual(normalize_query('ansi("2014 -01")'), normalize_query('ansi("2014-01")'), "Error")
+        self.assertNotEqual(normalize_query('$c*10'), normalize_query('$c*10.0'), "Error")
+        self.assertEqual(normalize_query('$c*2.50'), '$c*2.5', "Error")
+        self.assertEqual(normalize_query('$c*10.0'), '$c*10.0', "Error")
+        self.assertEqual(normalize_query('$c[Lat( -5 )] - 273.15'), normalize_query('$c[Lat(-5)]-273.15'), "Error")
+        self.assertEqual(normalize_query('$c - -2.50'), '$c--2.5', "Error")
+        self.assertEqual(normalize_query('ansi("2014-01" : "2014-12")'), 'ansi("2014-01":"2014-12")', "Error")
+
+    # The least recently used entry is evicted first
+    def test_memory_lru(self):
+        cache = QueryCache(max_entries=2)
+        cache.put("q1", serverUrl, b"1")
+        cache.put("q2", serverUrl, b"2")
+        cache.get("q1", serverUrl)
+        cache.put("q3", serverUrl, b"3")
+        self.assertEqual(cache.get("q1", serverUrl), b"1", "Error")
+        self.assertIsNone(cache.get("q2", serverUrl), "Error")
+        self.assertEqual(cache.stats['evictions'], 1, "Error")
+
+    # Entries written to disk are found by a new cache on the same directory
+    def test_disk_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            QueryCache(directory).put("q1", serverUrl, b"1")
+            cache = QueryCache(directory)
+            self.assertEqual(cache.get("q1", serverUrl), b"1", "Error")
+            self.assertIsNone(cache.get("q1", "http://other"), "Error")
+            self.assertEqual(cache.stats['disk_hits'], 1, "Error")
+
+class TestPointBatching(unittest.TestCase):
+
+    # Point queries on one coverage are folded into one struct query, others are kept
+    def test_fold_point_queries(self):
+        ansi = '"2014-01":"2014-12"'
+        queries = [cube.get_single_value(53.08, 8.80, "2014-07"),
+                   cube.get_3d_to_1d_subset(53.08, 8.80, ansi),
+                   cube.get_avg(42.13, 3, ansi)]
+        batches = fold_point_queries(queries)
+        self.assertEqual([batch.indices for batch in batches], [[1], [0, 2]], "Error")
+        self.assertIn("p1: avg($c[Lat(42.13), Long(3), ansi(" + ansi + ")])", batches[1].query, "Error")
+        self.assertEqual(batches[1].split("{25.984251,21.528871536254883}"), ["25.984251", "21.528871536254883"], "Error")
+
+    # Every point gets its own value back in order; a failed batch is retried point by point
+    # so that only the failing point holds an error
+    def test_execute_batches(self):
+        ansi = '"2014-01":"2014-12"'
+        chloro = DataCube("AverageChloroColor")
+        points = [(cube, lat, 10) for lat in (1, 2, 3)] + [(chloro, 7, 20)] + \
+                 [(cube, lat, 10) for lat in (4, 5, 6)] + [(chloro, 8, 20)]
+        with MockWCPSServer(fail_on="Lat(5),") as server:
+            batch_wdc = WebDataConnector(server.url)
+            batch_dbo = batch_wdc.createDBO()
+            for point_cube, lat, long in points:
+                batch_dbo.add_operation(point_cube.get_avg(lat, long, ansi))
+            results = batch_dbo.execute_all_operations(max_workers=4, batch_points=True, max_points=3)
+            self.assertEqual(server.requests, 6, "Error")
+            for query in server.queries:
+                self.assertNotEqual("AvgLandTemp" in query, "AverageChloroColor" in query, "Error")
+                self.assertLessEqual(query.count("avg("), 3, "Error")
+            for (point_cube, lat, long), result in zip(points, results):
+                if lat == 5:
+                    self.assertIsInstance(result, ServerError, "Error")
+                elif lat in (4, 6):
+                    # Retried alone, answered with the mock's scalar value
+                    self.assertEqual(result, "25.984251", "Error")
+                else:
+                    self.assertEqual(float(result), point_value(lat, long), "Error")
+            self.assertEqual(batch_dbo.execute_points(chloro.get_avg, [(8, 20, ansi), (7, 20, ansi)]),
+                             ["8020.000000", "7020.000000"], "Error")
+            batch_wdc.close()
+
+class TestDecodeResult(unittest.TestCase):
+
+    # Scalars, CSV series and '{...}' arrays are decoded with the right dtype and shape
+    def test_decode_result(self):
+        self.assertEqual(decode_result(b"25.984251"), 25.984251, "Error")
+        self.assertEqual(decode_result(b"7").dtype.kind, "i", "Error")
+        series = decode_result(b"2.834646,4.488189,11.10236")
+        self.assertEqual((series.shape, series.dtype.kind), ((3,), "f"), "Error")
+        self.assertEqual(decode_result(b"{1,2,3},{4,5,6}").shape, (2, 3), "Error")
+        self.assertRaises(ValueError, decode_result, b"<html>")
+
+# Stands in for the requests session of the DBC: answers every query with 'body', handed
+# out in chunks; 'largest_chunk' is the biggest chunk read at once
+class FakeSession:
+
+    def __init__(self, body):
+        self.body = body
+        self.largest_chunk = 0
+        self.streamed = False
+
+    def post(self, url, params=None, stream=False, **kwargs):
+        self.streamed = stream
+        return FakeResponse(self, f"{url}?query={params['query']}")
+
+    def close(self):
+        pass
+
+class FakeResponse:
+
+    status_code = 200
+    headers = {}
+
+    def __init__(self, session, url):
+        self.session = session
+        self.request = types.SimpleNamespace(url=url)
+        self.raw = io.BytesIO(session.body)
+        self.content = self.text = session.body
+
+    def iter_content(self, chunk_size=1):
+        while True:
+            chunk = self.raw.read(chunk_size)
+            if not chunk:
+                return
+            self.session.largest_chunk = max(self.session.largest_chunk, len(chunk))
+            yield chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+class TestStreamingMode(unittest.TestCase):
+
+    # Results are streamed chunk by chunk to a path or a writer, or memory-mapped
+    def test_query_to(self):
+        body = bytes(range(256)) * 100
+        session = FakeSession(body)
+        stream_dbc = DataBlockConnector("http://localhost/rasdaman/ows", session=session)
+        stream_dbo = DatabaseOperation(stream_dbc)
+        stream_dbo.add_operation("for $c in (AvgLandTemp) return encode($c, \"netcdf\")")
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "result.nc")
+            self.assertEqual(stream_dbo.execute_operation_to(1, path, chunk_size=1000), len(body), "Error")
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), body, "Error")
+            writer = io.BytesIO()
+            self.assertEqual(stream_dbc.query_to(stream_dbo.operations[0], writer, chunk_size=1000), len(body), "Error")
+            self.assertEqual(writer.getvalue(), body, "Error")
+            mapped = stream_dbo.execute_operation_to(1, path, mmap=True, chunk_size=1000)
+            self.assertEqual(mapped[:], body, "Error")
+            mapped.close()
+        self.assertTrue(session.streamed, "Error")
+        self.assertEqual(session.largest_chunk, 1000, "Error")
+
+class TestTiling(unittest.TestCase):
+
+    grid = CoverageMetadata("Grid", "EPSG:4326", [
+        Axis("Lat", -90.0, 90.0, 18, 10.0), Axis("Long", -180.0, 180.0, 36, 10.0),
+        Axis("ansi", "2014-01", "2014-12", 12, coefficients=[f"2014-{m:02d}-01T00:00:00.000Z" for m in range(1, 13)])])
+
+    # Extents are split into disjoint tiles of whole cells, at most tile_size degrees each
+    def test_split_extent(self):
+        self.assertEqual(split_extent('0:10', 4, resolution=1), ['0.5:3.5', '4.5:7.5', '8.5:9.5'], "Error")
+        self.assertEqual(split_extent('35:75', 20, axis=self.grid.axis("Lat")), ['35.0:45.0', '55.0:65.0', '75.0:75.0'], "Error")
+        self.assertRaises(QueryError, split_extent, '35:75', 20)
+        self.assertRaises(QueryError, DataCube("Grid").tiled_aggregation, '35:75', '-10:30', '2014-07')
+
+    # Tiles stitched or aggregated on the grid of the coverage equal one untiled query
+    def test_execute_tiled(self):
+        cube = DataCube("Grid", metadata=self.grid)
+        with MockWCPSServer(grid=self.grid) as server:
+            tiled_wdc = WebDataConnector(server.url)
+            tiled_dbo = tiled_wdc.createDBO(image_dir=None)
+            def subset(lat, long):
+                return cube.generate_query(f'$c[Lat({lat}), Long({long}), ansi("2014-07")]', return_format="netcdf")
+            whole = tiled_dbo.execute_tiled(cube.tiled(subset, '-40:30', '-60:50', tile_size=30))
+            single = tiled_dbo.execute_tiled(cube.tiled(subset, '-40:30', '-60:50', tile_size=180))
+            self.assertEqual(whole.shape, (7, 11), "Error")
+            self.assertEqual(whole.tolist(), single.tolist(), "Error")
+            for func in ("add", "avg"):
+                query = cube.tiled_aggregation('-40:30', '-60:50', '2014-07', func, tile_size=30)
+                self.assertTrue(all(text.count("$c[") == 1 for text in query.queries), "Error")
+                tiled = tiled_dbo.execute_tiled(query)
+                untiled = decode_result(tiled_dbo.fetch_all([cube.spatial_aggregation('-40:30', '-60:50', '2014-07', func)])[0])
+                self.assertAlmostEqual(tiled, untiled, 6, "Error")
+            tiled_wdc.close()
+
+    # Partial averages are combined from their sums and cell counts
+    def test_combine_aggregate(self):
+        self.assertEqual(combine_aggregate("avg", [[10, 2], [20, 8]]), 3, "Error")
+        self.assertEqual(combine_aggregate("max", [1, 7, 3]), 7, "Error")
+
+class TestTimeSeries(unittest.TestCase):
+
+    # Date ranges are split into chunks of whole months or days
+    def test_chunk_dates(self):
+        self.assertEqual(chunk_dates('"2013-11"', '"2014-12"', 6),
+                         [('2013-11', '2014-04'), ('2014-05', '2014-10'), ('2014-11', '2014-12')], "Error")
+        self.assertEqual(chunk_dates('2016-02-28', '2016-03-01', 2),
+                         [('2016-02-28', '2016-02-29'), ('2016-03-01', '2016-03-01')], "Error")
+
+    # Chunks are joined in date order and a refresh only requests the steps after the stored end
+    def test_fetch_and_refresh(self):
+        def build_query(start, end):
+            return f'for $c in (Grid) return encode($c[Lat(5), Long(5), ansi("{start}":"{end}")], "application/netcdf")'
+        with MockWCPSServer(grid=TestTiling.grid) as server, tempfile.TemporaryDirectory() as directory:
+            series_wdc = WebDataConnector(server.url)
+            fetcher = TimeSeriesFetcher(series_wdc.createDBO(image_dir=None), build_query, chunk_size=5,
+                                        store=os.path.join(directory, "series.npz"))
+            self.assertEqual(fetcher.fetch("2014-01", "2014-12").tolist(), list(grid_values(9, 18, range(12))), "Error")
+            fetcher.refresh("2014-01", "2014-06")
+            sent = len(server.queries)
+            values = fetcher.refresh("2014-01", "2014-12")
+            self.assertEqual(values.tolist(), list(grid_values(9, 18, range(12))), "Error")
+            self.assertEqual(sorted(query[query.index("ansi"):] for query in server.queries[sent:]),
+                             ['ansi("2014-07":"2014-11")], "application/netcdf")',
+                              'ansi("2014-12":"2014-12")], "application/netcdf")'], "Error")
+            # The server rejects steps after 2014-12; with the metadata the refresh stops there
+            fetcher.chunk_size, fetcher.store = 24, os.path.join(directory, "short.npz")
+            with self.assertRaises(ServerError):
+                fetcher.refresh("2014-01", "2015-03")
+            self.assertIsNone(fetcher.load(), "Error")
+            fetcher.metadata = TestTiling.grid
+            self.assertEqual(len(fetcher.refresh("2014-01", "2015-03")), 12, "Error")
+            self.assertEqual(fetcher.load()[1], "2014-12", "Error")
+            series_wdc.close()
+
+class TestQueryCompiler(unittest.TestCase):
+
+    # A subset used several times is computed once in a let binding
+    def test_common_subexpression(self):
+        query = cube.get_on_the_fly_coloring('35:75', '-20:40', "2014-07")
+        self.assertIn('let $v0 := $c[ansi("2014-07"), Lat(35:75), Long(-20:40)] return', query, "Error")
+        self.assertEqual(query.count("$c["), 1, "Error")
+
+    # Integer and float literals are different nodes, so they compile and cache apart
+    def test_literal_types(self):
+        point = Subset("$c", ("Lat", 53.08), ("Long", 8.80))
+        self.assertNotEqual(Literal(1), Literal(1.0), "Error")
+        self.assertTrue(Query("AvgLandTemp", point + 1).compile().endswith("] + 1"), "Error")
+        self.assertTrue(Query("AvgLandTemp", point + 1.0).compile().endswith("] + 1.0"), "Error")
+        self.assertRaises(TypeError, Expr)
+
+    # Malformed queries are rejected before they are sent
+    def test_validation(self):
+        point = Subset("$c", ("Lat", 53.08), ("Long", 8.80))
+        self.assertRaises(QueryError, Query("AvgLandTemp", Call("median", point)).compile)
+        self.assertRaises(QueryError, Query("AvgLandTemp", Encode(point, "text/unknown")).compile)
+        self.assertRaises(QueryError, Query("AvgLandTemp", Subset("$c")).compile)
+
+class TestSummary(unittest.TestCase):
+
+    # All statistics come from one struct query over one shared subset
+    def test_summary(self):
+        query = cube.get_summary(53.08, 8.80, '"2014-01":"2014-12"')
+        self.assertEqual(query.count("$c["), 1, "Error")
+        stats = query.parse(b"{2.2834647,25.984251,15.052493472894033,12,7}")
+        self.assertEqual((stats.max, stats.count, stats.above_15), (25.984251, 12, 7), "Error")
+
+    # Grouped statistics are returned per time bucket
+    def test_summary_by_season(self):
+        query = cube.get_summary(53.08, 8.80, '"2014-01":"2014-12"', ("avg",), (), group_by="season")
+        self.assertEqual(query.groups, ['2013_winter', '2014_spring', '2014_summer', '2014_autumn', '2014_winter'], "Error")
+        self.assertIn('ansi("2014-03":"2014-05")', query, "Error")
+
+class TestCoverageMetadata(unittest.TestCase):
+
+    metadata = CoverageMetadata("AvgLandTemp", "EPSG:4326", [
+        Axis("Lat", -90.0, 90.0, 1800, 0.1),
+        Axis("Long", -180.0, 180.0, 3600, 0.1),
+        Axis("ansi", "2000-02-01T00:00:00.000Z", "2015-06-01T00:00:00.000Z", 185)])
+
+    # Subsets outside of the coverage extent are rejected before a query is built
+    def test_validation(self):
+        checked = DataCube("AvgLandTemp", metadata=self.metadata)
+        self.assertIn("Lat(53.08)", checked.get_avg(53.08, 8.80, '"2014-01":"2014-12"'), "Error")
+        self.assertRaises(QueryError, checked.get_avg, 95, 8.80, '"2014-01":"2014-12"')
+        self.assertRaises(QueryError, checked.get_avg, 53.08, 8.80, '"2016-01":"2016-12"')
+        self.assertIn("Lat(53.08)", checked.get_data_series(53.08, 8.80, "2014-01", "2014-12", "P1M"), "Error")
+        self.assertRaises(QueryError, checked.get_data_series, 53.08, 8.80, "2015-01", "2015-12", "P1M")
+        self.assertIn("ansi('2014-06:08')", checked.extract_seasonal_data(53.08, 8.80, "summer", 2014), "Error")
+        self.assertRaises(QueryError, checked.extract_seasonal_data, 95, 8.80, "summer", 2014)
+        self.assertRaises(QueryError, checked.extract_seasonal_data, 53.08, 8.80, "winter", 2015)
+
+    # Point coordinates are snapped to the grid and oversized subsets are rejected
+    def test_snap_and_size(self):
+        checked = DataCube("AvgLandTemp", metadata=self.metadata, snap=True, max_bytes=10**6)
+        self.assertIn("Lat(53.05), Long(8.85)", checked.get_single_value(53.08, 8.80, '"2014-07"'), "Error")
+        self.assertRaises(QueryError, checked.get_3d_to_2d_subset, '"2014-07"')
+
+    # Failed DescribeCoverage requests are retried and raise a ServerError
+    def test_describe_error(self):
+        with MockWCPSServer(error_rate=1.0) as server:
+            describe_wdc = WebDataConnector(server.url, retry=RetryPolicy(attempts=2, base=0.01))
+            with self.assertRaises(ServerError) as raised:
+                describe_wdc.describe_coverage("AvgLandTemp")
+            self.assertEqual((raised.exception.status, server.requests), (500, 2), "Error")
+            describe_wdc.close()
+
+class TestMockServer(unittest.TestCase):
+
+    # The mock server answers each kind of query with a matching payload
+    def test_answers(self):
+        with MockWCPSServer(series_length=5) as server:
+            dbc = DataBlockConnector(server.url)
+            self.assertEqual(dbc.query(cube.get_avg(53.08, 8.80, '"2014-01":"2014-12"')), b"25.984251", "Error")
+            self.assertEqual(decode_result(dbc.query(cube.get_3d_to_1d_subset(53.08, 8.80, '"2014-01":"2014-12"'))).shape, (5,), "Error")
+            self.assertTrue(dbc.query(cube.get_3d_to_2d_subset('"2014-07"')).startswith(b"\x89PNG"), "Error")
+            dbc.close()
+            self.assertEqual(server.requests, 3, "Error")
+
+    # DBOs of one WDC share its session, sequential queries reuse one kept-alive connection
+    def test_connection_reuse(self):
+        with MockWCPSServer() as server:
+            reuse_wdc = WebDataConnector(server.url)
+            first_dbo, second_dbo = reuse_wdc.createDBO(), reuse_wdc.createDBO()
+            self.assertIs(first_dbo.dbc.session, second_dbo.dbc.session, "Error")
+            for lat in range(5):
+                for reuse_dbo in (first_dbo, second_dbo):
+                    reuse_dbo.add_operation(cube.get_avg(lat, 8.80, '"2014-01":"2014-12"'))
+                    reuse_dbo.execute_operation(len(reuse_dbo.operations))
+            self.assertEqual((server.requests, server.connections), (10, 1), "Error")
+            reuse_wdc.close()
+
+class TestInstrumentation(unittest.TestCase):
+
+    # Every query is traced with its phases, bytes and cache outcome
+    def test_metrics(self):
+        sink = MetricsSink()
+        with MockWCPSServer() as server:
+            wdc = WebDataConnector(server.url, cache=QueryCache(), instrumentation=Instrumentation(sink))
+            dbo = wdc.createDBO()
+            dbo.add_operation(cube.get_avg(53.08, 8.80, '"2014-01":"2014-12"'))
+            dbo.execute_operation(1)
+            dbo.execute_operation(1)
+            wdc.close()
+        metrics = sink.snapshot()
+        self.assertEqual(metrics["counters"]["queries"], 2, "Error")
+        self.assertEqual((metrics["counters"]["cache_hits"], metrics["counters"]["cache_misses"]), (1, 1), "Error")
+        self.assertEqual(metrics["counters"]["bytes"], len(b"25.984251"), "Error")
+        self.assertEqual(metrics["latency"]["wait"]["count"], 1, "Error")
+        self.assertEqual(metrics["latency"]["total"]["count"], 2, "Error")
+
+    # Percentiles are accurate to one logarithmic bucket
+    def test_histogram(self):
+        histogram = Histogram()
+        for i in range(1, 101):
+            histogram.add(i / 1000)
+        self.assertAlmostEqual(histogram.percentile(50), 0.05, delta=0.05 * 0.26, msg="Error")
+        self.assertEqual(histogram.percentile(100), 0.1, "Error")
+
+class TestImageResults(unittest.TestCase):
+
+    # Image formats are detected from their magic bytes
+    def test_detect_image(self):
+        self.assertEqual(detect_image(make_png(2, 2)), "image/png", "Error")
+        self.assertEqual(detect_image(b"\xff\xd8\xff\xe0"), "image/jpeg", "Error")
+        self.assertIsNone(detect_image(b"25.984251"), "Error")
+
+    # Image results are written unchanged in the background and decoded only on request
+    def test_image_result(self):
+        with MockWCPSServer(image_size=(8, 4)) as server, tempfile.TemporaryDirectory() as directory:
+            wdc = WebDataConnector(server.url)
+            dbo = wdc.createDBO(image_dir=directory)
+            dbo.add_operation(cube.get_3d_to_2d_subset('"2014-07"'))
+            image = dbo.execute_all_operations()[0]
+            wdc.close()
+            self.assertIsInstance(image, ImageResult, "Error")
+            with open(image.path, "rb") as f:
+                self.assertEqual(f.read(), make_png(8, 4), "Error")
+            self.assertEqual(image.array.shape, (4, 8), "Error")
+
+    # Image writer threads are stopped by WDC.close, or after the run of a DBO without a WDC
+    def test_image_writer_threads(self):
+        def writers():
+            return [thread for thread in threading.enumerate() if thread.name.startswith("image-writer")]
+        with MockWCPSServer() as server, tempfile.TemporaryDirectory() as directory:
+            writer_wdc = WebDataConnector(server.url)
+            for _ in range(3):
+                writer_dbo = writer_wdc.createDBO(image_dir=directory)
+                writer_dbo.add_operation(cube.get_3d_to_2d_subset('"2014-07"'))
+                writer_dbo.execute_all_operations()
+            self.assertLessEqual(len(writers()), 1, "Error")
+            writer_wdc.close()
+            self.assertEqual(writers(), [], "Error")
+            own_dbo = DatabaseOperation(writer_wdc.dbc, image_dir=directory)
+            own_dbo.add_operation(cube.get_3d_to_2d_subset('"2014-07"'))
+            self.assertTrue(os.path.exists(own_dbo.execute_all_operations()[0].path), "Error")
+            self.assertEqual(writers(), [], "Error")
+            writer_wdc.close()
+
+class TestBinaryFormats(unittest.TestCase):
+
+    # netCDF and JSON results are decoded straight to arrays, fill values become NaN
+    def test_decode_binary(self):
+        raw = make_netcdf("AvgLandTemp", [[1.5, -9999.0], [2.5, 3.5]], ("Lat", "Long"), fill_value=-9999.0)
+        values = decode_result(raw)
+        self.assertEqual((values.dtype.name, values.shape), ("float32", (2, 2)), "Error")
+        self.assertTrue(np.isnan(values[0, 1]), "Error")
+        self.assertEqual(decode_result(b"[[1,2],[3,4]]").tolist(), [[1, 2], [3, 4]], "Error")
+        self.assertTrue(np.isnan(decode_result(b"[1.5,null]")[1]), "Error")
+
+    # Output formats are given by MIME type or short name; unknown short names are rejected,
+    # MIME types the library does not know are passed through
+    def test_output_format(self):
+        self.assertIn('"application/netcdf"', cube.get_3d_to_1d_subset(53.08, 8.80, '"2014-01":"2014-12"', "netcdf"), "Error")
+        self.assertTrue(cube.get_data_series(53.08, 8.80, "2014-01", "2014-12", "P1M").startswith("diagram>>"), "Error")
+        self.assertRaises(QueryError, cube.get_data_series, 53.08, 8.80, "2014-01", "2014-12", "P1M", "netcfd")
+        self.assertIn('"image/gif"', cube.get_3d_to_2d_subset('"2014-07"', "image/gif"), "Error")
+
+    # Typed DBOs return GeoTIFF results as NumPy-backed QueryResults, not as images to write
+    def test_geotiff_typed(self):
+        tiff = b"II*\x00" + bytes(16)
+        self.assertIsInstance(DatabaseOperation(None, typed=True, image_dir=None)._process_result(1, tiff),
+                              QueryResult, "Error")
+        self.assertIsInstance(DatabaseOperation(None, image_dir=None)._process_result(1, tiff), ImageResult, "Error")
+
+    # Compressed responses are decompressed transparently
+    def test_compression(self):
+        query = cube.get_3d_to_1d_subset(53.08, 8.80, '"2014-01":"2014-12"')
+        with MockWCPSServer(series_length=1000, compress=True) as server:
+            plain = DataBlockConnector(server.url, compress=False)
+            compressed = DataBlockConnector(server.url)
+            self.assertEqual(plain.query(query), compressed.query(query), "Error")
+            plain.close()
+            compressed.close()
+            self.assertLess(server.bytes_sent, 2 * 1000 * 10, "Error")
+
+def struct_query(fields):
+    # The mock answers a struct of n fields with "{20,21,...}", so results tell queries apart
+    return "for $c in (AvgLandTemp) return {" + "; ".join(f"f{i}: 1" for i in range(fields)) + "}"
+
+class TestConcurrentExecution(unittest.TestCase):
+
+    # Results come back in queue order whatever order the queries finish in
+    def test_order(self):
+        with MockWCPSServer(latency=0.01, jitter=0.05) as server:
+            order_wdc = WebDataConnector(server.url)
+            order_dbo = order_wdc.createDBO()
+            for fields in range(1, 9):
+                order_dbo.add_operation(struct_query(fields))
+            for max_workers in (1, 8):
+                results = order_dbo.execute_all_operations(max_workers=max_workers)
+                self.assertEqual([len(r.strip("{}").split(",")) for r in results], list(range(1, 9)), "Error")
+            order_wdc.close()
+
+    # A failing operation holds its error, in both modes, and the others still run
+    def test_error_isolation(self):
+        with MockWCPSServer(fail_on="f3: 1}") as server:
+            error_wdc = WebDataConnector(server.url)
+            error_dbo = error_wdc.createDBO()
+            for fields in range(1, 7):
+                error_dbo.add_operation(struct_query(fields))
+            for max_workers in (1, 4):
+                results = error_dbo.execute_all_operations(max_workers=max_workers)
+                self.assertIsInstance(results[3], ServerError, "Error")
+                self.assertEqual(sum(isinstance(r, str) for r in results), 5, "Error")
+            error_wdc.close()
+
+    # Operations that have not started when cancel() is called are not sent
+    def test_cancel(self):
+        with MockWCPSServer(latency=0.2) as server:
+            cancel_wdc = WebDataConnector(server.url)
+            cancel_dbo = cancel_wdc.createDBO()
+            for fields in range(1, 9):
+                cancel_dbo.add_operation(struct_query(fields))
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                future = executor.submit(cancel_dbo.execute_all_operations, 2)
+                time.sleep(0.05)
+                cancel_dbo.cancel()
+                results = future.result()
+            self.assertTrue(all(isinstance(r, str) for r in results[:2]), "Error")
+            self.assertTrue(all(isinstance(r, CancelledError) for r in results[2:]), "Error")
+            self.assertEqual(server.requests, 2, "Error")
+            cancel_wdc.close()
+
+class TestAsync(unittest.TestCase):
+
+    def run_async(self, server, operations, **options):
+        async_wdc = WebDataConnector(server.url, **options)
+        async_dbo = async_wdc.createDBO()
+        for operation in operations:
+            async_dbo.add_operation(operation)
+
+        async def run():
+            try:
+                return await async_dbo.execute_all_operations_async()
+            finally:
+                await async_wdc.aclose()
+        results = asyncio.run(run())
+        async_wdc.close()
+        return results
+
+    # Results come back in queue order, a failed operation holds its exception
+    def test_order_and_errors(self):
+        with MockWCPSServer(latency=0.01, jitter=0.05, fail_on="f3: 1}") as server:
+            results = self.run_async(server, [struct_query(fields) for fields in range(1, 9)], timeout=10)
+        self.assertIsInstance(results[3], ServerError, "Error")
+        self.assertEqual([len(r.strip("{}").split(",")) for i, r in enumerate(results) if i != 3],
+                         [1, 2, 3, 5, 6, 7, 8], "Error")
+
+    # No more than max_in_flight requests reach the server at once
+    def test_max_in_flight(self):
+        with MockWCPSServer(latency=0.05, capacity=3) as server:
+            results = self.run_async(server, [struct_query(fields) for fields in range(1, 13)], max_in_flight=3)
+            self.assertTrue(all(isinstance(r, str) for r in results), "Error")
+            self.assertEqual(server.rejected, 0, "Error")
+            self.assertLessEqual(server.peak, 3, "Error")
+
+    # Identical queries awaited together share one request
+    def test_coalescing(self):
+        with MockWCPSServer(latency=0.1) as server:
+            results = self.run_async(server, [struct_query(2)] * 6)
+            self.assertEqual(server.requests, 1, "Error")
+            self.assertEqual(results, ["{20,21}"] * 6, "Error")
+
+class TestStreaming(unittest.TestCase):
+
+    # Results are streamed to a path, a writer or a memory map
+    def test_query_to(self):
+        query = cube.get_3d_to_1d_subset(53.08, 8.80, '"2014-01":"2014-12"', output_format="netcdf")
+        with MockWCPSServer(series_length=24) as server, tempfile.TemporaryDirectory() as directory:
+            stream_wdc = WebDataConnector(server.url)
+            stream_dbo = stream_wdc.createDBO()
+            stream_dbo.add_operation(query)
+            path = os.path.join(directory, "series.nc")
+            written = stream_dbo.execute_operation_to(1, path)
+            self.assertEqual(os.listdir(directory), ["series.nc"], "Error")
+            self.assertEqual(os.path.getsize(path), written, "Error")
+            writer = io.BytesIO()
+            self.assertEqual(stream_dbo.execute_operation_to(1, writer), written, "Error")
+            with open(path, "rb") as f:
+                self.assertEqual(writer.getvalue(), f.read(), "Error")
+            mapped = stream_dbo.execute_operation_to(1, path, mmap=True)
+            values = netcdf_array(mapped)
+            self.assertEqual((values.shape, values.dtype.kind), ((24,), "f"), "Error")
+            mapped.close()
+            stream_wdc.close()
+
+    # A failed query raises ServerError and leaves an existing file as it was, with no partial file
+    def test_query_to_error(self):
+        with MockWCPSServer(fail_on="Lat") as server, tempfile.TemporaryDirectory() as directory:
+            stream_dbc = DataBlockConnector(server.url)
+            path = os.path.join(directory, "result.csv")
+            with open(path, "wb") as f:
+                f.write(b"old")
+            with self.assertRaises(ServerError):
+                stream_dbc.query_to(cube.get_3d_to_1d_subset(53.08, 8.80, '"2014-01":"2014-12"'), path)
+            with self.assertRaises(ServerError):
+                stream_dbc.query_to(cube.get_avg(53.08, 8.80, '"2014-01":"2014-12"'), io.BytesIO())
+            stream_dbc.close()
+
+            # A download broken off halfway is not written over the file either
+            class BrokenConnector(DataBlockConnector):
+                @staticmethod
+                def _copy(response, writer, chunk_size, trace=None):
+                    writer.write(b"partial")
+                    raise OSError("Connection dropped")
+            broken_dbc = BrokenConnector(server.url)
+            with self.assertRaises(OSError):
+                broken_dbc.query_to(cube.most_basic_query(), path)
+            broken_dbc.close()
+            self.assertEqual(os.listdir(directory), ["result.csv"], "Error")
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"old", "Error")
+
+class TestCoalescing(unittest.TestCase):
+
+    # Identical queries sent at the same time share one request, and its error
+    def test_single_flight(self):
+        query = cube.get_3d_to_2d_subset('"2014-07"')
+        with MockWCPSServer(latency=0.2) as server:
+            dbc = DataBlockConnector(server.url)
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(executor.map(lambda _: dbc.query(query), range(8)))
+            self.assertEqual(server.requests, 1, "Error")
+            self.assertTrue(all(result is results[0] for result in results), "Error")
+            server.error_rate = 1.0
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                futures = [executor.submit(dbc.query, query) for _ in range(4)]
+            self.assertEqual(server.requests, 1 + dbc.retry.attempts, "Error")
+            errors = [future.exception() for future in futures]
+            self.assertTrue(all(isinstance(error, ServerError) and error.status == 500 for error in errors), "Error")
+            self.assertEqual(len({id(error) for error in errors}), 4, "Error")
+            dbc.close()
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+
+    # Overload halves the limit once per window, successes raise it again
+    def test_aimd(self):
+        controller = AIMDController(initial=8, max_limit=16)
+        started = 0.0
+        controller.on_overload(started)
+        controller.on_overload(started)
+        self.assertEqual(controller.slots, 4, "Error")
+        controller.on_success(float('inf'), 0.01)
+        self.assertEqual(controller.limit, 4.25, "Error")
+
+    # 5xx answers and a smoothed latency well above the baseline count as overload
+    def test_overload_signals(self):
+        self.assertTrue(is_overload(ServerError("Error: 500", 500)), "Error")
+        self.assertFalse(is_overload(ServerError("Error: 400", 400)), "Error")
+        controller = AIMDController(initial=8, max_limit=16, smoothing=1.0)
+        controller.on_success(0.0, 0.01)
+        self.assertEqual(controller.slots, 9, "Error")
+        controller.on_success(1.0, 0.1)
+        self.assertEqual(controller.slots, 4, "Error")
+
+    # Callers beyond the queue bound get an OverloadError
+    def test_backpressure(self):
+        limiter = AdaptiveLimiter(max_queue=0, initial=1)
+        started = limiter.acquire()
+        with self.assertRaises(OverloadError):
+            limiter.acquire()
+        limiter.release(started, ok=True)
+        limiter.release(limiter.acquire(), ok=True)
+
+    # A server rejecting load beyond its capacity still answers every query
+    def test_capacity(self):
+        with MockWCPSServer(latency=0.02, capacity=4) as server:
+            dbc = DataBlockConnector(server.url, pool_maxsize=16,
+                                     retry=RetryPolicy(attempts=20, base=0.01, cap=0.2, seed=0))
+            queries = [f"for $c in (AvgLandTemp) return {i}" for i in range(100)]
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                results = list(executor.map(dbc.query, queries))
+            self.assertEqual(results, [b'25.984251'] * 100, "Error")
+            self.assertLess(dbc.limiter.controller.slots, 16, "Error")
+            dbc.close()
+
+    # The default limiter starts at pool_maxsize, so max_workers queries are in flight at
+    # once with it as without it
+    def test_max_workers(self):
+        for limiter in (True, None):
+            with MockWCPSServer(latency=0.3) as server:
+                workers_wdc = WebDataConnector(server.url, pool_maxsize=16, limiter=limiter)
+                workers_dbo = workers_wdc.createDBO(image_dir=None)
+                workers_dbo.fetch_all([f"for $c in (AvgLandTemp) return {i}" for i in range(16)], max_workers=16)
+                self.assertEqual(server.peak, 16, "Error")
+                workers_wdc.close()
+
+class TestHedging(unittest.TestCase):
+
+    # Only queries with scalar results are hedged
+    def test_small_queries(self):
+        self.assertTrue(is_small_query(cube.get_avg(53.08, 8.80, '"2014-01":"2014-12"')), "Error")
+        self.assertTrue(is_small_query(cube.get_single_value(53.08, 8.80, '"2014-01"')), "Error")
+        self.assertFalse(is_small_query(cube.get_3d_to_2d_subset('"2014-07"')), "Error")
+        self.assertFalse(is_small_query(cube.get_on_the_fly_coloring(53.08, 8.80, '"2014-07"')), "Error")
+
+    # Duplicates are limited by the budget
+    def test_budget(self):
+        policy = HedgePolicy(min_samples=2, budget=0.5, burst=1)
+        for latency in (0.01, 0.02, 0.03):
+            policy.record(latency)
+        self.assertEqual(policy.delay(), 0.03, "Error")
+        self.assertFalse(policy.acquire(), "Error")
+        policy.delay()
+        self.assertTrue(policy.acquire(), "Error")
+        self.assertFalse(policy.acquire(), "Error")
+
+    # Slow requests are answered by their duplicate
+    def test_tail(self):
+        with MockWCPSServer(latency=0.005, slow_rate=0.1, slow_latency=0.5, seed=3) as server:
+            dbc = DataBlockConnector(server.url, hedge=HedgePolicy(percentile=50, min_samples=10, budget=1.0))
+            for i in range(60):
+                start = time.perf_counter()
+                self.assertEqual(dbc.query(cube.get_avg(53.08 + i / 100, 8.80, '"2014-01"')), b'25.984251', "Error")
+                if i >= 10:
+                    self.assertLess(time.perf_counter() - start, 0.25, "Error")
+            self.assertGreater(dbc.hedge.sent, 0, "Error")
+            dbc.close()
+
+class TestOperationGraph(unittest.TestCase):
+
+    # Results flow downstream, independent branches overlap and identical queries are sent once
+    def test_execute_graph(self):
+        ansi = '"2014-01":"2014-12"'
+        with MockWCPSServer(latency=0.1) as server:
+            wdc = WebDataConnector(server.url)
+            graph_dbo = wdc.createDBO(image_dir=None)
+            graph_dbo.add_operation(cube.get_min(53.08, 8.80, ansi))
+            for i in range(3):
+                graph_dbo.add_node(f"avg{i}", cube.get_avg(53.08 + i, 8.80, ansi))
+                graph_dbo.add_step(f"threshold{i}", lambda avg: float(avg) + 1, after=[f"avg{i}"])
+                graph_dbo.add_node(f"series{i}", lambda threshold, i=i: cube.get_celsius_to_kelvin(
+                    53.08 + i + threshold / 100, 8.80, ansi), after=[f"threshold{i}"])
+            graph_dbo.add_node("same", cube.get_avg(53.08, 8.80, ansi), after=[1])
+            start = time.perf_counter()
+            results = graph_dbo.execute_graph()
+            self.assertLess(time.perf_counter() - start, 0.35, "Error")
+            self.assertEqual(server.requests, 7, "Error")
+            self.assertEqual(results["threshold0"], 26.984251, "Error")
+            self.assertEqual(results["same"], results["avg0"], "Error")
+            self.assertEqual(len(results["series2"].split(',')), 12, "Error")
+            wdc.close()
+
+    # Failures are passed on to dependent operations, cycles are refused
+    def test_errors(self):
+        graph = OperationGraph()
+        graph.add("query", "for $c in (AvgLandTemp) return 1")
+        graph.add_step("step", lambda value: value, after=["query"])
+        results = graph.run(lambda query, name: 1 / 0)
+        self.assertIsInstance(results["query"], ZeroDivisionError, "Error")
+        self.assertIsInstance(results["step"], DependencyError, "Error")
+        graph.add("cycle", "for $c in (AvgLandTemp) return 2", after=["cycle"])
+        with self.assertRaises(ValueError):
+            graph.run(lambda query, name: query)
+
+class TestLocalEvaluation(unittest.TestCase):
+
+    # Derived queries are computed from a series fetched before
+    def test_derived_queries(self):
+        ansi = '"2014-01":"2014-12"'
+        local = LocalEvaluator()
+        series = b'2.83,4.48,7.2,10.1,15.2,18.3,20.1,19.8,15.5,11.0,6.2,3.1'
+        self.assertTrue(local.learn(cube.get_3d_to_1d_subset(53.08, 8.80, ansi), series), "Error")
+        self.assertEqual(local.evaluate(cube.get_max(53.08, 8.80, ansi)), b'20.1', "Error")
+        self.assertEqual(local.evaluate(cube.get_when_temp_more_than_15(53.08, 8.80, ansi)), b'5', "Error")
+        self.assertEqual(local.evaluate(cube.get_single_value(53.08, 8.80, '"2014-07"')), b'20.1', "Error")
+        self.assertEqual(local.evaluate(cube.get_avg(53.08, 8.80, '"2014-06":"2014-08"')), b'19.4', "Error")
+        self.assertEqual(local.evaluate(cube.difference_between_dates(53.08, 8.80, '2014-07', '2014-01')),
+                         b'17.27', "Error")
+        self.assertEqual(local.evaluate(cube.get_celsius_to_kelvin(53.08, 8.80, ansi)).split(b',')[0],
+                         b'275.98', "Error")
+        self.assertEqual(local.evaluate(cube.get_summary(53.08, 8.80, ansi, aggregates=("min", "count"))),
+                         b'{2.83,12,5}', "Error")
+        self.assertEqual(classify([5, 15, 25], [10, 20]).tolist(), [1, 2, 0], "Error")
+        self.assertEqual(local.evaluate(cube.classify_data([10, 20], 53.08, 8.80, ansi)),
+                         b'1,1,1,2,2,2,0,2,2,2,1,1', "Error")
+        self.assertIsNone(local.evaluate(cube.classify_data([10, 20])), "Error")
+
+    # Queries outside the held series or needing other encodings go to the server
+    def test_fallback(self):
+        ansi = '"2014-01":"2014-12"'
+        with MockWCPSServer() as server:
+            local_wdc = WebDataConnector(server.url, local=LocalEvaluator())
+            local_dbo = local_wdc.createDBO()
+            local_dbo.add_operation(cube.get_3d_to_1d_subset(53.08, 8.80, ansi))
+            local_dbo.add_operation(cube.get_min(53.08, 8.80, ansi))
+            local_dbo.add_operation(cube.get_min(53.08, 8.80, '"2013-01":"2014-12"'))
+            local_dbo.add_operation(cube.get_3d_to_1d_subset(53.08, 8.80, ansi, output_format="netcdf"))
+            results = local_dbo.execute_all_operations()
+            self.assertEqual(server.requests, 3, "Error")
+            self.assertEqual(results[1], "20.0", "Error")
+            self.assertEqual(local_wdc.local.hits, 1, "Error")
+            local_wdc.close()
+
+class TestChunkStore(unittest.TestCase):
+
+    grid = CoverageMetadata("Grid", "EPSG:4326", [
+        Axis("Lat", -90.0, 90.0, 18, 10.0), Axis("Long", -180.0, 180.0, 36, 10.0),
+        Axis("ansi", "2014-01", "2014-12", 12, coefficients=[f"2014-{m:02d}-01T00:00:00.000Z" for m in range(1, 13)])])
+
+    # Subsets are assembled from stored chunks, only missing chunks are fetched
+    def test_read(self):
+        with MockWCPSServer(grid=self.grid) as server, tempfile.TemporaryDirectory() as root:
+            store_wdc = WebDataConnector(server.url)
+            store = ChunkStore(root, self.grid, store_wdc.createDBO(image_dir=None),
+                               chunks={"Lat": 4, "Long": 8, "ansi": 6})
+            values = store.read(Lat="5:25", Long="-175:-165", ansi='"2014-02":"2014-03"')
+            expected = grid_values(*np.meshgrid(range(9, 12), range(0, 2), range(1, 3), indexing="ij"))
+            self.assertTrue(np.array_equal(values, expected), "Error")
+            self.assertEqual(server.requests, 1, "Error")
+            series = store.read(Lat=12, Long=-172, ansi='"2014-01":"2014-06"')
+            self.assertEqual(series.tolist(), list(grid_values(10, 0, range(6))), "Error")
+            self.assertEqual(server.requests, 1, "Error")
+            store.read(Lat="5:45")
+            self.assertEqual(store.fetched, 2 * 5 * 2, "Error")
+            store_wdc.close()
+
+            # Stored chunks are read without a connection
+            offline = ChunkStore.open(root, "Grid")
+            self.assertTrue(np.array_equal(offline.read(Lat="5:25", Long="-175:-165", ansi='"2014-02":"2014-03"'),
+                                           values), "Error")
+            with self.assertRaises(QueryError):
+                offline.read(Lat="-85:-75")
+
+    # Stores only hold floating point values, as missing cells are NaN
+    def test_dtype(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.assertRaises(QueryError, ChunkStore, root, self.grid, dtype="int16")
+            self.assertEqual(ChunkStore(root, self.grid, dtype="float64").dtype, np.float64, "Error")
+
+class TestFanOut(unittest.TestCase):
+
+    # One template over several coverages and locations gives one aligned array
+    def test_fan_out(self):
+        coverages = ["AvgLandTemp", "AverageChloroColor", "C3S_satellite_soil_moisture_active_daily_t0"]
+        locations = [(53.08, 8.80), (40.42, -3.70)]
+        with MockWCPSServer() as server:
+            fan_wdc = WebDataConnector(server.url)
+            result = fan_wdc.createDBO().fan_out("get_3d_to_1d_subset", coverages, locations, '"2014-01":"2014-12"')
+            self.assertEqual(result.values.shape, (3, 2, 12), "Error")
+            self.assertEqual(server.requests, 6, "Error")
+            self.assertEqual(result.series("AvgLandTemp", (40.42, -3.70))[0], 20.0, "Error")
+            averages = fan_wdc.createDBO().fan_out(
+                "for $c in ($coverage) return avg($c[Lat($lat), Long($long), ansi($ansi)])",
+                coverages, locations, ansi='"2014-01":"2014-12"')
+            self.assertEqual(averages.values.shape, (3, 2), "Error")
+            self.assertIn("for $c in (AvgLandTemp) return avg($c[Lat(53.08), Long(8.8), ansi(\"2014-01\":\"2014-12\")])",
+                          server.queries, "Error")
+            fan_wdc.close()
+
+    # Braces of WCPS structs in a text template are sent as they are
+    def test_struct_template(self):
+        queries = build_queries("for $c in ($coverage) return {low: min($c[Lat($lat), Long($long)]); "
+                                "high: max($c[Lat($lat), Long($long)])}", ["AvgLandTemp"], [(53.08, 8.80)])
+        self.assertEqual(queries, ["for $c in (AvgLandTemp) return {low: min($c[Lat(53.08), Long(8.8)]); "
+                                   "high: max($c[Lat(53.08), Long(8.8)])}"], "Error")
+
+    # Correlations of every coverage pair at every location, skipping missing steps
+    def test_correlate(self):
+        values = np.random.default_rng(0).random((3, 4, 50))
+        values[1] = 2 * values[0] + 1
+        values[2, 1] = np.nan
+        values[2, 1, :10] = values[0, 1, :10] * -3
+        result = correlate(values)
+        self.assertEqual(result.shape, (4, 3, 3), "Error")
+        self.assertTrue(np.allclose(result[:, 0, 1], 1), "Error")
+        self.assertTrue(np.isclose(result[1, 0, 2], -1), "Error")
+        self.assertTrue(np.isclose(result[0, 0, 2], np.corrcoef(values[0, 0], values[2, 0])[0, 1]), "Error")
+
+class TestCommandLine(unittest.TestCase):
+
+    # A batch file runs to per-query files and an npz archive, bad specs are reported
+    def test_batch(self):
+        specs = [{"name": "max", "method": "get_max", "args": [53.08, 8.80, '"2014-01":"2014-12"']},
+                 {"method": "get_3d_to_1d_subset", "args": [53.08, 8.80, '"2014-01":"2014-12"']},
+                 "for $c in (AvgLandTemp) return 1",
+                 {"method": "get_3d_to_2d_subset", "kwargs": {"ansi": '"2014-07"'}},
+                 {"method": "no_such_method"}]
+        with MockWCPSServer() as server, tempfile.TemporaryDirectory() as directory:
+            batch = os.path.join(directory, "batch.jsonl")
+            with open(batch, "w") as f:
+                f.write("\n".join(json.dumps(spec) for spec in specs))
+            out, err = io.StringIO(), io.StringIO()
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+                code = cli_main([batch, "--url", server.url, "--output-dir", os.path.join(directory, "out"),
+                                 "--npz", os.path.join(directory, "results.npz")])
+            self.assertEqual(code, 1, "Error")
+            self.assertEqual(len(out.getvalue().splitlines()), 5, "Error")
+            self.assertIn("5 queries (1 failed)", err.getvalue(), "Error")
+            self.assertEqual(sorted(os.listdir(os.path.join(directory, "out"))),
+                             ["2.txt", "3.txt", "4.png", "max.txt"], "Error")
+            with np.load(os.path.join(directory, "results.npz")) as results:
+                self.assertEqual(results["2"].shape, (12,), "Error")
+                self.assertEqual(float(results["max"]), 25.984251, "Error")
+
+    # Repeated names get the first free suffix, also when a later spec uses it explicitly
+    def test_unique_names(self):
+        query = "for $c in (AvgLandTemp) return 1"
+        with MockWCPSServer() as server:
+            names_wdc = WebDataConnector(server.url)
+            out = io.StringIO()
+            run_batch(names_wdc, [("a", query), ("a", query), ("a_2", query), ("a", query)], out=out)
+            names = sorted(json.loads(line)["name"] for line in out.getvalue().splitlines())
+            self.assertEqual(names, ["a", "a_2", "a_2_2", "a_3"], "Error")
+            names_wdc.close()
+
+class TestImport(unittest.TestCase):
+
+    # Importing the package loads none of the heavy dependencies
+    def test_lazy_import(self):
+        for module in ("rascode", "rascode.main"):
+            self.assertEqual(bench_import(module, repeat=1)["heavy_modules"], [], "Error")
+
 if __name__ == "__main__": 
     unittest.main()
\ No newline at end of file
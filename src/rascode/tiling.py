@@ -0,0 +1,96 @@
+# Spatial tiling
+# Splits queries over large Lat/Long extents into tiles that are fetched in parallel,
+# then stitches the tiles back into one array or combines their partial aggregates
+
+import numpy as np
+
+from .exceptions import QueryError
+from .images import detect_image, decode_image
+from .metadata import Axis, parse_bounds
+from .netcdf import is_netcdf, read_netcdf
+from .results import decode_result
+from .store import decode_grid
+
+def split_extent(extent, tile_size, resolution=None, axis=None):
+    """
+    Splits an extent such as '35:75' into disjoint ranges of at most tile_size degrees
+    that together select the same grid cells as the extent. Tile edges lie on cell
+    centres, so no cell is fetched twice and none is left out. The grid comes from
+    'axis' (an Axis of the coverage metadata) or, without it, from 'resolution' with
+    cells starting at the lower end of the extent.
+    """
+    if tile_size <= 0:
+        raise ValueError("tile_size must be positive")
+    if axis is None:
+        if not resolution:
+            raise QueryError("Tiling needs the grid resolution or the coverage metadata, "
+                             "otherwise neighbouring tiles would share their edge cells")
+        low, high = (float(value) for value in parse_bounds(extent))
+        axis = Axis('', low, high, max(round((high - low) / resolution), 1), resolution)
+    first, last = axis.indices(parse_bounds(extent))
+    cells = max(round(tile_size / axis.resolution), 1)
+    return [axis.subset(start, min(start + cells, last + 1) - 1) for start in range(first, last + 1, cells)]
+
+def decode_tile(raw, lat_descending=True):
+    """
+    Decodes one tile - images to an (height, width[, bands]) array, netCDF subsets to
+    a (Lat, Long, ...) array with Lat running like the rows of images (north to south
+    with lat_descending), other results with decode_result.
+    """
+    if detect_image(raw) is not None:
+        return decode_image(raw)
+    if is_netcdf(raw):
+        dims = list(read_netcdf(raw)[0])
+        names = sorted(dims, key=lambda name: {'lat': 0, 'long': 1}.get(name.lower(), 2))
+        data = decode_grid(raw, names)
+        return np.flip(data, 0) if lat_descending and names[0].lower() == 'lat' else data
+    return decode_result(raw)
+
+def stitch(tiles, shape, lat_descending=True):
+    """
+    Joins the decoded tiles (ordered Lat-major, ascending Lat and Long) into one array
+    of shape (rows, columns, ...). With lat_descending the northernmost tiles come first,
+    matching the row order of images.
+    """
+    rows = [list(tiles[i * shape[1]:(i + 1) * shape[1]]) for i in range(shape[0])]
+    if lat_descending:
+        rows.reverse()
+    return np.concatenate([np.concatenate(row, axis=1) for row in rows], axis=0)
+
+def combine_aggregate(aggregate_func, partials):
+    """
+    Combines per-tile partial aggregates into the aggregate over the whole extent.
+    For 'avg' every partial is a (sum, cell count) pair.
+    """
+    partials = np.asarray(partials, dtype=np.float64)
+    match aggregate_func:
+        case "min":
+            return partials.min()
+        case "max":
+            return partials.max()
+        case "count" | "add" | "sum":
+            return partials.sum()
+        case "avg":
+            total, cells = partials.sum(axis=0)
+            return total / cells
+    raise ValueError(f"Aggregate '{aggregate_func}' cannot be combined across tiles")
+
+class TiledQuery:
+    """
+    Queries for the tiles of one extent, ordered Lat-major.
+    - 'shape' is the number of (Lat, Long) tiles.
+    - 'aggregate_func' is set for tiled aggregations, which return partial aggregates.
+    """
+    def __init__(self, queries, shape, aggregate_func=None, lat_descending=True):
+        self.queries = queries
+        self.shape = shape
+        self.aggregate_func = aggregate_func
+        self.lat_descending = lat_descending
+
+    # Turns the raw tile results into the stitched array or the combined aggregate
+    def combine(self, results):
+        tiles = [decode_tile(raw, self.lat_descending) for raw in results]
+        if self.aggregate_func:
+            return combine_aggregate(self.aggregate_func, tiles)
+        tiles = [np.atleast_2d(tile) for tile in tiles]
+        return stitch(tiles, self.shape, self.lat_descending)
@@ -0,0 +1,121 @@
+# Time series fetching
+# Splits long ansi ranges into chunks fetched concurrently and keeps a local copy
+# of fetched series so a refresh only asks the server for the newer time steps
+
+import os
+from datetime import date, timedelta
+
+import numpy as np
+
+from .results import decode_result
+
+def parse_date(value):
+    """
+    Parses a 'YYYY-MM' or 'YYYY-MM-DD' ansi date (quotes are ignored).
+    Returns the date and whether it has monthly resolution.
+    """
+    value = str(value).strip().strip('"\'')
+    parts = [int(part) for part in value[:10].split('-')]
+    if len(parts) == 2:
+        return date(parts[0], parts[1], 1), True
+    return date(parts[0], parts[1], parts[2]), False
+
+def format_date(day, monthly):
+    return day.strftime('%Y-%m') if monthly else day.isoformat()
+
+def add_steps(day, steps, monthly):
+    """
+    Moves a date by a number of time steps (months or days).
+    """
+    if monthly:
+        months = day.year * 12 + day.month - 1 + steps
+        return date(months // 12, months % 12 + 1, 1)
+    return day + timedelta(days=steps)
+
+def chunk_dates(start, end, chunk_size):
+    """
+    Splits the inclusive range start..end into consecutive (start, end) ranges of
+    chunk_size time steps, in the format of start ('YYYY-MM' or 'YYYY-MM-DD').
+    """
+    first, monthly = parse_date(start)
+    last, _ = parse_date(end)
+    chunks = []
+    while first <= last:
+        chunk_end = min(add_steps(first, chunk_size - 1, monthly), last)
+        chunks.append((format_date(first, monthly), format_date(chunk_end, monthly)))
+        first = add_steps(chunk_end, 1, monthly)
+    return chunks
+
+class TimeSeriesFetcher:
+    """
+    Fetches one time series in chunks through a DatabaseOperation.
+    - 'build_query' is called with the (start, end) dates of a chunk and returns the
+      WCPS query of that chunk, for example
+      lambda start, end: cube.get_3d_to_1d_subset(lat, long, f'"{start}":"{end}"') or
+      lambda start, end: cube.get_data_series(lat, long, start, end, freq)
+    - 'chunk_size' is the number of time steps (months or days) per request.
+    - 'store' is an optional .npz path holding the series between runs.
+    - 'metadata' is the CoverageMetadata of the coverage (see
+      WebDataConnector.describe_coverage); refresh then stops at the last date of its
+      'time_axis', as servers reject subsets reaching past the extent.
+    """
+    def __init__(self, dbo, build_query, chunk_size=12, max_workers=8, store=None, metadata=None,
+                 time_axis='ansi'):
+        self.dbo = dbo
+        self.build_query = build_query
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.store = store
+        self.metadata = metadata
+        self.time_axis = time_axis
+
+    # Fetches start..end with the chunks requested concurrently and joined in date order
+    def fetch(self, start, end):
+        queries = [self.build_query(first, last) for first, last in chunk_dates(start, end, self.chunk_size)]
+        results = self.dbo.fetch_all(queries, self.max_workers)
+        return np.concatenate([np.atleast_1d(decode_result(raw)) for raw in results])
+
+    # Returns the stored series extended up to end, fetching only the time steps after
+    # the stored end date; the store is created on the first run and updated afterwards
+    # With metadata, end is first clamped to the time extent of the coverage, so a
+    # refresh up to a date that is not published yet returns the steps that are
+    def refresh(self, start, end):
+        end = self.clamp(end)
+        stored = self.load()
+        if stored is None or stored[0] != start:
+            values = self.fetch(start, end)
+        else:
+            _, stored_end, values = stored
+            last, monthly = parse_date(stored_end)
+            if parse_date(end)[0] <= last:
+                return values
+            next_step = format_date(add_steps(last, 1, monthly), monthly)
+            values = np.concatenate([values, self.fetch(next_step, end)])
+        # The stored end is the date of the last value returned, which is end unless
+        # the server returned fewer steps than asked for
+        first, monthly = parse_date(start)
+        self.save(start, format_date(add_steps(first, len(values) - 1, monthly), monthly), values)
+        return values
+
+    # Returns end, or the last date of the time axis of the metadata if that is earlier,
+    # in the format of end
+    def clamp(self, end):
+        if self.metadata is None:
+            return end
+        axis = self.metadata.axis(self.time_axis)
+        upper = axis.coefficients[-1] if axis.coefficients else axis.upper
+        day, monthly = parse_date(end)
+        last = parse_date(upper[:10])[0]
+        return format_date(min(day, last), monthly)
+
+    # Returns (start, end, values) of the stored series, or None
+    def load(self):
+        if not self.store or not os.path.exists(self.store):
+            return None
+        with np.load(self.store) as data:
+            return str(data['start']), str(data['end']), data['values']
+
+    def save(self, start, end, values):
+        if self.store:
+            with open(self.store, 'wb') as f:
+                np.savez(f, start=start, end=end, values=values)
@@ -2,15 +2,71 @@
 # URL associated with an instance of WDC will be used for 
 # all connections and datacubes.
 
-from dbc import DataBlockConnector
-from dbo import DatabaseOperation
+from .dbc import DataBlockConnector
+from .adbc import AsyncDataBlockConnector
+from .dbo import DatabaseOperation
+from .images import ImageWriter
+from .metadata import MetadataCache
 
 class WebDataConnector:
     # Initialize database connection object with user-specified URL
-    def __init__(self, server_url):
-        self.dbc = DataBlockConnector(server_url)
+    # Pool options (pool_connections, pool_maxsize, timeout, compress, coalesce, limiter, retry,
+    # hedge) are passed to the DBC, whose connection pool is shared by every DBO created from this WDC
+    # max_in_flight limits the concurrent requests of the asyncio connector (ADBC)
+    # cache is an optional QueryCache shared by every DBO created from this WDC
+    # Coverage descriptions are cached per server, in metadata_path if given, and
+    # fetched again once they are older than metadata_max_age seconds
+    # instrumentation is an optional Instrumentation shared by every DBO created from
+    # this WDC; sinks can be added to it at any time
+    # local is an optional LocalEvaluator shared by every DBO created from this WDC
+    # Image files of every DBO created from this WDC are written by one ImageWriter
+    def __init__(self, server_url, max_in_flight=100, cache=None, metadata_path=None,
+                 metadata_max_age=24 * 3600, instrumentation=None, local=None, **pool_options):
+        self.cache = cache
+        self.instrumentation = instrumentation
+        self.local = local
+        self.metadata = MetadataCache(metadata_path, metadata_max_age)
+        self.images = ImageWriter()
+        self.dbc = DataBlockConnector(server_url, **pool_options)
+        self.adbc = AsyncDataBlockConnector(server_url, max_in_flight=max_in_flight,
+                                            timeout=self.dbc.timeout, compress=self.dbc.compress,
+                                            coalesce=self.dbc.coalesce,
+                                            adaptive=self.dbc.limiter is not None,
+                                            retry=self.dbc.retry)
 
     # Create DataCube object
-    def createDBO(self):
-        return DatabaseOperation(self.dbc)
-    
\ No newline at end of file
+    # typed=True makes the DBO return numeric results as NumPy-backed QueryResult objects
+    # image_dir is where image results are written (None keeps them in memory only)
+    def createDBO(self, typed=False, image_dir='.'):
+        return DatabaseOperation(self.dbc, self.adbc, self.cache, typed=typed,
+                                 instrumentation=self.instrumentation, image_dir=image_dir,
+                                 local=self.local, writer=self.images)
+
+    # Returns the CoverageMetadata (axes, extents, resolution, CRS) of a coverage,
+    # to be passed to DataCube for local validation and size estimates
+    def describe_coverage(self, coverage, refresh=False):
+        return self.metadata.describe(self.dbc, coverage, refresh)
+
+    # Returns a ChunkStore keeping the values of a coverage in chunks under root, fetching
+    # missing chunks through a DBO of this WDC (see store.py)
+    def open_store(self, coverage, root, chunks=None, max_workers=8):
+        from .store import ChunkStore
+        return ChunkStore(root, self.describe_coverage(coverage), self.createDBO(image_dir=None),
+                          chunks=chunks, max_workers=max_workers)
+
+    # Returns the ids of the coverages offered by the server
+    def list_coverages(self, refresh=False):
+        return self.metadata.coverages(self.dbc, refresh)
+
+    # Close the pooled connections of the shared DBC and stop the image writer once
+    # every image is written
+    def close(self):
+        self.images.close()
+        self.dbc.close()
+
+    # Close the session of the shared ADBC, must be awaited in the event loop that used it,
+    # and stop the image writer once every image is written
+    async def aclose(self):
+        import asyncio
+        await asyncio.get_running_loop().run_in_executor(None, self.images.close)
+        await self.adbc.close()